@@ -0,0 +1,32 @@
+import h5py
+import numpy as np
+from cli.dataset_builder import images_key
+
+
+def get_images(dataset, n_images, size=128, seed=42, sample=False):
+    """
+    Returns the images to benchmark, from a dataset or synthetic.
+
+    Args:
+        dataset(str):           HDF5 dataset to take the images from, synthetic if None
+        n_images(int):          number of images
+        size(int):              size of the synthetic images
+        seed(int):              seed of the sample and of the synthetic images
+        sample(bool):           random rows of the dataset instead of the first ones
+    Returns:
+        images(numpy.array):    (n_images, H, W, 3) uint8 images
+    """
+    if dataset:
+        with h5py.File(dataset, "r") as file:
+            # segmented datasets only hold split sets
+            key = "train_images" if "train_images" in file else images_key(file)
+            images = file[key]
+            n = min(n_images, len(images))
+            if not sample:
+                return images[:n]
+            rng = np.random.default_rng(seed)
+            return images[np.sort(rng.choice(len(images), n, replace=False))]
+    # smooth synthetic images with leaf-like and background colors, compressible like real photos
+    rng = np.random.default_rng(seed)
+    low = rng.integers(0, 256, (n_images, 8, 8, 3), dtype=np.uint8)
+    return np.repeat(np.repeat(low, size // 8, axis=1), size // 8, axis=2)
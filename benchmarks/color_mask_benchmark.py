@@ -0,0 +1,74 @@
+"""
+Compares the per-image color_mask + remove_whites path of the leaf
+segmentation with the batched kernels (color_mask_batch, remove_whites_batch),
+and checks that both give the same masks.
+
+usage:
+    python benchmarks/color_mask_benchmark.py [--dataset path_to_h5] [--n_images 1024]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_utils import get_images
+from cli.leaf_segmentation import color_mask, color_mask_batch
+from cli.image_preprocessing import remove_whites, remove_whites_batch
+
+
+def per_image(images, mask_type):
+    masks = np.empty(images.shape[:3], dtype=np.uint8)
+    for img, dst in zip(images, masks):
+        final_mask = color_mask(img, ls1=17, ls2=60, type=mask_type)[0]
+        dst[:] = remove_whites(img, final_mask)
+    return masks
+
+
+def batched(images, mask_type, batch_size):
+    masks = np.empty(images.shape[:3], dtype=np.uint8)
+    for start in range(0, len(images), batch_size):
+        block = images[start:start + batch_size]
+        final_masks = color_mask_batch(block, ls1=17, ls2=60, type=mask_type)[3]
+        masks[start:start + batch_size] = remove_whites_batch(block, final_masks)
+    return masks
+
+
+def timed(fn, *args, repeat=3):
+    """ Returns the output and the best time of a function over repeat runs. """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Color mask kernels benchmark.')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help="HDF5 dataset to take the images from")
+    parser.add_argument('--n_images', type=int, default=1024)
+    parser.add_argument('--size', type=int, default=128,
+                        help="size of the synthetic images")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = get_images(args.dataset, args.n_images, args.size)
+    print(f"Images: {images.shape}\n")
+    print(f"{'mask type':<12}{'path':<16}{'time (s)':>10}{'img/s':>10}{'speedup':>10}{'identical':>11}")
+    for mask_type in [1, 2]:
+        ref, ref_time = timed(per_image, images, mask_type, repeat=args.repeat)
+        print(f"{mask_type:<12}{'per image':<16}{ref_time:>10.3f}"
+              f"{len(images) / ref_time:>10.0f}{1:>10.2f}{'':>11}")
+        for batch_size in args.batch_sizes:
+            out, out_time = timed(batched, images, mask_type, batch_size, repeat=args.repeat)
+            print(f"{'':<12}{f'batch({batch_size})':<16}{out_time:>10.3f}"
+                  f"{len(images) / out_time:>10.0f}{ref_time / out_time:>10.2f}"
+                  f"{str(np.array_equal(ref, out)):>11}")
+
+
+if __name__ == "__main__":
+    main()
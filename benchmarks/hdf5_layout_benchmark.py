@@ -0,0 +1,88 @@
+"""
+Compares the on-disk size and the sequential and random read throughput of
+the HDF5 image layouts offered by store_hdf5.
+
+usage:
+    python benchmarks/hdf5_layout_benchmark.py [--dataset path_to_h5] [--n_images 2000]
+"""
+import os
+import sys
+import time
+import h5py
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_utils import get_images
+from cli.dataloader import hdf5_layout
+
+LAYOUTS = {
+    'legacy (contiguous, STD_U8BE)': None,
+    'contiguous': dict(layout='contiguous'),
+    'image': dict(layout='image'),
+    'image + lzf': dict(layout='image', compression='lzf'),
+    'image + gzip + shuffle': dict(layout='image', compression='gzip', shuffle=True),
+    'batch(64)': dict(layout='batch', chunk_rows=64),
+    'batch(64) + lzf': dict(layout='batch', chunk_rows=64, compression='lzf'),
+    'batch(64) + gzip + shuffle': dict(layout='batch', chunk_rows=64, compression='gzip', shuffle=True),
+}
+
+
+def write(path, images, options):
+    with h5py.File(path, "w") as file:
+        if options is None:
+            file.create_dataset("images", images.shape,
+                                h5py.h5t.STD_U8BE, data=images)
+        else:
+            file.create_dataset("images", data=images, dtype=np.uint8,
+                                **hdf5_layout(images.shape, **options))
+
+
+def read_throughput(path, batch_size, n_random, seed=42):
+    """ Returns the sequential and random read throughput in images/s. """
+    with h5py.File(path, "r") as file:
+        images = file["images"]
+        n = images.shape[0]
+        start = time.perf_counter()
+        for i in range(0, n, batch_size):
+            images[i:i + batch_size]
+        seq = n / (time.perf_counter() - start)
+
+        rows = np.random.default_rng(seed).integers(0, n, n_random)
+        start = time.perf_counter()
+        for row in rows:
+            images[row]
+        rand = n_random / (time.perf_counter() - start)
+    return seq, rand
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HDF5 layout benchmark.')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help="HDF5 dataset to take the images from")
+    parser.add_argument('--n_images', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=128,
+                        help="size of the synthetic images")
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--n_random', type=int, default=1000)
+    args = parser.parse_args()
+
+    images = get_images(args.dataset, args.n_images, args.size)
+    print(f"Images: {images.shape} -- {images.nbytes / 2**20:.1f} MB in memory\n")
+    print(f"{'layout':<30}{'size (MB)':>12}{'write (s)':>12}"
+          f"{'seq (img/s)':>14}{'rand (img/s)':>14}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, options in LAYOUTS.items():
+            path = os.path.join(tmp_dir, "bench.h5")
+            start = time.perf_counter()
+            write(path, images, options)
+            write_time = time.perf_counter() - start
+            size = os.path.getsize(path) / 2**20
+            seq, rand = read_throughput(path, args.batch_size, args.n_random)
+            print(f"{name:<30}{size:>12.1f}{write_time:>12.2f}{seq:>14.0f}{rand:>14.0f}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
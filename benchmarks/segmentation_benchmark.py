@@ -0,0 +1,244 @@
+"""
+Cost and quality of the remove_background variants over a fixed sample of
+images: latency of each stage of back_segmentation, throughput per core,
+memory allocated, and agreement (IoU) of the leaf masks with a reference
+variant.
+
+A variant is a preprocessing type with options, e.g. 'p0', 'p2+dist',
+'p1+cast' or 'p0-white' (without the removal of the white pixels). A
+'@scale' suffix computes the masks on images downscaled by scale, e.g.
+'p0+dist@0.5', and '+refine' refines the edges of the upsampled masks.
+'+adaptive' only runs the watershed of dist on the images whose HSV mask is
+not clean (needs_watershed); the number of images on each path and the time
+saved are reported against the same variant without the gate.
+
+usage:
+    python benchmarks/segmentation_benchmark.py [--dataset path_to_h5] [--n_images 256]
+        [--variants p0 p1 p2 p0+dist p0+dist+adaptive p0+dist@0.5] [--reference p2+dist]
+        [--n_workers 4]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_utils import get_images
+from cli.batch_engine import WorkerPool, map_batches
+import cv2
+from cli.leaf_segmentation import (color_mask, watershed_markers, mask_batch, upscale_masks,
+                                   needs_watershed)
+from cli.image_preprocessing import (adjust_contrast, adjust_lightness, color_cast_removal,
+                                     remove_whites, fill_object)
+
+VARIANTS = ['p0', 'p1', 'p2', 'p0+dist', 'p1+dist', 'p2+dist', 'p0+cast', 'p0-white',
+            'p0@0.5', 'p0+dist@0.5', 'p0+dist@0.5+refine', 'p2+dist@0.5',
+            'p0+dist+adaptive', 'p2+dist+adaptive']
+STAGES = ['downscale', 'cast', 'contrast', 'lightness', 'color_mask', 'remove_whites',
+          'gate', 'dist', 'fill_object', 'upscale']
+
+
+def parse_variant(variant):
+    """ Returns the options of a variant name, see the module docstring. """
+    p_type = int(variant[1])
+    scale = float(variant.split('@')[1].split('+')[0]) if '@' in variant else 1.
+    options = {'p_type': p_type, 'contrast': p_type in [1, 2], 'lightness': p_type == 2,
+               'dist': '+dist' in variant, 'cast': '+cast' in variant,
+               'white': '-white' not in variant, 'mask_scale': scale,
+               'refine': '+refine' in variant, 'adaptive': '+adaptive' in variant}
+    return options
+
+
+def staged_segmentation(rgb_img, options, timings, paths=None):
+    """
+    back_segmentation split in stages, each one timed into timings. The path
+    taken by the images of dist is counted into paths if given.
+
+    Returns:
+        mask (numpy.array):     leaf mask of the image, True on the leaves
+    """
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        out = fn(*args)
+        timings[stage] += time.perf_counter() - start
+        return out
+
+    full_img = rgb_img
+    if options['mask_scale'] != 1:
+        h, w = rgb_img.shape[:2]
+        size = (max(1, round(w * options['mask_scale'])), max(1, round(h * options['mask_scale'])))
+        rgb_img = timed('downscale', cv2.resize, rgb_img, size, None, 0, 0, cv2.INTER_AREA)
+
+    new_img = rgb_img.copy()
+    if options['cast']:
+        new_img = timed('cast', color_cast_removal, new_img)
+    if options['contrast']:
+        new_img = timed('contrast', adjust_contrast, new_img)
+    if options['lightness']:
+        new_img = timed('lightness', adjust_lightness, new_img)
+    final_mask = timed('color_mask', color_mask, new_img, 17, 60)[0]
+    if options['white']:
+        final_mask = timed('remove_whites', remove_whites, rgb_img, final_mask)
+    dist = options['dist']
+    if dist and options['adaptive']:
+        dist = timed('gate', needs_watershed, final_mask)
+    if dist:
+        markers = timed('dist', watershed_markers, rgb_img, final_mask)
+    if paths is not None and options['dist']:
+        paths['watershed' if dist else 'fill'] += 1
+    final_mask = timed('fill_object', fill_object, rgb_img, final_mask)[0]
+    mask = (markers > 1 if dist else final_mask != 0).astype(np.uint8)
+
+    if options['mask_scale'] != 1:
+        h, w = full_img.shape[:2]
+        refine_imgs = full_img[np.newaxis] if options['refine'] else None
+        mask = timed('upscale', upscale_masks, mask[np.newaxis], (w, h), refine_imgs,
+                     options['p_type'], options['dist'])[0]
+    return mask != 0
+
+
+def run_variant(images, options, n_warmup=4):
+    """
+    Segments the images one by one, after a few untimed warm-up images.
+
+    Returns:
+        masks (numpy.array):    (N, H, W) leaf masks
+        timings (dict):         stage -> total time (s)
+        latencies (numpy.array): time of each image (s)
+        paths (dict):           number of images of dist on each path
+    """
+    for img in images[:n_warmup]:
+        staged_segmentation(img, options, dict.fromkeys(STAGES, 0.))
+    timings = dict.fromkeys(STAGES, 0.)
+    paths = {'watershed': 0, 'fill': 0}
+    latencies = np.empty(len(images))
+    masks = np.empty(images.shape[:3], dtype=bool)
+    for i, img in enumerate(images):
+        start = time.perf_counter()
+        masks[i] = staged_segmentation(img, options, timings, paths)
+        latencies[i] = time.perf_counter() - start
+    return masks, timings, latencies, paths
+
+
+def peak_memory(images, options, n_images=32):
+    """ Returns the peak memory (bytes) allocated while segmenting images one by one. """
+    timings = dict.fromkeys(STAGES, 0.)
+    tracemalloc.start()
+    for img in images[:n_images]:
+        staged_segmentation(img, options, timings)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def pool_throughput(images, options, n_workers, chunk_size=32):
+    """
+    Images per second and per core of the batched path on a pool of
+    processes, started and warmed up (a chunk per worker) before the timing.
+    """
+    kwargs = dict(out_shape=images.shape[1:3], chunk_size=chunk_size, p_type=options['p_type'],
+                  dist=options['dist'], mask_scale=options['mask_scale'],
+                  refine=options['refine'], adaptive=options['adaptive'])
+    with WorkerPool(n_workers) as pool:
+        warmup = np.resize(images, (max(n_workers, 2) * chunk_size, *images.shape[1:]))
+        map_batches(mask_batch, warmup, pool=pool, desc='Warm-up', **kwargs)
+        start = time.perf_counter()
+        map_batches(mask_batch, images, pool=pool, desc='Batched', **kwargs)
+        return len(images) / (time.perf_counter() - start) / n_workers
+
+
+def full_resolution(variant):
+    """ Returns the name of a variant without its mask scale and refinement. """
+    if '@' not in variant:
+        return variant
+    name, scale = variant.split('@')
+    options = [option for option in scale.split('+')[1:] if option != 'refine']
+    return '+'.join([name, *options])
+
+
+def without_gate(variant):
+    """ Returns the name of a variant without the adaptive watershed gate. """
+    return variant.replace('+adaptive', '')
+
+
+def iou(masks, ref_masks):
+    """ Intersection over union of each mask with its reference. """
+    inter = np.logical_and(masks, ref_masks).sum(axis=(1, 2))
+    union = np.logical_or(masks, ref_masks).sum(axis=(1, 2))
+    return np.where(union > 0, inter / np.maximum(union, 1), 1.)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Leaf segmentation variants benchmark.')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help="HDF5 dataset to take the images from")
+    parser.add_argument('--n_images', type=int, default=256)
+    parser.add_argument('--size', type=int, default=128,
+                        help="size of the synthetic images")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="seed of the sample of images")
+    parser.add_argument('--variants', type=str, nargs='+', default=VARIANTS)
+    parser.add_argument('--reference', type=str, default='p2+dist',
+                        help="variant the masks are compared with")
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help="also measure the batched path on a pool of processes")
+    args = parser.parse_args()
+
+    images = get_images(args.dataset, args.n_images, args.size, args.seed, sample=True)
+    print(f"Images: {images.shape}\n")
+    # scaled and gated variants are also compared with the variants without
+    variants = [args.reference]
+    for variant in args.variants:
+        variants += [full_resolution(variant), without_gate(variant), variant]
+    variants = list(dict.fromkeys(variants))
+    results = dict()
+    for variant in variants:
+        options = parse_variant(variant)
+        masks, timings, latencies, paths = run_variant(images, options)
+        results[variant] = {'masks': masks, 'timings': timings, 'latencies': latencies,
+                            'paths': paths, 'peak': peak_memory(images, options)}
+        if args.n_workers and not options['cast'] and options['white']:
+            results[variant]['pool'] = pool_throughput(images, options, args.n_workers)
+
+    ref_masks = results[args.reference]['masks']
+    print(f"\nMean latency per stage (ms / image)")
+    print(f"{'variant':<20}" + ''.join(f"{stage:>14}" for stage in STAGES))
+    for variant, res in results.items():
+        print(f"{variant:<20}" + ''.join(
+            f"{1e3 * res['timings'][stage] / len(images):>14.3f}" for stage in STAGES))
+
+    print(f"\nCost and mask agreement with {args.reference}")
+    print(f"{'variant':<20}{'mean (ms)':>11}{'p95 (ms)':>10}{'img/s/core':>12}"
+          f"{'pool img/s/core':>17}{'peak (KiB)':>12}{'IoU mean':>10}{'IoU min':>9}"
+          f"{'speedup full res':>18}{'IoU full res':>14}")
+    for variant, res in results.items():
+        scores = iou(res['masks'], ref_masks)
+        pool = f"{res['pool']:.0f}" if 'pool' in res else '-'
+        full = results[full_resolution(variant)]
+        speedup = full['latencies'].mean() / res['latencies'].mean()
+        full_scores = iou(res['masks'], full['masks'])
+        print(f"{variant:<20}{1e3 * res['latencies'].mean():>11.3f}"
+              f"{1e3 * np.percentile(res['latencies'], 95):>10.3f}"
+              f"{1 / res['latencies'].mean():>12.0f}{pool:>17}"
+              f"{res['peak'] / 2**10:>12.0f}{scores.mean():>10.4f}{scores.min():>9.4f}"
+              f"{speedup:>18.2f}{full_scores.mean():>14.4f}")
+
+    gated = [variant for variant in results if parse_variant(variant)['adaptive']
+             and parse_variant(variant)['dist']]
+    if gated:
+        print(f"\nAdaptive watershed gate, against the variants without it")
+        print(f"{'variant':<20}{'watershed':>11}{'fill':>7}{'gate (ms)':>11}"
+              f"{'saved (ms/img)':>16}{'saved (s)':>11}{'IoU':>8}")
+    for variant in gated:
+        res, full = results[variant], results[without_gate(variant)]
+        saved = full['latencies'].sum() - res['latencies'].sum()
+        print(f"{variant:<20}{res['paths']['watershed']:>11}{res['paths']['fill']:>7}"
+              f"{1e3 * res['timings']['gate'] / len(images):>11.3f}"
+              f"{1e3 * saved / len(images):>16.3f}{saved:>11.3f}"
+              f"{iou(res['masks'], full['masks']).mean():>8.4f}")
+
+
+if __name__ == "__main__":
+    main()
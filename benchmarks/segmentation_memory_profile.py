@@ -0,0 +1,90 @@
+"""
+Allocation and peak memory profile of the leaf segmentation on a batch of
+images: remove_background image by image against a SegmentationContext
+reusing its buffers, with the same output.
+
+Memory is traced with tracemalloc (numpy and OpenCV output arrays included):
+'alloc/img' is the memory allocated while segmenting an image (its peak above
+what was allocated before it), 'peak' the peak over the whole batch and
+'buffers' the persistent buffers of the context.
+
+usage:
+    python benchmarks/segmentation_memory_profile.py [--dataset path_to_h5] [--n_images 256]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_utils import get_images
+from cli.leaf_segmentation import remove_background, SegmentationContext
+
+
+def per_image(images, p_type, dist, out):
+    for img, dst in zip(images, out):
+        dst[:] = remove_background(img, p_type, dist)
+
+
+def profile(segment, images, p_type, dist, out, repeat=3):
+    """
+    Segments the images into out under tracemalloc, after one untimed image.
+
+    Returns:
+        alloc (float):  mean memory allocated per image (bytes)
+        peak (int):     peak memory allocated over the batch (bytes)
+        seconds (float): best time of the batch over repeat runs, without tracing
+    """
+    segment(images[:1], p_type, dist, out[:1])
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        segment(images, p_type, dist, out)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    peak = alloc = 0
+    for i in range(len(images)):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        segment(images[i:i + 1], p_type, dist, out[i:i + 1])
+        image_peak = tracemalloc.get_traced_memory()[1]
+        alloc += image_peak - before
+        peak = max(peak, image_peak)
+    tracemalloc.stop()
+    return alloc / len(images), peak, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segmentation memory profile.')
+    parser.add_argument('--dataset', type=str, default=None,
+                        help="HDF5 dataset to take the images from")
+    parser.add_argument('--n_images', type=int, default=256)
+    parser.add_argument('--size', type=int, default=128,
+                        help="size of the synthetic images")
+    args = parser.parse_args()
+
+    images = get_images(args.dataset, args.n_images, args.size)
+    print(f"Images: {images.shape}\n")
+    print(f"{'variant':<10}{'path':<10}{'alloc/img (KiB)':>17}{'peak (KiB)':>12}"
+          f"{'buffers (KiB)':>15}{'time (s)':>10}{'identical':>11}")
+    for p_type in [0, 1, 2]:
+        for dist in [False, True]:
+            variant = f"p{p_type}{'+dist' if dist else ''}"
+            ref = np.empty_like(images)
+            alloc, peak, seconds = profile(per_image, images, p_type, dist, ref)
+            print(f"{variant:<10}{'per image':<10}{alloc / 2**10:>17.1f}{peak / 2**10:>12.0f}"
+                  f"{'-':>15}{seconds:>10.3f}{'':>11}")
+
+            context = SegmentationContext(images.shape[1:3])
+            out = np.empty_like(images)
+            alloc, peak, seconds = profile(context.segment_images, images, p_type, dist, out)
+            print(f"{'':<10}{'context':<10}{alloc / 2**10:>17.1f}{peak / 2**10:>12.0f}"
+                  f"{context.nbytes / 2**10:>15.0f}{seconds:>10.3f}"
+                  f"{str(np.array_equal(ref, out)):>11}")
+
+
+if __name__ == "__main__":
+    main()
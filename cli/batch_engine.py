@@ -0,0 +1,211 @@
+import multiprocessing
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from cli.cli_utils import ThroughputMeter
+
+# shared memory slots the worker process is attached to, set by _process_slot
+_slots = dict()
+
+
+class SharedSlots():
+    """
+    Ring of fixed-size array slots in shared memory, used to pass chunks of
+    images between processes without pickling them.
+
+    Attributes:
+        n_slots (int): number of slots
+        slot_shape (tuple): shape of a slot, (chunk_size, ...)
+        dtype (numpy.dtype): type of the arrays
+    """
+
+    def __init__(self, n_slots, slot_shape, dtype):
+        self.n_slots = n_slots
+        self.slot_shape = tuple(slot_shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, n_slots * int(np.prod(slot_shape)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.array = np.ndarray(
+            (n_slots, *self.slot_shape), dtype=self.dtype, buffer=self.shm.buf)
+
+
+    @property
+    def spec(self):
+        """ Picklable description used to attach to the slots from a worker. """
+        return self.shm.name, (self.n_slots, *self.slot_shape), self.dtype.str
+
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _process_slot(fn, specs, slot, n, with_stats, kwargs):
+    # the slots of a pool change with the shape of the images, attach to the new ones
+    if _slots.get('specs') != specs:
+        for shm, _ in _slots.get('arrays', []):
+            shm.close()
+        _slots['specs'], _slots['arrays'] = specs, [_attach(spec) for spec in specs]
+    src, dst = _slots['arrays'][0][1], _slots['arrays'][1][1]
+    if with_stats:
+        dst[slot, :n], stats = fn(src[slot, :n], **kwargs)
+        return n, stats
+    dst[slot, :n] = fn(src[slot, :n], **kwargs)
+    return n, None
+
+
+def _add_stats(stats, chunk_stats):
+    for key, value in chunk_stats.items():
+        stats[key] = stats.get(key, 0) + value
+
+
+class WorkerPool():
+    """
+    Pool of worker processes shared by successive map_batches calls, so that
+    the processes are started once and not for every call. The processes are
+    only started by the first call that needs them, and the shared memory
+    slots are kept as long as the images keep the same shape.
+
+    Attributes:
+        n_workers (int): number of processes
+    """
+
+    def __init__(self, n_workers=None):
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.executor = None
+        self.slots = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def _get_slots(self, chunk_shape, dtype, out_chunk_shape, out_dtype):
+        """ Returns the input and output slots, allocated again when the shapes change. """
+        n_slots = 2 * self.n_workers
+        if self.slots is not None:
+            src, dst = self.slots
+            if (src.slot_shape, src.dtype, dst.slot_shape, dst.dtype) == \
+                    (chunk_shape, dtype, out_chunk_shape, out_dtype):
+                return self.slots
+            src.close()
+            dst.close()
+        self.slots = (SharedSlots(n_slots, chunk_shape, dtype),
+                      SharedSlots(n_slots, out_chunk_shape, out_dtype))
+        return self.slots
+
+
+    def map(self, fn, images, out=None, out_shape=None, out_dtype=None, chunk_size=32, desc='Processing', stats=None, **kwargs):
+        """ See map_batches. """
+        if isinstance(images, (list, tuple)):
+            images = np.asarray(images)
+        out_shape = tuple(out_shape or images.shape[1:])
+        out_dtype = np.dtype(out_dtype or images.dtype)
+        if out is None:
+            out = np.empty((len(images), *out_shape), dtype=out_dtype)
+        meter = ThroughputMeter(len(images), desc=desc)
+
+        # not worth starting processes for a single chunk
+        if self.n_workers == 1 or len(images) <= chunk_size:
+            for start in range(0, len(images), chunk_size):
+                chunk = np.asarray(images[start:start + chunk_size])
+                if stats is not None:
+                    out[start:start + len(chunk)], chunk_stats = fn(chunk, **kwargs)
+                    _add_stats(stats, chunk_stats)
+                else:
+                    out[start:start + len(chunk)] = fn(chunk, **kwargs)
+                meter.update(len(chunk))
+            meter.close()
+            return out
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.n_workers)
+        src, dst = self._get_slots((chunk_size, *images.shape[1:]), np.dtype(images.dtype),
+                                   (chunk_size, *out_shape), out_dtype)
+        specs = (src.spec, dst.spec)
+        free, pending = deque(range(src.n_slots)), deque()
+
+        def collect():
+            start, slot, future = pending.popleft()
+            n, chunk_stats = future.result()
+            if stats is not None:
+                _add_stats(stats, chunk_stats)
+            out[start:start + n] = dst.array[slot, :n]
+            free.append(slot)
+            meter.update(n)
+
+        try:
+            for start in range(0, len(images), chunk_size):
+                if not free:
+                    collect()
+                slot = free.popleft()
+                chunk = images[start:start + chunk_size]
+                src.array[slot, :len(chunk)] = chunk
+                pending.append((start, slot, self.executor.submit(
+                    _process_slot, fn, specs, slot, len(chunk), stats is not None, kwargs)))
+            while pending:
+                collect()
+        finally:
+            # slots still in use by the workers are not reused
+            for _, _, future in pending:
+                future.cancel()
+            if pending:
+                self.close()
+        meter.close()
+        return out
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.slots is not None:
+            for slots in self.slots:
+                slots.close()
+            self.slots = None
+
+
+def map_batches(fn, images, out=None, out_shape=None, out_dtype=None, n_workers=None, chunk_size=32, desc='Processing', pool=None, stats=None, **kwargs):
+    """
+    Applies a batch function to images with a pool of worker processes.
+
+    The images are copied chunk by chunk into a ring of shared memory slots,
+    the workers write their results into output slots, and each result is
+    copied to its position in the output. Results are placed by position, so
+    the output does not depend on the completion order, and the number of
+    chunks in flight is bounded by the ring size.
+
+    Args:
+        fn(function):           top-level function mapping an (n, ...) chunk
+                                of images to an (n, ...) array, fn(chunk, **kwargs)
+        images(numpy.array):    (N, ...) images, or an h5py.Dataset
+        out(numpy.array):       array or h5py.Dataset receiving the results,
+                                allocated if None
+        out_shape(tuple):       shape of one result, that of an image if None
+        out_dtype(numpy.dtype): type of the results, that of the images if None
+        n_workers(int):         number of processes (defaults to the cpu count)
+        chunk_size(int):        number of images per task
+        desc(str):              description of the progress report
+        pool(WorkerPool):       pool to run on, started for this call if None
+                                (n_workers is then that of the pool)
+        stats(dict):            if given, fn returns (results, stats of the
+                                chunk) and the numbers are summed into stats
+    Returns:
+        out(numpy.array):       the results, in the order of the images
+    """
+    if pool is not None:
+        return pool.map(fn, images, out, out_shape, out_dtype, chunk_size, desc, stats, **kwargs)
+    with WorkerPool(n_workers) as pool:
+        return pool.map(fn, images, out, out_shape, out_dtype, chunk_size, desc, stats, **kwargs)
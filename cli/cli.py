@@ -1,22 +1,36 @@
+import os
 import sys
 import json
+import h5py
 import wandb
 import random
 import numpy as np
-from cli_utils import bcolors, strawb
-from dataloader import PlantDataset, store_hdf5, create_transformer_ds, resize_images
-from leaf_segmentation import segment_split_set
+from cli.cli_utils import bcolors, strawb
+from cli.dataloader import PlantDataset, load_hdf5, create_transformer_ds, export_shards
+from cli.dataset_builder import build_hdf5_dataset, store_split_indices, open_split_sets, load_duplicate_groups
+from cli.dataset_stats import channel_stats, split_stats
+from cli.near_duplicates import expand_groups
+from cli.leaf_segmentation import segment_split_set
+from cli.mask_cache import segment_dataset
 from sklearn.model_selection import train_test_split
 
+# resolutions built in a single pass, 128 for the CNNs and 224 for the transformers
+IMG_SIZES = [(128, 128), (224, 224)]
+
 
 def get_sample_dict(test_x, test_y, nbr_imgs):
+    """
+    Samples nbr_imgs images per label. Only the sampled rows are read, so
+    test_x can be a lazy view on a split set (see open_split_sets).
+    """
+    idx_dict = dict()
+    for i, label in enumerate(test_y):
+        if label not in idx_dict.keys():
+            idx_dict[label] = []
+        idx_dict[label].append(i)
     img_dict = dict()
-    for img, label in zip(test_x, test_y):
-        if label not in img_dict.keys():
-            img_dict[label] = []
-        img_dict[label].append(img)
-    for k, v in img_dict.items():
-        img_dict[k] = random.sample(v, nbr_imgs)
+    for k, v in idx_dict.items():
+        img_dict[k] = [test_x[i] for i in random.sample(v, nbr_imgs)]
     return img_dict
 
 
@@ -53,34 +67,34 @@ def viz_dataset_wandb(img_dict, name):
     wandb.run.finish()
 
 
-def get_split_sets(seed, class_type, images, labels):
+def get_split_sets(seed, class_type, labels, rows=None):
     """
-    Prepare the inputs and target split sets for a given classification.
+    Prepare the stratified split sets for a given classification. Only the
+    row indices are split, the images are read through them afterwards.
 
     Args:
         seed(int): seef for the random state
         class_type(str): type of classification (binary, multiclass)
-        images(numpy.array): images array
-        labels(numpy.array): label array
+        labels(numpy.array): label of each row
+        rows(numpy.array): rows of the dataset to split, all if None
 
     Returns:
-        images_split_lst(list): list containing the images split sets
-        label_split_lst(list): list containing the labels split sets
+        idx_split_lst(list): rows of the train, valid and test sets
     """
-
+    rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+    pos = np.arange(len(rows))
     # Split train, valid, test
-    X_train, X_tmp, y_train, y_tmp = train_test_split(
-        images, labels, test_size=0.30, stratify=labels, random_state=seed)
-    X_valid, X_test, y_valid, y_test = train_test_split(
-        X_tmp, y_tmp, test_size=0.50, stratify=y_tmp, random_state=seed)
+    pos_train, pos_tmp = train_test_split(
+        pos, test_size=0.30, stratify=labels, random_state=seed)
+    pos_valid, pos_test = train_test_split(
+        pos_tmp, test_size=0.50, stratify=labels[pos_tmp], random_state=seed)
 
-    label_split_lst = list([y_train, y_valid, y_test])
-    images_split_lst = list([X_train, X_valid, X_test])
+    pos_split_lst = list([np.sort(pos_train), np.sort(pos_valid), np.sort(pos_test)])
     name_lst = list(['Train', 'Valid', 'Test'])
 
     # Display counts for unique values in each set
-    for value, d_set in zip(label_split_lst, name_lst):
-        (unique, cnt) = np.unique(value, return_counts=True)
+    for split_pos, d_set in zip(pos_split_lst, name_lst):
+        (unique, cnt) = np.unique(labels[split_pos], return_counts=True)
         print(f"  {d_set} Labels:")
         for name, counts in zip(unique, cnt):
             print(f"    {name} = {counts}")
@@ -88,26 +102,28 @@ def get_split_sets(seed, class_type, images, labels):
             print(f"  Ratio Healthy = {cnt[0]/(cnt[0]+cnt[1])}")
             print(f"  Ratio Sick = {cnt[1]/(cnt[0]+cnt[1])}\n")
 
-    if class_type == 'healthy':
-        y_train = y_train[:, np.newaxis]
-        y_valid = y_valid[:, np.newaxis]
-        y_test = y_test[:, np.newaxis]
+    return [rows[split_pos] for split_pos in pos_split_lst]
 
-    return images_split_lst, label_split_lst
 
+def dump_training_stats(train_stats, label_type, prefix, size=128):
+    """
+    Writes the per-channel mean and std of a training set to a json file.
 
-def dump_training_stats(X_train, label_type, prefix):
-    X_train_mean_rgb = np.round(
-        np.mean(X_train, axis=tuple(range(X_train.ndim-1))), 3)
-    X_train_std_rgb = np.round(
-        np.std(X_train, axis=tuple(range(X_train.ndim-1))), 3)
+    Args:
+        train_stats(dict):  'mean' and 'std' arrays, see dataset_stats.split_stats
+        label_type(str):    type of classification
+        prefix(str):        prefix of the json file
+        size(int):          resolution of the images
+    """
+    X_train_mean_rgb = np.round(train_stats['mean'], 3)
+    X_train_std_rgb = np.round(train_stats['std'], 3)
     train_stats = {
         'X_train_mean_rgb': X_train_mean_rgb.tolist(),
         'X_train_std_rgb': X_train_std_rgb.tolist()
     }
     print(f"X train mean : {X_train_mean_rgb}")
     print(f"X train std : {X_train_std_rgb}")
-    with open(f"resources/{prefix}_{label_type}_train_stats_128.json", "w") as outfile:
+    with open(f"resources/{prefix}_{label_type}_train_stats_{size}.json", "w") as outfile:
         json.dump(train_stats, outfile, indent=4)
 
 
@@ -115,7 +131,7 @@ def main():
     if len(sys.argv) == 2:
         quit_lst = ['q', 'quit']
         plant_data = PlantDataset(sys.argv[1], verbose=True)
-        plant_df = plant_data.load_data()
+        plant_df = plant_data.scan()
         print(
             f"\n\n{bcolors.OKGREEN}==================  POP FARM : Plant Phenotyping  =================={bcolors.ENDC}")
         print(f"{bcolors.FAIL}{strawb}{bcolors.ENDC}\n\n")
@@ -125,23 +141,44 @@ def main():
         label_type = input(
             f'Enter the label type: plant, disease, healthy, gen_disease\n').lower()
         assert label_type in ['plant', 'disease', 'healthy', 'gen_disease']
-        images, labels = plant_data.get_relevant_images_labels(label_type)
-        raw_images = resize_images(images, (128, 128))
-        X_splits, y_splits = get_split_sets(42, label_type, raw_images, labels)
+        dataset_name = f"resources/datasets/augm_lab_{label_type}_ds.h5"
+        # Stream the images to disk block by block, then split on the row indices
+        build_hdf5_dataset(plant_data, dataset_name, IMG_SIZES)
+        labels = load_hdf5(dataset_name, label_type, label_only=True)
+        # Near-duplicates on both sides of the split inflate the test metrics
+        groups = load_duplicate_groups(dataset_name)
+        n_duplicates = len(groups) - len(np.unique(groups))
+        dup_option = '0'
+        if n_duplicates:
+            dup_option = input(
+                f"""{n_duplicates} near-duplicate images found:\n{bcolors.OKBLUE}[0]{bcolors.ENDC} -- Keep them\n{bcolors.OKBLUE}[1]{bcolors.ENDC} -- Drop them\n{bcolors.OKBLUE}[2]{bcolors.ENDC} -- Keep each group of duplicates in a single split\n""")
+        rows = np.arange(len(labels))
+        if dup_option in ['1', '2']:
+            # split on the representative of each group
+            rows = np.unique(groups)
+        idx_splits = get_split_sets(42, label_type, labels[rows], rows)
+        if dup_option == '2':
+            idx_splits = [expand_groups(idx, groups) for idx in idx_splits]
+        store_split_indices(dataset_name, idx_splits, label_type, seed=42)
+        # Get stats from training set for data preprocessing, for each resolution
+        # (streamed from the dataset and cached in it for the training framework)
+        for img_size in IMG_SIZES:
+            train_stats = split_stats(dataset_name, 'train', img_size)
+            dump_training_stats(train_stats, label_type, prefix='augm_lab', size=img_size[0])
+        # CREATE TRANSFORMER DATASET (shared uint8 images at the 224 input resolution)
+        create_transformer_ds(label_type, dataset_name)
+        # The split sets are read lazily, only the samples and the shards are loaded
+        dataset_file = h5py.File(dataset_name, "r")
+        X_splits, y_splits = open_split_sets(dataset_file)
         X_train, X_valid, X_test = X_splits
         y_train, y_valid, y_test = y_splits
         img_dict = get_sample_dict(X_test, y_test, 5,)
         viz_dataset_wandb(img_dict, 'test_ds')
-        # Get stats from training set for data preprocessing
-        dump_training_stats(X_train, label_type, prefix='augm_lab')
-        store_hdf5(f"resources/datasets/augm_lab_{label_type}_{plant_data.img_nbr}_ds_128.h5", X_train, X_valid, X_test, y_train, y_valid, y_test)
-        # CREATE TRANSFORMER DATASET
-        create_transformer_ds(label_type, X_train, X_valid, X_test, y_train, y_valid, y_test)
         try:
             while not False:
 
                 options = input(
-                    f"""{bcolors.OKBLUE}[0]{bcolors.ENDC} -- Visualization of your farm\n{bcolors.OKBLUE}[1]{bcolors.ENDC} -- Generate Segmented Leaves HSV Mask\n{bcolors.OKBLUE}[2]{bcolors.ENDC} -- Generate Segmented Leaves HSV Mask + dist transform\n{bcolors.OKBLUE}[q]{bcolors.ENDC} -- Quit\n""")
+                    f"""{bcolors.OKBLUE}[0]{bcolors.ENDC} -- Visualization of your farm\n{bcolors.OKBLUE}[1]{bcolors.ENDC} -- Generate Segmented Leaves HSV Mask\n{bcolors.OKBLUE}[2]{bcolors.ENDC} -- Generate Segmented Leaves HSV Mask + dist transform\n{bcolors.OKBLUE}[3]{bcolors.ENDC} -- Export dataset shards (TFRecord / npy)\n{bcolors.OKBLUE}[q]{bcolors.ENDC} -- Quit\n""")
 
                 if options.lower() in quit_lst:
                     print("Bye !")
@@ -153,14 +190,21 @@ def main():
                     plant_data.plant_overview(plant_df)
                     print('Done')
 
+                if options == '3':
+                    fmt = input('Enter the shard format: tfrecord, npy\n').lower()
+                    if fmt in ['tfrecord', 'npy']:
+                        shard_dir = f"resources/datasets/shards/{os.path.splitext(os.path.basename(dataset_name))[0]}_{fmt}"
+                        export_shards(shard_dir, {'train': (X_train, y_train), 'valid': (
+                            X_valid, y_valid), 'test': (X_test, y_test)}, fmt=fmt)
+                    else:
+                        print('Invalid option')
+                    continue
+
                 if options == '1':
                     print('Leag Segmentation HSV mask')
                     p_option = input(
                         f"""Chose Image adjustments (brightness, contrast):\n{bcolors.OKBLUE}[0]{bcolors.ENDC} -- No Adjustments\n{bcolors.OKBLUE}[1]{bcolors.ENDC} -- Adjust Contrast\n{bcolors.OKBLUE}[2]{bcolors.ENDC} -- Adjust Lightness and Contrast\n""")
                     if p_option in ['0', '1', '2']:
-                        X_train_seg = segment_split_set(X_train, p_option)
-                        X_val_seg = segment_split_set(X_valid, p_option)
-                        X_test_seg = segment_split_set(X_test, p_option)
                         seg_dict = dict()
                         for k, v in img_dict.items():
                             seg_dict[k] = segment_split_set(v, p_option)
@@ -180,12 +224,6 @@ def main():
                     p_option = input(
                         f"""Chose Image adjustments (brightness, contrast):\n{bcolors.OKBLUE}[0]{bcolors.ENDC} -- No Adjustments\n{bcolors.OKBLUE}[1]{bcolors.ENDC} -- Adjust Contrast\n{bcolors.OKBLUE}[2]{bcolors.ENDC} -- Adjust Lightness and Contrast\n""")
                     if p_option in ['0', '1', '2']:
-                        X_train_seg = segment_split_set(
-                            X_train, p_option, dist=True)
-                        X_val_seg = segment_split_set(
-                            X_valid, p_option, dist=True)
-                        X_test_seg = segment_split_set(
-                            X_test, p_option, dist=True)
                         seg_dict = dict()
                         for k, v in img_dict.items():
                             seg_dict[k] = segment_split_set(v, p_option)
@@ -200,11 +238,15 @@ def main():
                         continue
 
                 if options in ['1', '2']:
-                    dataset_name = f"resources/datasets/segm_{label_type}_{plant_data.img_nbr}_ds_128.h5"
+                    segm_name = f"resources/datasets/segm_{label_type}_{plant_data.img_nbr}_ds_128.h5"
+                    # Stream the split sets to disk block by block (masks are cached next to
+                    # the dataset), an interrupted run resumes where it stopped
+                    segment_dataset(dataset_name, segm_name, p_option, dist=options == '2')
                     # Get stats from training set for data preprocessing
-                    dump_training_stats(X_train_seg, label_type, prefix='segm_')
+                    with h5py.File(segm_name, "r") as segm_file:
+                        stats, _ = channel_stats(segm_file["train_images"])
+                    dump_training_stats({'mean': stats.mean, 'std': stats.std}, label_type, prefix='segm_')
                     viz_dataset_wandb(seg_dict, name)
-                    store_hdf5(dataset_name,  X_train_seg, X_val_seg, X_test_seg, y_train, y_valid, y_test)
 
         except EOFError:  # for ctrl + c
           print("\nBye !")
@@ -212,11 +254,14 @@ def main():
         except KeyboardInterrupt:  # for ctrl + d
           print("\nSee you soon !")
 
+        finally:
+            dataset_file.close()
+
     else:
         print(
             f"{bcolors.FAIL}Input the directory of your images to run the program{bcolors.ENDC}")
         print(
-            f"{bcolors.WARNING}usage:\t{bcolors.ENDC}python cli.py <images_directory>")
+            f"{bcolors.WARNING}usage:\t{bcolors.ENDC}python -m cli.cli <images_directory>")
         return
 
 
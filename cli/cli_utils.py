@@ -1,3 +1,5 @@
+import sys
+import time
 import matplotlib.pyplot as plt
 
 
@@ -30,6 +32,56 @@ strawb = """
        `~----~'"""
 
 
+class ThroughputMeter():
+    """
+    Reports the progress and the throughput of a long running job on a
+    single, refreshed terminal line.
+
+    Attributes:
+        total (int): number of items to process
+        desc (str): description displayed in front of the progress
+        unit (str): name of the processed items
+        interval (float): minimum number of seconds between two refreshes
+    """
+
+    def __init__(self, total, desc='', unit='img', interval=0.5):
+        self.total = total
+        self.desc = desc
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self._last = self.start
+
+
+    def update(self, n=1):
+        """ Adds n processed items and refreshes the display if needed. """
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._display(now)
+
+
+    def close(self):
+        """ Displays the final throughput and returns the elapsed time. """
+        elapsed = time.perf_counter() - self.start
+        self._display(time.perf_counter())
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+        return elapsed
+
+
+    def _display(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.done / elapsed
+        pct = 100. * self.done / self.total if self.total else 100.
+        sys.stdout.write(
+            f"\r{self.desc} {self.done}/{self.total} {self.unit} ({pct:5.1f}%)"
+            f" -- {rate:.1f} {self.unit}/s -- {elapsed:.1f}s")
+        sys.stdout.flush()
+
+
 
 def plot_multiple_img(imgs, gray=False, titles=''):
     """
@@ -3,6 +3,7 @@ import cv2
 import glob
 import h5py
 import json
+import time
 import random
 import datasets
 import multiprocessing
@@ -10,12 +11,39 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.subplots as sp
-from transformers import ViTFeatureExtractor, ConvNextFeatureExtractor, AutoFeatureExtractor, DefaultDataCollator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cli.cli_utils import ThroughputMeter
+from cli.near_duplicates import dhash_batch
 
-RANDOM_SEED = 42
 
+def hdf5_layout(shape, layout='contiguous', chunk_rows=64, compression=None, shuffle=False):
+    """
+    Returns the h5py.create_dataset options of an image dataset layout.
 
-def store_hdf5(name, train_x, valid_x, test_x, train_y, valid_y, test_y):
+    Args:
+        shape(tuple):           shape of the dataset, (N, H, W, 3)
+        layout(str):            'contiguous', 'image' (one chunk per image)
+                                or 'batch' (one chunk per chunk_rows images)
+        chunk_rows(int):        number of images per chunk for 'batch'
+        compression(str):       None, 'gzip' or 'lzf'
+        shuffle(bool):          option to apply the byte shuffle filter
+    Returns:
+        options(dict):          keyword arguments of create_dataset
+    """
+    if layout not in ['contiguous', 'image', 'batch']:
+        raise ValueError(f"Layout {layout} not found")
+    if layout == 'contiguous':
+        if compression or shuffle:
+            raise ValueError("Filters require a chunked layout")
+        return dict()
+
+    rows = 1 if layout == 'image' else chunk_rows
+    rows = max(1, min(rows, shape[0]))
+    return {'chunks': (rows, *shape[1:]), 'compression': compression,
+            'shuffle': shuffle}
+
+
+def store_hdf5(name, train_x, valid_x, test_x, train_y, valid_y, test_y, layout='contiguous', chunk_rows=64, compression=None, shuffle=False):
     """
     Stores an array of images to HDF5.
 
@@ -27,6 +55,10 @@ def store_hdf5(name, train_x, valid_x, test_x, train_y, valid_y, test_y):
         train_y(numpy.array): 	training labels array
         valid_y(numpy.array): 	validation labels array
         test_y(numpy.array): 	testing labels array
+        layout(str):            'contiguous', 'image' or 'batch' chunking
+        chunk_rows(int):        number of images per chunk for 'batch'
+        compression(str):       None, 'gzip' or 'lzf'
+        shuffle(bool):          option to apply the byte shuffle filter
     Returns:
         file(h5py.File): file containing
     """
@@ -36,24 +68,79 @@ def store_hdf5(name, train_x, valid_x, test_x, train_y, valid_y, test_y):
     print(f"Train Images:     {np.shape(train_x)}  -- dtype: {train_x.dtype}")
     print(f"Train Labels:    {np.shape(train_y)} -- dtype: {train_y.dtype}")
 
-    # Images are store as uint8 -> 0-255
-    file.create_dataset("train_images", np.shape(train_x),
-                        h5py.h5t.STD_U8BE, data=train_x)
-    file.create_dataset("valid_images", np.shape(valid_x),
-                        h5py.h5t.STD_U8BE, data=valid_x)
-    file.create_dataset("test_images", np.shape(test_x),
-                        h5py.h5t.STD_U8BE, data=test_x)
-
-    file.create_dataset("train_labels", np.shape(train_y),
-                        h5py.h5t.STD_U8BE, data=train_y)
-    file.create_dataset("valid_labels", np.shape(valid_y),
-                        h5py.h5t.STD_U8BE, data=valid_y)
-    file.create_dataset("test_labels", np.shape(test_y),
-                        h5py.h5t.STD_U8BE, data=test_y)
+    # Images are store as native uint8 -> 0-255
+    for split_set, images in zip(['train', 'valid', 'test'], [train_x, valid_x, test_x]):
+        file.create_dataset(f"{split_set}_images", data=images, dtype=np.uint8,
+                            **hdf5_layout(np.shape(images), layout, chunk_rows,
+                                          compression, shuffle))
+
+    file.create_dataset("train_labels", data=train_y, dtype=np.uint8)
+    file.create_dataset("valid_labels", data=valid_y, dtype=np.uint8)
+    file.create_dataset("test_labels", data=test_y, dtype=np.uint8)
     file.close()
     return file
 
 
+def _write_tfrecord_shard(path, images, labels):
+    # tensorflow is only needed to export TFRecord shards
+    import tensorflow as tf
+    with tf.io.TFRecordWriter(path) as writer:
+        for image, label in zip(images, labels):
+            features = tf.train.Features(feature={
+                'image': tf.train.Feature(
+                    bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+                'label': tf.train.Feature(
+                    int64_list=tf.train.Int64List(value=[int(label)])),
+            })
+            writer.write(tf.train.Example(
+                features=features).SerializeToString())
+
+
+def export_shards(out_dir, splits, shard_size=2048, fmt='tfrecord'):
+    """
+    Exports split sets to fixed-size shards, with an index.json file
+    describing them, so that they can be read in parallel by several hosts.
+
+    Args:
+        out_dir(str):           directory of the shards
+        splits(dict):           split name -> (images, labels), the images
+                                can be any sliceable array (h5py.Dataset...)
+        shard_size(int):        number of images per shard
+        fmt(str):               'tfrecord' or 'npy'
+    Returns:
+        index(dict):            content of the index file
+    """
+    if fmt not in ['tfrecord', 'npy']:
+        raise ValueError(f"Shard format {fmt} not found")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    index = {'format': fmt, 'splits': dict()}
+    for split_set, (images, labels) in splits.items():
+        n_shards = int(np.ceil(len(images) / shard_size))
+        shards = []
+        for i, start in enumerate(range(0, len(images), shard_size)):
+            shard_x = np.asarray(images[start:start + shard_size], dtype=np.uint8)
+            shard_y = np.asarray(labels[start:start + shard_size], dtype=np.uint8)
+            prefix = f"{split_set}-{i:05d}-of-{n_shards:05d}"
+            if fmt == 'tfrecord':
+                _write_tfrecord_shard(
+                    os.path.join(out_dir, f"{prefix}.tfrecord"), shard_x, shard_y)
+                shards.append({'images': f"{prefix}.tfrecord", 'n': len(shard_x)})
+            else:
+                np.save(os.path.join(out_dir, f"{prefix}.images.npy"), shard_x)
+                np.save(os.path.join(out_dir, f"{prefix}.labels.npy"), shard_y)
+                shards.append({'images': f"{prefix}.images.npy",
+                               'labels': f"{prefix}.labels.npy", 'n': len(shard_x)})
+        index['img_shape'] = list(np.shape(images)[1:])
+        index['splits'][split_set] = shards
+        print(f"{split_set}: {len(images)} images in {n_shards} shards")
+
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=4)
+    return index
+
+
 def load_hdf5(name, class_label, label_only=False):
     """
     Reads image from HDF5.
@@ -66,25 +153,159 @@ def load_hdf5(name, class_label, label_only=False):
         labels(numpy.array):    labels array, (N,) to be stored
     """
     images, labels = [], []
-    # Open the HDF5 file
-    file = h5py.File(f"{name}", "r+")
-    # images are stored as uint8 -> 0-255
-    images = np.array(file["/images"]).astype(np.uint8)
-
-    if class_label == 'healthy':
-        labels = np.array(file["/healthy"]).astype(np.uint8)
-    elif class_label == 'plant':
-        labels = np.array(file["/plant"]).astype(np.uint8)
-    elif class_label == 'disease':
-        labels = np.array(file["/disease"]).astype(np.uint8)
-    elif class_label == 'gen_disease':
-        labels = np.array(file["/gen_disease"]).astype(np.uint8)
+    # Open the HDF5 file read-only, images are stored as uint8 -> 0-255
+    with h5py.File(f"{name}", "r") as file:
+        if not label_only:
+            images = file["/images"][()]
+        if class_label in ['healthy', 'plant', 'disease', 'gen_disease']:
+            labels = file[f"/{class_label}"][()]
     if label_only:
         return labels
     else:
         return images, labels
 
 
+RANDOM_SEED = 42
+# reduced resolution decoding flags, largest reduction first
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def reduced_flag(src_shape, dst_shape):
+    """
+    Returns the imread flag decoding at the smallest resolution (JPEG DCT
+    scaling by 1/2, 1/4 or 1/8) still covering the destination shape.
+    """
+    for factor, flag in REDUCED_FLAGS:
+        if src_shape[0] // factor >= dst_shape[0] and src_shape[1] // factor >= dst_shape[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def read_image(path, out, src_shape=None):
+    """
+    Decodes an image file as RGB straight into a preallocated array, at the
+    resolution of the array. Several arrays can be given to get several
+    resolutions from a single decode.
+
+    Args:
+        path(str):              path to the image file
+        out(numpy.array):       (H, W, 3) uint8 array receiving the image, or
+                                a list of them
+        src_shape(tuple):       expected (H, W) of the file, to decode it at a
+                                reduced resolution before a single area resize
+    Returns:
+        out(numpy.array):       the decoded image(s)
+    """
+    outs = out if isinstance(out, (list, tuple)) else [out]
+    largest = max(outs, key=lambda arr: arr.shape[0] * arr.shape[1])
+    flag = cv2.IMREAD_COLOR
+    if src_shape is not None:
+        flag = reduced_flag(src_shape, largest.shape)
+    image = cv2.imread(path, flag)
+    if flag != cv2.IMREAD_COLOR and (image is None or image.shape[0] < largest.shape[0]
+                                     or image.shape[1] < largest.shape[1]):
+        # smaller file than expected, decode it at full resolution
+        image = cv2.imread(path)
+    if image is None:
+        raise IOError(f"Could not decode image: {path}")
+    for arr in outs:
+        resized = image
+        if image.shape[:2] != arr.shape[:2]:
+            resized = cv2.resize(image, (arr.shape[1], arr.shape[0]),
+                                 interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=arr)
+    return out
+
+
+def _decode_chunk(paths, out, start, src_shape):
+    for i, path in enumerate(paths):
+        if isinstance(out, (list, tuple)):
+            read_image(path, [arr[start + i] for arr in out], src_shape)
+        else:
+            read_image(path, out[start + i], src_shape)
+    return len(paths)
+
+
+def decode_images(paths, out, n_workers=None, chunk_size=64, desc='Decoding', meter=None, src_shape=None):
+    """
+    Decodes image files with a pool of worker threads (OpenCV releases the
+    GIL while decoding) into a preallocated array, reporting the throughput.
+
+    Args:
+        paths(list):            paths of the image files
+        out(numpy.array):       (N, H, W, 3) uint8 array receiving the images,
+                                or a list of them, one per resolution
+        n_workers(int):         number of threads (defaults to the cpu count)
+        chunk_size(int):        number of files decoded per task
+        desc(str):              description of the progress report
+        meter(ThroughputMeter): shared progress report, left open when given
+        src_shape(tuple):       expected (H, W) of the files, see read_image
+    Returns:
+        out(numpy.array):       the decoded images
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    own_meter = meter is None
+    if own_meter:
+        meter = ThroughputMeter(len(paths), desc=desc)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_decode_chunk, paths[i:i+chunk_size], out, i, src_shape)
+                   for i in range(0, len(paths), chunk_size)]
+        for future in as_completed(futures):
+            meter.update(future.result())
+    if own_meter:
+        meter.close()
+    return out
+
+
+def encode_folder_labels(folders):
+    """
+    Encodes the class folder ({plant}___{plant_disease}) of each image into
+    its healthy, plant, disease and general disease labels.
+
+    Args:
+        folders(list):          class folder of each image
+    Returns:
+        labels(dict):           label type -> (N,) labels array
+    """
+    healthy_lst, plant_lst, disease_lst, general_disease_lst = [], [], [], []
+    for folder in folders:
+        split_file = folder.split('___')
+        plant_specie = split_file[0].lower().replace(',', '')
+        disease = split_file[1].lower()
+        healthy_lst.append(int(disease == 'healthy'))
+        plant_lst.append(plant_specie)
+        disease_lst.append(f"{plant_specie}_{disease}")
+        general_disease_lst.append(disease)
+
+    healthy_arr = np.array(healthy_lst).astype(int).astype(bool)
+
+    plants_d = {i: np.unique(plant_lst)[i]
+                for i in range(len(np.unique(plant_lst)))}
+    diseases_d = {i: np.unique(disease_lst)[i]
+                  for i in range(len(np.unique(disease_lst)))}
+    general_diseases_d = {i: np.unique(general_disease_lst)[i]
+                          for i in range(len(np.unique(general_disease_lst)))}
+
+    labels_dict = {"plants": plants_d, "diseases": diseases_d,
+                   "general_diseases": general_diseases_d}
+    #for name, elem in labels_dict.items():
+    #    with open(f'../resources/{name}_label_map.json', 'w') as f:
+    #        json.dump(elem, f, indent=4)
+
+    rev_plants_d = {v: k for k, v in plants_d.items()}
+    rev_disease_d = {v: k for k, v in diseases_d.items()}
+    rev_general_disease_d = {v: k for k, v in general_diseases_d.items()}
+
+    plants_arr = np.array([rev_plants_d[val] for val in plant_lst])
+    disease_arr = np.array([rev_disease_d.get(val) for val in disease_lst])
+    general_disease_arr = np.array(
+        [rev_general_disease_d.get(val) for val in general_disease_lst])
+
+    return {'healthy': healthy_arr, 'plant': plants_arr,
+            'disease': disease_arr, 'gen_disease': general_disease_arr}
+
+
 class PlantDataset():
     """
     Class to represents our plant dataset with useful metadata and
@@ -107,16 +328,16 @@ class PlantDataset():
         self.verbose = verbose
 
 
-    def load_data(self, seed=42, dtype='float32'):
+    def scan(self, seed=42):
         """
-        Stores an array of images to HDF5.
+        Walks the basefolder and collects the image paths with their labels,
+        without decoding any image.
 
         Returns:
             plant_df (pandas.DataFrame): recapitulatory dataframe of our dataset
         """
         df_lst = []
-        images_lst, healthy_lst, plant_lst, disease_lst = [], [], [], []
-        general_disease_lst = []
+        path_lst, folder_lst = [], []
 
         total_pic = 0
         classes_folder = os.listdir(f"{self.basefolder}/")
@@ -153,29 +374,13 @@ class PlantDataset():
 
                 img_folder_name = f"{self.basefolder}/{folder}"
                 if self.verbose:
-                    print('Loading '+img_folder_name)
+                    print('Scanning '+img_folder_name)
                 img_list = os.listdir(img_folder_name)
                 img_list = [i for i in img_list if not i.startswith(".DS")]
                 random.shuffle(img_list)
-                p_img_lst = []
-                for img_file in img_list:
-                    absolute_file_name = img_folder_name+'/'+img_file
-                    print(f"filename : {absolute_file_name}")
-                    image = cv2.imread(absolute_file_name)
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) #(image, cv2.COLOR_BGR2LAB)
-                    if (image.shape != self.img_shape):
-                        if (image.shape[-1] != self.img_shape[-1]):
-                            print(
-                                f"Found wrong image shape: {absolute_file_name}.\nShape {image.shape} instead of {self.img_shape}")
-                        if (image.shape[0] > self.img_shape[0]):
-                            image = cv2.resize(image, (256, 256), interpolation=cv2.INTER_AREA)
-
-                    images_lst.append(image)
-                    healthy_lst.append(healthy)
-                    plant_lst.append(plant_specie)
-                    disease_lst.append(plant_state)
-                    general_disease_lst.append(disease)
-                    p_img_lst.append(absolute_file_name)
+                p_img_lst = [img_folder_name+'/'+img_file for img_file in img_list]
+                path_lst.extend(p_img_lst)
+                folder_lst.extend([folder] * len(p_img_lst))
                 state_img['plant'] = plant_specie
                 state_img['labels'] = plant_state
                 state_img['label_count'] = len(p_img_lst)
@@ -193,6 +398,48 @@ class PlantDataset():
                 f"{len(plant_df['plant'].unique())} unique plants :\n{plant_df['plant'].unique()}\n")
             print(
                 f"{len(plant_df['labels'].unique())} unique classes :\n{plant_df['labels'].unique()}")
+
+        labels = encode_folder_labels(folder_lst)
+
+        self.img_nbr = total_pic
+        self.file_paths = path_lst
+        self.file_folders = folder_lst
+        self.healthy = labels['healthy']
+        self.plants = labels['plant']
+        self.diseases = labels['disease']
+        self.general_diseases = labels['gen_disease']
+        return plant_df
+
+
+    def load_data(self, seed=42, dtype='float32', n_workers=None, target_size=None):
+        """
+        Loads every image of the basefolder into a single uint8 array.
+
+        The images are decoded by a pool of worker threads straight into a
+        preallocated (N, H, W, 3) array, so the dataset is never held twice
+        in memory. Their perceptual hashes are stored in self.phash.
+
+        Args:
+            seed (int):         seed used to shuffle the images of each class
+            n_workers (int):    number of decoding threads (defaults to the cpu count)
+            target_size (tuple): (height, width) to decode the images at, JPEGs
+                                are decoded at a reduced resolution then area
+                                resized once (defaults to the image shape)
+        Returns:
+            plant_df (pandas.DataFrame): recapitulatory dataframe of our dataset
+        """
+        plant_df = self.scan(seed)
+        img_size = tuple(target_size or self.img_shape[:2])
+        images_arr = np.empty(
+            (len(self.file_paths), *img_size, 3), dtype=np.uint8)
+        decode_images(self.file_paths, images_arr, n_workers=n_workers,
+                      src_shape=self.img_shape[:2])
+        # perceptual hashes to detect near-duplicates, computed by batch
+        self.phash = np.concatenate([dhash_batch(images_arr[i:i + 1024])
+                                     for i in range(0, len(images_arr), 1024)] or [np.empty(0, np.uint64)])
+
+        if self.verbose == True and len(images_arr):
+            image = images_arr[-1]
             print(f'Image Type: {type(image)}')
             print(f"Image dtype: {image.dtype}")
             print(f"Image Size: {image.size}")
@@ -202,44 +449,9 @@ class PlantDataset():
             print(f"Max RGB Value: {image.max()}")
             print(f"Min RGB Value: {image.min()}")
             print(
-                f"RGB values for pixel (100th rows, 50th column): {image[100, 50]}\n")
-
-
-        for x in images_lst:
-            if x.dtype != 'uint8':
-                print(f"image is {x.dtype}")
-
-        images_arr = np.array(images_lst)#, dtype=np.uint8)
-        healthy_arr = np.array(healthy_lst).astype(int).astype(bool)
-
-        plants_d = {i: np.unique(plant_lst)[i]
-                    for i in range(len(np.unique(plant_lst)))}
-        diseases_d = {i: np.unique(disease_lst)[i]
-                      for i in range(len(np.unique(disease_lst)))}
-        general_diseases_d = {i: np.unique(general_disease_lst)[i]
-                              for i in range(len(np.unique(general_disease_lst)))}
-
-        labels_dict = {"plants": plants_d, "diseases": diseases_d,
-                       "general_diseases": general_diseases_d}
-        #for name, elem in labels_dict.items():
-        #    with open(f'../resources/{name}_label_map.json', 'w') as f:
-        #        json.dump(elem, f, indent=4)
+                f"RGB values for pixel (100th rows, 50th column): {image[min(100, img_size[0]-1), 50]}\n")
 
-        rev_plants_d = {v: k for k, v in plants_d.items()}
-        rev_disease_d = {v: k for k, v in diseases_d.items()}
-        rev_general_disease_d = {v: k for k, v in general_diseases_d.items()}
-
-        plants_arr = np.array([rev_plants_d[val] for val in plant_lst])
-        disease_arr = np.array([rev_disease_d.get(val) for val in disease_lst])
-        general_disease_arr = np.array(
-            [rev_general_disease_d.get(val) for val in general_disease_lst])
-
-        self.img_nbr = total_pic
         self.images = images_arr
-        self.healthy = healthy_arr
-        self.plants = plants_arr
-        self.diseases = disease_arr
-        self.general_diseases = general_disease_arr
         return plant_df
 
 
@@ -354,52 +566,150 @@ class PlantDataset():
             this_figure.write_image(f"../resources/metadata/ds_{elem}_distrib.jpeg")
 
 
-def resize_images(img_arr, img_size):
-    resized_arr = []
-    for img in img_arr:
-        new_img = cv2.resize(img, dsize=img_size, interpolation=cv2.INTER_AREA)
-        resized_arr.append(new_img)
-    resized_arr = np.array(resized_arr)
-    return resized_arr
+def resize_interpolation(src_shape, dst_shape):
+    """
+    Returns the interpolation of a resize given its direction: area averaging
+    to downscale, bicubic to upscale and bilinear when the axes disagree.
+    """
+    if dst_shape[0] <= src_shape[0] and dst_shape[1] <= src_shape[1]:
+        return cv2.INTER_AREA
+    if dst_shape[0] >= src_shape[0] and dst_shape[1] >= src_shape[1]:
+        return cv2.INTER_CUBIC
+    return cv2.INTER_LINEAR
 
-def process(examples, feature_extractor):
-    """" Maps the feature_extractor to our image array """
-    examples.update(feature_extractor(examples['img'], ))
-    return examples
 
-#def transform(example_batch):
-#    # Take a list of PIL images and turn them to pixel values
-#    inputs = feature_extractor([x for x in example_batch['img']], return_tensors='tf')
-#    # Don't forget to include the labels!
-#    inputs['labels'] = example_batch['labels']
-#    return inputs
+def _resize_chunk(images, out, interpolation):
+    for img, dst in zip(images, out):
+        cv2.resize(img, dsize=(dst.shape[1], dst.shape[0]),
+                   dst=dst, interpolation=interpolation)
+    return len(images)
 
-def create_hf_ds(images, labels, feature_extractor, class_names):
-    """" Creates a dataset with transformer feature exctractor """
 
-    N_CPUS = multiprocessing.cpu_count()
+def resize_images(img_arr, img_size, out=None, n_workers=None, chunk_size=256, interpolation=None, desc='Resizing'):
+    """
+    Resizes a batch of images with a pool of worker threads (OpenCV releases
+    the GIL while resizing) into a preallocated array. The input is read in
+    chunks, so it can be an h5py.Dataset bigger than RAM, and only a bounded
+    number of chunks are in flight.
+
+    Args:
+        img_arr(numpy.array):   (N, H, W, C) images, or an h5py.Dataset
+        img_size(tuple):        (width, height) of the resized images
+        out(numpy.array):       (N, height, width, C) array receiving the
+                                images, or an h5py.Dataset, allocated if None
+        n_workers(int):         number of threads (defaults to the cpu count)
+        chunk_size(int):        number of images resized per task
+        interpolation(int):     OpenCV interpolation, chosen from the resize
+                                direction if None (see resize_interpolation)
+        desc(str):              description of the progress report
+    Returns:
+        out(numpy.array):       the resized images
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    width, height = img_size
+    if out is None:
+        out = np.empty((len(img_arr), height, width, *img_arr.shape[3:]),
+                       dtype=img_arr.dtype)
+    if interpolation is None:
+        interpolation = resize_interpolation(img_arr.shape[1:3], (height, width))
+    # h5py outputs are written by this thread, from per-chunk buffers
+    direct = isinstance(out, np.ndarray)
+    meter = ThroughputMeter(len(img_arr), desc=desc)
+
+    def collect(pending):
+        start, dst, future = pending.pop(0)
+        meter.update(future.result())
+        if not direct:
+            out[start:start + len(dst)] = dst
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = []
+        for start in range(0, len(img_arr), chunk_size):
+            images = np.asarray(img_arr[start:start + chunk_size])
+            dst = out[start:start + len(images)] if direct else \
+                np.empty((len(images), *out.shape[1:]), dtype=out.dtype)
+            pending.append((start, dst, executor.submit(
+                _resize_chunk, images, dst, interpolation)))
+            if len(pending) > 2 * n_workers:
+                collect(pending)
+        while pending:
+            collect(pending)
+    meter.close()
+    return out
+
+def _hdf5_examples(row_blocks, name, key, label_key, fingerprint=None):
+    """
+    Yields the examples of blocks of (shuffled) rows of an HDF5 dataset. The
+    fingerprint of the file is only there for the cache of from_generator.
+    """
+    with h5py.File(name, "r") as file:
+        images, labels = file[key], file[label_key]
+        for rows in row_blocks:
+            # h5py reads increasing rows, the shuffled order is restored after
+            order = np.argsort(rows)
+            inverse = np.argsort(order)
+            block_images = images[rows[order]][inverse]
+            block_labels = labels[rows[order]][inverse]
+            for image, label in zip(block_images, block_labels):
+                yield {"img": image, "labels": int(label)}
+
+
+def create_hf_ds(name, split_set, class_names, img_size=(224, 224), num_proc=None, shard_size=1024, seed=42):
+    """"
+    Creates a dataset of the uint8 images of a split set, shared by all the
+    transformer backbones: their resize and normalization are applied at
+    read time (see train_framework.preprocess_tensor.transformer_preprocessing).
+
+    The rows are shuffled then cut in shards generated by num_proc processes,
+    each reading its rows from the HDF5 file and writing Arrow batches of
+    about 64MB as it goes, so the split is never held in memory.
+
+    Args:
+        name(str):              path to the HDF5 file written by build_hdf5_dataset
+        split_set(str):         'train', 'valid' or 'test'
+        class_names(list):      names of the classes
+        img_size(tuple):        (height, width) of the images to use
+        num_proc(int):          number of processes (defaults to the cpu count)
+        shard_size(int):        number of rows per shard
+        seed(int):              seed of the shuffling
+    Returns:
+        ds(datasets.Dataset):   dataset with 'img' and 'labels' columns
+    """
+    # dataset_builder imports this module
+    from cli.dataset_builder import images_key
+
+    num_proc = num_proc or multiprocessing.cpu_count()
+    with h5py.File(name, "r") as file:
+        key = images_key(file, img_size)
+        label_key = file.attrs['split_label']
+        rows = file[f"{split_set}_idx"][()]
+        img_shape = file[key].shape[1:]
+    rows = np.random.default_rng(seed).permutation(rows)
+    row_blocks = [rows[i:i + shard_size] for i in range(0, len(rows), shard_size)]
+    # from_generator caches on its arguments: a rebuilt file must not reuse the cache
+    stat = os.stat(name)
+    fingerprint = (stat.st_size, stat.st_mtime_ns)
+
     features = datasets.Features({
-        "img": datasets.Image(),
+        "img": datasets.Array3D(shape=img_shape, dtype='uint8'),
         # ClassLabel feature type is for single-label multi-class classification
         # For multi-label classification (after one hot encoding) you can use Sequence with ClassLabel
-        "label": datasets.features.ClassLabel(names=class_names)
+        "labels": datasets.features.ClassLabel(names=class_names)
     })
-
-    print(features)
-    ds = datasets.Dataset.from_dict(
-        {"img": images, "label": labels}, features=features)
-    ds = ds.rename_column("label", "labels")
-
-    ds = ds.map(lambda x: process(x, feature_extractor), num_parallel_calls=N_CPUS, batched=True)
-    #ds = ds.with_transform(transform)
-
-    ds = ds.shuffle(seed=42)
+    writer_batch_size = max(1, (64 << 20) // int(np.prod(img_shape)))
+    ds = datasets.Dataset.from_generator(
+        _hdf5_examples, features=features, writer_batch_size=writer_batch_size,
+        num_proc=min(num_proc, len(row_blocks)) or None,
+        gen_kwargs={'row_blocks': row_blocks, 'name': name,
+                    'key': key, 'label_key': label_key, 'fingerprint': fingerprint})
     return ds
 
-def create_transformer_ds(label_type, X_train, X_valid, X_test, y_train, y_valid, y_test):
+
+def create_transformer_ds(label_type, name, out_dir="../resources/datasets/transformers/uint8", num_proc=None):
     """
-    Creates a training, validation and test set dataset (given the label type) with the appropriate feature
-    extractor applied for each of the ViT, Swin and ConvNexT models.
+    Creates a training, validation and test set dataset (given the label type) of uint8 images, shared
+    by the ViT, Swin, ConvNexT and CvT models, from the 224 resolution of an HDF5 dataset. The time spent
+    generating and saving each split set is reported.
     """
     if label_type !=  'healthy':
         if label_type == 'disease':
@@ -414,23 +724,13 @@ def create_transformer_ds(label_type, X_train, X_valid, X_test, y_train, y_valid
     else:
         class_names = ['healthy', 'not_healthy']
 
-    fe_dict = {
-        'vit': ViTFeatureExtractor.from_pretrained("google/vit-base-patch16-224"),
-        'swin': AutoFeatureExtractor.from_pretrained("microsoft/swin-tiny-patch4-window7-224"),
-        'convnext': ConvNextFeatureExtractor.from_pretrained("facebook/convnext-tiny-224")
-    }
-    for name, feature_extractor in fe_dict.items():
-        train_sets = create_hf_ds(
-            X_train, y_train, feature_extractor, class_names)
-        train_sets.save_to_disk(
-            f"../resources/datasets/transformers/{name}/train")
-
-        valid_sets = create_hf_ds(
-            X_valid, y_valid, feature_extractor, class_names)
-        valid_sets.save_to_disk(
-            f"../resources/datasets/transformers/{name}/valid")
-
-        test_sets = create_hf_ds(
-            X_test, y_test, feature_extractor, class_names)
-        test_sets.save_to_disk(
-            f"../resources/datasets/transformers/{name}/test")
+    num_proc = num_proc or multiprocessing.cpu_count()
+    for split_set in ['train', 'valid', 'test']:
+        start = time.perf_counter()
+        split_ds = create_hf_ds(name, split_set, class_names, num_proc=num_proc)
+        generated = time.perf_counter()
+        split_ds.save_to_disk(f"{out_dir}/{split_set}",
+                              num_proc=min(num_proc, split_ds.num_rows))
+        saved = time.perf_counter()
+        print(f"{split_set}: {split_ds.num_rows} images -- generate {generated - start:.1f}s, "
+              f"save {saved - generated:.1f}s ({split_ds.num_rows / (saved - start):.1f} img/s)")
@@ -0,0 +1,562 @@
+import os
+import json
+import h5py
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from cli.cli_utils import ThroughputMeter
+from cli.dataloader import decode_images, encode_folder_labels, hdf5_layout
+from cli.near_duplicates import dhash_batch, duplicate_groups
+
+SPLIT_SETS = ['train', 'valid', 'test']
+
+
+def size_group(img_size):
+    """ Returns the name of the HDF5 group holding the images of a resolution. """
+    return f"size_{img_size[0]}x{img_size[1]}"
+
+
+def images_key(file, img_size=None):
+    """
+    Returns the key of the images dataset of an HDF5 file at a resolution,
+    the first stored resolution by default. A file with a single 'images'
+    dataset only matches the resolution of its images.
+
+    Args:
+        file(h5py.File):        HDF5 file written by build_hdf5_dataset
+        img_size(tuple):        (height, width) of the images
+    Returns:
+        key(str):               key of the images dataset
+    """
+    if img_size is None:
+        if "images" in file:
+            return "images"
+        img_size = file.attrs['img_sizes'][0]
+    key = f"{size_group(img_size)}/images"
+    if key not in file and "images" in file:
+        if tuple(file["images"].shape[1:3]) == tuple(img_size):
+            return "images"
+    if key not in file:
+        raise KeyError(f"No {img_size[0]}x{img_size[1]} images in {file.filename}")
+    return key
+
+
+class HDF5ImageWriter():
+    """
+    Appends images to resizable HDF5 datasets in fixed-size blocks, so that
+    a dataset bigger than RAM can be written with a flat memory footprint.
+    Each resolution is stored in its own 'size_{h}x{w}/images' dataset, the
+    rows of all the resolutions matching.
+
+    Attributes:
+        name (str): path to the HDF5 file
+        img_sizes (list): (height, width) of each stored resolution
+        mode (str): h5py file mode, 'w' to create, 'a' to append
+        layout (dict): chunking and filter options, see hdf5_layout()
+    """
+
+    def __init__(self, name, img_sizes, mode='w', layout=None):
+        self.name = name
+        self.img_sizes = [tuple(img_size) for img_size in img_sizes]
+        self.file = h5py.File(name, mode)
+        layout = layout or {'layout': 'image'}
+        self.images = []
+        for h, w in self.img_sizes:
+            key = f"{size_group((h, w))}/images"
+            if key not in self.file:
+                # a resizable dataset has to be chunked
+                options = hdf5_layout((np.inf, h, w, 3), **layout)
+                self.file.create_dataset(
+                    key, (0, h, w, 3), maxshape=(None, h, w, 3),
+                    dtype=np.uint8, **options)
+            self.images.append(self.file[key])
+        self.file.attrs['img_sizes'] = np.array(self.img_sizes, dtype=np.int64)
+
+
+    def __len__(self):
+        return self.images[0].shape[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def append(self, blocks):
+        """
+        Appends a block of images at the end of the datasets.
+
+        Args:
+            blocks(list):           (N, H, W, 3) uint8 images to append, one
+                                    array per resolution
+        Returns:
+            start(int):             row of the first appended image
+        """
+        start = len(self)
+        for dataset, images in zip(self.images, blocks):
+            dataset.resize(start + len(images), axis=0)
+            dataset[start:] = images
+        return start
+
+
+    def truncate(self, n_rows):
+        """ Drops the rows of the datasets past n_rows. """
+        for dataset in self.images:
+            if n_rows < dataset.shape[0]:
+                dataset.resize(n_rows, axis=0)
+
+
+    def write_rows(self, rows, blocks):
+        """ Overwrites the given rows of the datasets with a block of images. """
+        for dataset, images in zip(self.images, blocks):
+            for row, image in zip(rows, images):
+                dataset[row] = image
+
+
+    def remove_rows(self, rows):
+        """
+        Removes rows by moving the last live rows into the holes they leave,
+        then shrinking the dataset.
+
+        Args:
+            rows(list):             rows to remove
+        Returns:
+            moved(dict):            former row -> new row of the moved images
+        """
+        rows = set(rows)
+        n_rows = len(self) - len(rows)
+        holes = iter(sorted(row for row in rows if row < n_rows))
+        moved = dict()
+        for row in range(n_rows, len(self)):
+            if row not in rows:
+                hole = next(holes)
+                for dataset in self.images:
+                    dataset[hole] = dataset[row]
+                moved[row] = hole
+        self.truncate(n_rows)
+        return moved
+
+
+    def write_column(self, key, values, dtype):
+        """ (Re)writes a dataset holding one value per row. """
+        if key in self.file:
+            del self.file[key]
+        self.file.create_dataset(key, data=np.asarray(values).astype(dtype))
+
+
+    def write_labels(self, labels_dict):
+        """
+        (Re)writes the label datasets, one per classification type.
+
+        Args:
+            labels_dict(dict):      label type -> (N,) labels array
+        """
+        for label_type, labels in labels_dict.items():
+            self.write_column(label_type, labels, np.uint8)
+
+
+    def close(self):
+        self.file.close()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ Returns the SHA-1 hex digest of the content of a file. """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Manifest():
+    """
+    Record of the image files stored in an HDF5 dataset, saved next to it as
+    {dataset}.manifest.json. Each entry holds the size, mtime, content hash
+    and label (class folder) of a file, with the row of the images datasets
+    holding it. The rows of the entries always are 0 to N-1.
+
+    Attributes:
+        name (str): path to the HDF5 file
+        img_sizes (list): (height, width) of each stored resolution
+        entries (dict): file path -> entry
+    """
+
+    def __init__(self, name, img_sizes, entries=None):
+        self.name = name
+        self.path = f"{os.path.splitext(name)[0]}.manifest.json"
+        self.img_sizes = [list(img_size) for img_size in img_sizes]
+        self.entries = entries if entries is not None else dict()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @classmethod
+    def load(cls, name, img_sizes):
+        """
+        Loads the manifest of an HDF5 dataset. Returns None when the dataset
+        or its manifest is missing, or was built for other image sizes.
+        """
+        manifest = cls(name, img_sizes)
+        if not (os.path.isfile(name) and os.path.isfile(manifest.path)):
+            return None
+        with open(manifest.path) as f:
+            content = json.load(f)
+        if content.get('img_sizes') != manifest.img_sizes:
+            return None
+        manifest.entries = content['entries']
+        return manifest
+
+
+    def save(self):
+        """ Atomically writes the manifest to disk. """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'img_sizes': self.img_sizes,
+                       'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+    def add(self, path, stat, digest, label, row, phash):
+        size, mtime = stat
+        self.entries[path] = {'size': size, 'mtime': mtime, 'sha1': digest,
+                              'label': label, 'row': row, 'phash': phash}
+
+
+    def diff(self, stats, n_workers=None):
+        """
+        Compares the manifest with the files currently on disk. Files whose
+        size or mtime changed are hashed to tell real changes apart. The
+        entries of the changed files are left as they are until their images
+        are rewritten, so that an interrupted build hashes them again.
+
+        Args:
+            stats(dict):            file path -> (size, mtime_ns)
+            n_workers(int):         number of hashing threads
+        Returns:
+            added(list):            paths missing from the manifest
+            changed(dict):          path -> (new digest, (size, mtime_ns)) of
+                                    the modified files
+            deleted(list):          paths of the manifest missing on disk
+        """
+        added, suspects = [], []
+        for path, stat in stats.items():
+            entry = self.entries.get(path)
+            if entry is None:
+                added.append(path)
+            elif (entry['size'], entry['mtime']) != tuple(stat):
+                suspects.append(path)
+        deleted = [path for path in self.entries if path not in stats]
+
+        changed = dict()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            digests = executor.map(file_digest, suspects)
+            for path, digest in zip(suspects, digests):
+                entry = self.entries[path]
+                if digest != entry['sha1']:
+                    changed[path] = (digest, stats[path])
+                else:
+                    # touched but identical
+                    entry['size'], entry['mtime'] = stats[path]
+        return added, changed, deleted
+
+
+    def column(self, key):
+        """ Returns the value of an entry field for each row. """
+        values = [None] * len(self)
+        for entry in self.entries.values():
+            values[entry['row']] = entry.get(key)
+        return values
+
+
+    def labels(self):
+        """ Returns the label (class folder) of each row. """
+        return self.column('label')
+
+
+def _class_blocks(labels, block_size):
+    """ Yields (start, stop) ranges of at most block_size rows per class. """
+    bounds = [i for i in range(1, len(labels)) if labels[i] != labels[i - 1]]
+    bounds = [0, *bounds, len(labels)]
+    for c_start, c_stop in zip(bounds[:-1], bounds[1:]):
+        for start in range(c_start, c_stop, block_size):
+            yield start, min(start + block_size, c_stop)
+
+
+def build_hdf5_dataset(plant_data, name, img_sizes, block_size=512, n_workers=None, incremental=True, layout=None):
+    """
+    Streams the images of a scanned PlantDataset into an HDF5 file: each
+    class is decoded in blocks which are appended to the file, so that only
+    one block is held in memory at a time. Every image is decoded once and
+    resized to each of the target sizes, stored in one group per size.
+
+    The stored files are tracked in a Manifest saved after every block. A
+    rebuild only decodes the added or modified files and drops the deleted
+    ones, and an interrupted build resumes after its last saved block.
+    The perceptual hash of each image is stored in a 'phash' dataset to
+    detect near-duplicates, and the content hash of its file in a 'digest'
+    dataset, the fingerprint of the rows (see rows_digest) that the stats
+    and segmented images derived from them are checked against. The digests
+    are dropped as soon as rows change, until the build completes.
+
+    Args:
+        plant_data(PlantDataset):   dataset on which scan() has been called
+        name(str):                  path to the HDF5 file to create
+        img_sizes(list):            (height, width) of each stored resolution,
+                                    the first one being the default
+        block_size(int):            number of images decoded per block
+        n_workers(int):             number of decoding threads
+        incremental(bool):          option to reuse a previous build
+        layout(dict):               chunking and filter options of the images
+    Returns:
+        name(str):                  path to the HDF5 file
+    """
+    img_sizes = [tuple(img_size) for img_size in img_sizes]
+    manifest = Manifest.load(name, img_sizes) if incremental else None
+    mode = 'a'
+    if manifest is None:
+        manifest, mode = Manifest(name, img_sizes), 'w'
+
+    folders = dict(zip(plant_data.file_paths, plant_data.file_folders))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        stats = dict(zip(folders, executor.map(_file_stat, folders)))
+    added, changed, deleted = manifest.diff(stats, n_workers)
+    print(f"{len(manifest) - len(changed) - len(deleted)} unchanged, "
+          f"{len(added)} added, {len(changed)} changed, {len(deleted)} deleted images")
+
+    blocks = [np.empty((block_size, *img_size, 3), dtype=np.uint8)
+              for img_size in img_sizes]
+    src_shape = plant_data.img_shape[:2]
+    meter = ThroughputMeter(len(added) + len(changed), desc=f"Writing {name}")
+
+    with HDF5ImageWriter(name, img_sizes, mode, layout) as writer:
+        # rows past the manifest belong to a block interrupted before its save
+        writer.truncate(len(manifest))
+        if (changed or deleted) and 'digest' in writer.file:
+            # the images derived from the rows are stale from here
+            del writer.file['digest']
+        rows = [manifest.entries.pop(path)['row'] for path in deleted]
+        moved = writer.remove_rows(rows)
+        for entry in manifest.entries.values():
+            entry['row'] = moved.get(entry['row'], entry['row'])
+        writer.file.flush()
+        manifest.save()
+
+        changed_paths = list(changed)
+        for start in range(0, len(changed_paths), block_size):
+            paths = changed_paths[start:start + block_size]
+            n = len(paths)
+            images = decode_images(paths, [block[:n] for block in blocks],
+                                   n_workers=n_workers, meter=meter, src_shape=src_shape)
+            writer.write_rows(
+                [manifest.entries[path]['row'] for path in paths], images)
+            writer.file.flush()
+            for path, phash in zip(paths, dhash_batch(images[0])):
+                entry = manifest.entries[path]
+                entry['sha1'], (entry['size'], entry['mtime']) = changed[path]
+                entry['phash'] = int(phash)
+            manifest.save()
+
+        added_folders = [folders[path] for path in added]
+        for start, stop in _class_blocks(added_folders, block_size):
+            paths = added[start:stop]
+            n = stop - start
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                digests = list(executor.map(file_digest, paths))
+            images = decode_images(paths, [block[:n] for block in blocks],
+                                   n_workers=n_workers, meter=meter, src_shape=src_shape)
+            row = writer.append(images)
+            writer.file.flush()
+            hashes = dhash_batch(images[0])
+            for i, path in enumerate(paths):
+                manifest.add(path, stats[path], digests[i], folders[path],
+                             row + i, int(hashes[i]))
+            manifest.save()
+
+        # manifests of former builds have no perceptual hashes
+        hashes = manifest.column('phash')
+        missing = [row for row, phash in enumerate(hashes) if phash is None]
+        for start in range(0, len(missing), block_size):
+            rows = missing[start:start + block_size]
+            for row, phash in zip(rows, dhash_batch(writer.images[0][rows])):
+                hashes[row] = int(phash)
+        if missing:
+            for entry in manifest.entries.values():
+                entry['phash'] = hashes[entry['row']]
+            manifest.save()
+        writer.write_labels(encode_folder_labels(manifest.labels()))
+        writer.write_column('phash', hashes, np.uint64)
+        digests = np.array([int(sha1[:16], 16) for sha1 in manifest.column('sha1')], dtype=np.uint64)
+        writer.write_column('digest', digests, np.uint64)
+    meter.close()
+    return name
+
+
+def store_split_indices(name, idx_splits, label_type, seed=None):
+    """
+    Persists the train, valid and test row indices in the HDF5 file. The rows
+    are stored in a shuffled order (seeded), as the dataset rows are grouped
+    by class and the splits are read in their stored order; the readers that
+    need increasing rows sort them, see read_rows.
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(name, "a") as file:
+        for split_set, idx in zip(SPLIT_SETS, idx_splits):
+            if f"{split_set}_idx" in file:
+                del file[f"{split_set}_idx"]
+            file.create_dataset(
+                f"{split_set}_idx", data=rng.permutation(np.asarray(idx)).astype(np.int64))
+        file.attrs['split_label'] = label_type
+        if seed is not None:
+            file.attrs['split_seed'] = seed
+
+
+def read_rows(dataset, rows):
+    """
+    Reads rows of an h5py.Dataset in any order: h5py only reads increasing
+    rows without duplicates, so the unique rows are read in order and the
+    requested order restored after.
+
+    Args:
+        dataset(h5py.Dataset):      dataset to read, or an array
+        rows(numpy.array):          rows to read
+    Returns:
+        values(numpy.array):        rows of the dataset, in the order of rows
+    """
+    rows = np.asarray(rows)
+    if len(rows) and np.all(np.diff(rows) == 1):
+        return dataset[rows[0]:rows[-1] + 1]
+    if isinstance(dataset, np.ndarray):
+        return dataset[rows]
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    return dataset[unique_rows][inverse]
+
+
+class LazyRows():
+    """
+    Lazy, read-only view on the rows of an image dataset. Rows are only read
+    from disk when the view is indexed.
+
+    Attributes:
+        dataset (h5py.Dataset or numpy.memmap): (N, H, W, 3) images
+        indices (numpy.array): rows of the dataset in the view, all if None
+    """
+
+    def __init__(self, dataset, indices=None):
+        self.dataset = dataset
+        self.indices = indices
+
+
+    def __len__(self):
+        if self.indices is None:
+            return self.dataset.shape[0]
+        return len(self.indices)
+
+
+    @property
+    def shape(self):
+        return (len(self), *self.dataset.shape[1:])
+
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+
+    def __getitem__(self, key):
+        """ Reads the rows selected by an int, a slice or an array of rows. """
+        rows = key if self.indices is None else self.indices[key]
+        if isinstance(rows, (slice, int, np.integer)):
+            return np.asarray(self.dataset[rows])
+        return read_rows(self.dataset, rows)
+
+
+    def __array__(self, dtype=None, copy=None):
+        images = self[:]
+        return images if dtype is None else images.astype(dtype)
+
+
+def open_split_sets(file, img_size=None):
+    """
+    Returns lazy views on the split sets of an open HDF5 file written by
+    build_hdf5_dataset: the images are only read when the views are indexed,
+    and while the file is open.
+
+    Args:
+        file(h5py.File):            HDF5 file written by build_hdf5_dataset
+        img_size(tuple):            (height, width) of the images to read,
+                                    the first stored resolution by default
+    Returns:
+        X_splits(list):             train, valid and test images (LazyRows)
+        y_splits(list):             train, valid and test labels
+    """
+    X_splits, y_splits = [], []
+    labels = file[file.attrs['split_label']]
+    images = file[images_key(file, img_size)]
+    for split_set in SPLIT_SETS:
+        idx = file[f"{split_set}_idx"][()]
+        X_splits.append(LazyRows(images, idx))
+        y_splits.append(read_rows(labels, idx))
+    return X_splits, y_splits
+
+
+def rows_digest(file, rows):
+    """
+    Returns a fingerprint of the content of rows of an HDF5 file written by
+    build_hdf5_dataset, a hash of their 'digest' values: it changes when
+    the images of the rows are rewritten. '' when the file has no digests
+    (former builds, or a build in progress).
+
+    Args:
+        file(h5py.File):            HDF5 file written by build_hdf5_dataset
+        rows(numpy.array):          rows of the images
+    Returns:
+        key(str):                   hex digest of the content of the rows
+    """
+    if 'digest' not in file:
+        return ''
+    digests = np.ascontiguousarray(read_rows(file['digest'], rows), dtype=np.uint64)
+    return hashlib.blake2b(digests, digest_size=8).hexdigest()
+
+
+def load_split_sets(name, img_size=None):
+    """
+    Reads the split sets of an HDF5 file written by build_hdf5_dataset.
+
+    Args:
+        name(str):                  path to the HDF5 file
+        img_size(tuple):            (height, width) of the images to read,
+                                    the first stored resolution by default
+    Returns:
+        X_splits(list):             train, valid and test images
+        y_splits(list):             train, valid and test labels
+    """
+    with h5py.File(name, "r") as file:
+        X_splits, y_splits = open_split_sets(file, img_size)
+        X_splits = [split[:] for split in X_splits]
+    return X_splits, y_splits
+
+
+def load_duplicate_groups(name, max_distance=3):
+    """
+    Groups the near-duplicate images of an HDF5 file written by
+    build_hdf5_dataset from their perceptual hashes.
+
+    Args:
+        name(str):                  path to the HDF5 file
+        max_distance(int):          maximum hamming distance between duplicates
+    Returns:
+        groups(numpy.array):        row of the representative of each image
+    """
+    with h5py.File(name, "r") as file:
+        hashes = file["phash"][()]
+    return duplicate_groups(hashes, max_distance)
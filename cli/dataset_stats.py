@@ -0,0 +1,191 @@
+import hashlib
+import h5py
+import numpy as np
+from cli.dataset_builder import images_key, read_rows, rows_digest
+
+# pixel values and their squares, to get exact sums from uint8 histograms
+PIXEL_VALUES = np.arange(256, dtype=np.float64)
+
+
+def block_moments(images):
+    """
+    Computes the per-channel count, mean and sum of squared deviations (M2)
+    of a block of images. uint8 images go through per-channel histograms, so
+    that the sums and sums of squares are exact integers and no float copy of
+    the block is made.
+
+    Args:
+        images(numpy.array):    (N, H, W, C) images
+    Returns:
+        count(int):             number of pixels per channel
+        mean(numpy.array):      (C,) mean of each channel
+        m2(numpy.array):        (C,) sum of squared deviations of each channel
+    """
+    images = np.asarray(images)
+    pixels = images.reshape(-1, images.shape[-1])
+    count = len(pixels)
+    if images.dtype == np.uint8:
+        hists = np.stack([np.bincount(pixels[:, c], minlength=256)
+                          for c in range(pixels.shape[1])]).astype(np.float64)
+        sums = hists @ PIXEL_VALUES
+        mean = sums / count
+        m2 = hists @ PIXEL_VALUES**2 - sums * mean
+    else:
+        mean = pixels.mean(axis=0, dtype=np.float64)
+        m2 = ((pixels - mean)**2).sum(axis=0)
+    return count, mean, m2
+
+
+class ChannelStats():
+    """
+    Streaming per-channel mean and standard deviation. The moments of each
+    block are merged with the parallel variant of Welford's algorithm, so
+    the statistics of a dataset are computed in one pass over its blocks.
+
+    Attributes:
+        count (int): number of pixels per channel seen so far
+        mean (numpy.array): mean of each channel
+        m2 (numpy.array): sum of squared deviations of each channel
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+
+    def merge(self, count, mean, m2):
+        """ Merges the moments of another set of pixels. """
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+
+
+    def update(self, images):
+        """ Adds a block of (N, H, W, C) images to the statistics. """
+        self.merge(*block_moments(images))
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+def channel_stats(images, rows=None, labels=None, block_size=512):
+    """
+    Computes the per-channel mean and std of images read in blocks, so that
+    only one block is held in memory at a time.
+
+    Args:
+        images(numpy.array):    (N, H, W, C) images, or an h5py.Dataset
+        rows(numpy.array):      rows to use, all if None
+        labels(numpy.array):    label of each used row, for per-class stats
+        block_size(int):        number of images read at once
+    Returns:
+        stats(ChannelStats):    statistics of all the images
+        class_stats(dict):      label -> ChannelStats, empty without labels
+    """
+    rows = np.arange(len(images)) if rows is None else np.asarray(rows)
+    stats, class_stats = ChannelStats(), dict()
+    for start in range(0, len(rows), block_size):
+        block = read_rows(images, rows[start:start + block_size])
+        if labels is None:
+            stats.update(block)
+            continue
+        block_labels = np.asarray(labels[start:start + block_size])
+        for label in np.unique(block_labels):
+            moments = block_moments(block[block_labels == label])
+            class_stats.setdefault(label.item(), ChannelStats()).merge(*moments)
+            stats.merge(*moments)
+    return stats, class_stats
+
+
+def _split_rows(file, split_set, img_size):
+    """ Returns the images dataset, rows and labels of a split set. """
+    if f"{split_set}_idx" in file:
+        rows = file[f"{split_set}_idx"][()]
+        labels = file[file.attrs['split_label']][()][rows]
+        return file[images_key(file, img_size)], rows, labels
+    images = file[f"{split_set}_images"]
+    return images, np.arange(len(images)), file[f"{split_set}_labels"][()]
+
+
+def stats_key(rows, labels, content=''):
+    """
+    Returns the key the cached stats of a split are stored with, a hash of
+    its rows, labels and content fingerprint (see rows_digest: the images
+    rewritten by an incremental build change it), also checked by the
+    training framework.
+    """
+    sha = hashlib.sha1(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+    sha.update(np.ascontiguousarray(labels).tobytes())
+    sha.update(content.encode())
+    return sha.hexdigest()
+
+
+def _cached_stats(images, split_set, key, per_class):
+    attrs = images.attrs
+    if attrs.get(f"{split_set}_stats_key") != key:
+        return None
+    if per_class and f"{split_set}_class_labels" not in attrs:
+        return None
+    stats = {'mean': attrs[f"{split_set}_mean"], 'std': attrs[f"{split_set}_std"]}
+    if per_class:
+        stats.update({k: attrs[f"{split_set}_{k}"]
+                      for k in ['class_labels', 'class_mean', 'class_std']})
+    return stats
+
+
+def split_stats(name, split_set='train', img_size=None, per_class=False, block_size=512, refresh=False):
+    """
+    Per-channel mean and std of a split set of an HDF5 dataset, computed in
+    one streaming pass. The results are cached as attributes of the images
+    dataset ('{split}_mean', '{split}_std', ...), keyed by a hash of the split
+    rows, labels and content so that they are recomputed when the split or
+    its images change.
+
+    Args:
+        name(str):              path to the HDF5 file (dataset)
+        split_set(str):         'train', 'valid' or 'test'
+        img_size(tuple):        (height, width) of the images to use
+        per_class(bool):        option to also compute the stats of each class
+        block_size(int):        number of images read at once
+        refresh(bool):          option to ignore the cached stats
+    Returns:
+        stats(dict):            'mean' and 'std' arrays, plus 'class_labels',
+                                'class_mean' and 'class_std' with per_class
+    """
+    with h5py.File(name, "r") as file:
+        images, rows, labels = _split_rows(file, split_set, img_size)
+        # the segmented split sets are rewritten as a whole, with their attributes
+        content = rows_digest(file, rows) if f"{split_set}_idx" in file else ''
+        key = stats_key(rows, labels, content)
+        stats = None if refresh else _cached_stats(images, split_set, key, per_class)
+        if stats is not None:
+            return stats
+        total, class_stats = channel_stats(
+            images, rows, labels if per_class else None, block_size)
+
+    stats = {'mean': total.mean, 'std': total.std}
+    if per_class:
+        class_labels = sorted(class_stats)
+        stats.update({
+            'class_labels': np.array(class_labels),
+            'class_mean': np.stack([class_stats[k].mean for k in class_labels]),
+            'class_std': np.stack([class_stats[k].std for k in class_labels])})
+    with h5py.File(name, "a") as file:
+        attrs = _split_rows(file, split_set, img_size)[0].attrs
+        for k in ['class_labels', 'class_mean', 'class_std']:
+            if f"{split_set}_{k}" in attrs:
+                del attrs[f"{split_set}_{k}"]
+        for k, v in stats.items():
+            attrs[f"{split_set}_{k}"] = v
+        attrs[f"{split_set}_stats_key"] = key
+    return stats
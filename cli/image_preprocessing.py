@@ -1,7 +1,14 @@
 import cv2
+import threading
 import numpy as np
 from cli.cli_utils import plot_multiple_img
-import skimage
+
+# identity lookup table, the transforms below are built by applying them to it
+RAMP = np.arange(256, dtype=np.uint8)
+# pixels with a channel at or above it are white, see remove_whites
+WHITE_LEVEL = 230
+# CLAHE instances of each thread, see get_clahe
+_local = threading.local()
 
 
 def adaptive_thresh_and_canny(image_gray):
@@ -70,56 +77,80 @@ def morph_transform(image_gray):
     plot_multiple_img(morphs, True, titles)
 
 
-def automatic_brightness_and_contrast(rgb_img, clip_hist_percent=2, verbose=False):
+def brightness_contrast_lut(gray, clip_hist_percent=2):
     """
-    Automatic brightness and contrast optimization with histogram clipping.
+    Lookup table of the automatic brightness and contrast optimization of
+    a grayscale image, see automatic_brightness_and_contrast. The clipping
+    points are located with a cumulative sum of the histogram and a binary
+    search.
 
     Args:
-        rgb_img (numpy.ndarray):    RGB image to adjust
+        gray (numpy.ndarray):       grayscale image
         clip_hist_percent (int):    specify the histogram percentile to clip at
-        verbose (bool):             option to display images
     Returns:
-        new_img (numpy.ndarray):    image with brightness and contrast adjusted
+        lut (numpy.ndarray):        (256,) uint8 lookup table
     """
-    # Convert image to grayscale
-    gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
-
-    # Calculate grayscale histogram
-    hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
-    hist_size = len(hist)
-
     # Calculate cumulative distribution from the histogram
-    accumulator = []
-    accumulator.append(float(hist[0]))
-    for index in range(1, hist_size):
-        accumulator.append(accumulator[index - 1] + float(hist[index]))
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    accumulator = np.cumsum(hist, dtype=np.float64)
 
     # Locate points to clip
     maximum = accumulator[-1]
     clip_hist_percent *= (maximum/100.0)
     clip_hist_percent /= 2.0
+    # first bin reaching the left cut, last bin below the right cut
+    minimum_gray = int(np.searchsorted(accumulator, clip_hist_percent, side='left'))
+    maximum_gray = int(np.searchsorted(
+        accumulator, maximum - clip_hist_percent, side='left')) - 1
 
-    # Locate left cut
-    minimum_gray = 0
-    while accumulator[minimum_gray] < clip_hist_percent:
-        minimum_gray += 1
-
-    # Locate right cut
-    maximum_gray = hist_size - 1
-    while accumulator[maximum_gray] >= (maximum - clip_hist_percent):
-        maximum_gray -= 1
+    # uniform images, or with two adjacent gray levels, are left as they are
+    if maximum_gray <= minimum_gray:
+        return RAMP.copy()
 
     # Calculate alpha and beta values
     alpha = 255 / (maximum_gray - minimum_gray)
     beta = -minimum_gray * alpha
+    return cv2.convertScaleAbs(RAMP, alpha=alpha, beta=beta).ravel()
+
+
+def automatic_brightness_and_contrast(rgb_img, clip_hist_percent=2, verbose=False):
+    """
+    Automatic brightness and contrast optimization with histogram clipping.
 
-    new_img = cv2.convertScaleAbs(rgb_img, alpha=alpha, beta=beta)
+    Args:
+        rgb_img (numpy.ndarray):    RGB image to adjust
+        clip_hist_percent (int):    specify the histogram percentile to clip at
+        verbose (bool):             option to display images
+    Returns:
+        new_img (numpy.ndarray):    image with brightness and contrast adjusted
+    """
+    # Convert image to grayscale
+    gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
+    new_img = cv2.LUT(rgb_img, brightness_contrast_lut(gray, clip_hist_percent))
     if verbose:
         plot_multiple_img([rgb_img, new_img], True,
                           titles=['image', 'new image with auto bright+contrast'])
     return new_img
 
 
+def lightness_luts(l_channels):
+    """
+    Lookup tables clipping the lightness of images 30 levels inside their
+    range, see adjust_lightness. The limits are computed in uint8 like the
+    per-image path, so that they wrap around on very dark or bright images.
+
+    Args:
+        l_channels (numpy.ndarray): (N, H, W) L channels of LAB images
+    Returns:
+        luts (numpy.ndarray):       (N, 256) uint8 lookup tables
+    """
+    l_channels = l_channels.reshape(len(l_channels), -1)
+    upper_lim = (l_channels.max(axis=1) - np.uint8(30))[:, np.newaxis]
+    lower_lim = (l_channels.min(axis=1) + np.uint8(30))[:, np.newaxis]
+    luts = np.where(RAMP <= lower_lim, lower_lim, RAMP)
+    return np.where(RAMP >= upper_lim, upper_lim, luts)
+
+
 def adjust_lightness(rgb_img, verbose=False):
     """
     Adjust the lightness of an RGB image.
@@ -132,16 +163,12 @@ def adjust_lightness(rgb_img, verbose=False):
     """
     # Convert image to LAB color space
     lab = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2LAB)
-    l, a, b = cv2.split(lab)
+    l = lab[:, :, 0]
 
-    # Define the lightness boundaries
-    upper_lim = np.max(l) - 30
-    lower_lim = np.min(l) + 30
-
-    # Adjust the lightness
-    new_l = np.where(l <= lower_lim, lower_lim, l)
-    new_l = np.where(l >= upper_lim, upper_lim, new_l)
-    new_lab = cv2.merge((new_l, a, b))
+    # Clip the lightness inside its boundaries
+    new_l = lightness_luts(l[np.newaxis])[0][l]
+    new_lab = lab.copy()
+    new_lab[:, :, 0] = new_l
 
     final = cv2.cvtColor(new_lab, cv2.COLOR_LAB2RGB)
     if verbose:
@@ -150,6 +177,20 @@ def adjust_lightness(rgb_img, verbose=False):
     return final
 
 
+def get_clahe(clip_limit=3.0, tile_grid_size=(8, 8)):
+    """
+    Returns a CLAHE instance, created once per thread and set of parameters
+    instead of once per image.
+    """
+    if not hasattr(_local, 'clahe'):
+        _local.clahe = dict()
+    key = (clip_limit, tuple(tile_grid_size))
+    if key not in _local.clahe:
+        _local.clahe[key] = cv2.createCLAHE(
+            clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+    return _local.clahe[key]
+
+
 def adjust_contrast(rgb_img, verbose=False):
     """
     Adjust the contrast of an RGB image using the Contrast Limited Adaptive
@@ -164,8 +205,7 @@ def adjust_contrast(rgb_img, verbose=False):
     lab = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2LAB)
     l, a, b = cv2.split(lab)
 
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    c_l = clahe.apply(l)
+    c_l = get_clahe(3.0, (8, 8)).apply(l)
 
     new_lab = cv2.merge((c_l, a, b))
     new_img = cv2.cvtColor(new_lab, cv2.COLOR_LAB2RGB)
@@ -189,14 +229,34 @@ def remove_whites(image, mask):
     """
     # setup the white remover to process logical_and in place
     white_remover = np.full((image.shape[0], image.shape[1]), False)
-    white_remover[image[:, :, 0] >= 230] = True
-    white_remover[image[:, :, 1] >= 230] = True
-    white_remover[image[:, :, 2] >= 230] = True
+    white_remover[image[:, :, 0] >= WHITE_LEVEL] = True
+    white_remover[image[:, :, 1] >= WHITE_LEVEL] = True
+    white_remover[image[:, :, 2] >= WHITE_LEVEL] = True
     # remove whites from mask
     mask[white_remover] = True
     return mask
 
 
+def remove_whites_batch(images, masks):
+    """
+    Batched remove_whites, bit-identical to the per-image path: pixels of
+    the masks where any channel of the image is >= 230 are set to 1 (True).
+
+    Args:
+        images: (N, H, W, 3) RGB images
+        masks:  (N, H, W) masks to be cleaned, in place
+    Returns:
+        masks: masks with white pixels removed
+    """
+    n, h, w = masks.shape
+    # 255 where all the channels are < 230, 0 on white pixels
+    non_white = cv2.inRange(images.reshape(n * h, w, 3),
+                            (0, 0, 0), (WHITE_LEVEL - 1,) * 3).reshape(n, h, w)
+    np.bitwise_and(masks, non_white, out=masks)
+    np.bitwise_or(masks, np.bitwise_not(non_white) & 1, out=masks)
+    return masks
+
+
 def fill_object(rgb_img, final_mask):
     """
     Fills the object in the mask with white pixels.
@@ -221,6 +281,47 @@ def fill_object(rgb_img, final_mask):
     return final_mask, no_back_img
 
 
+# hue rotation by 90 of color_cast_removal, with the uint8 wrap of h + 90
+HUE_LUT = ((RAMP + np.uint8(90)) % 180).astype(np.uint8)
+
+
+def color_cast_luts(images, rgb_new):
+    """
+    Lookup tables of the blend and range stretching of color_cast_removal.
+    Both steps are applied channel by channel and the blend is increasing,
+    so they are computed on the 256 values of each channel only, for all
+    the images at once.
+
+    Args:
+        images (numpy.ndarray):     (N, H, W, 3) RGB images to process
+        rgb_new (numpy.ndarray):    (N, H, W, 3) images with the hue reversed
+    Returns:
+        luts (numpy.ndarray):       (N, 256, 1, 3) uint8 lookup tables
+    """
+    n = len(images)
+    # 50-50 blend of each value with the average color of rgb_new
+    ave_colors = np.empty((n, 1, 3), dtype=np.uint8)
+    for img_new, color in zip(rgb_new, ave_colors):
+        color[:] = cv2.mean(img_new)[0:3]
+    ramps = np.repeat(RAMP[np.newaxis, :, np.newaxis], n, axis=0).repeat(3, axis=2)
+    blend = cv2.addWeighted(ramps, 0.5, np.repeat(ave_colors, 256, axis=1), 0.5, 0.0)
+
+    # range of each blended image, from the range of its channels
+    channels = np.arange(3)
+    rows = np.arange(n)[:, np.newaxis]
+    low = images.min(axis=1).min(axis=1)
+    high = images.max(axis=1).max(axis=1)
+    imin = blend[rows, low, channels].min(axis=1).astype(np.float64)[:, None, None]
+    imax = blend[rows, high, channels].max(axis=1).astype(np.float64)[:, None, None]
+
+    # stretch dynamic range, as skimage.exposure.rescale_intensity does
+    blend = np.clip(blend, imin, imax)
+    flat = imin == imax
+    stretched = (blend - imin) / np.where(flat, 1., imax - imin) * 255. + 0.
+    luts = np.where(flat, blend, stretched).astype(np.uint8)
+    return luts[:, :, np.newaxis]
+
+
 def color_cast_removal(rgb_img, verbose=False):
     """
     Removes unwanted tint of colors.
@@ -230,26 +331,97 @@ def color_cast_removal(rgb_img, verbose=False):
         verbose (bool):             option to display images
     """
     hsv_image = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2HSV)
-    # separate channels
-    h, s, v = cv2.split(hsv_image)
     # reverse the hue channel by 180 deg out of 360, so in python add 90 and modulo 180
-    h_new = (h + 90) % 180
-    # combine new hue with old sat and value
-    hsv_new = cv2.merge([h_new, s, v])
+    hsv_new = hsv_image.copy()
+    hsv_new[:, :, 0] = HUE_LUT[hsv_image[:, :, 0]]
     # convert back to RGB
     rgb_new = cv2.cvtColor(hsv_new, cv2.COLOR_HSV2RGB)
-    # Get the average color of rgb_new
-    ave_color = cv2.mean(rgb_new)[0:3]
-
-    # create a new image with the average color
-    color_img = np.full_like(rgb_img, ave_color)
-    # make a 50-50 blend of img and color_img
-    blend = cv2.addWeighted(rgb_img, 0.5, color_img, 0.5, 0.0)
-    # stretch dynamic range
-    result = skimage.exposure.rescale_intensity(
-        blend, in_range='image', out_range=(0, 255)).astype(np.uint8)
+    # blend with the average color of rgb_new and stretch dynamic range
+    result = cv2.LUT(rgb_img, color_cast_luts(rgb_img[np.newaxis], rgb_new[np.newaxis])[0])
 
     if verbose:
         plot_multiple_img(imgs=[rgb_img, hsv_image, hsv_new, result], gray=True,
                           titles=['rgb_img', 'hsv_image', 'hsv_new', 'result'])
     return result
+
+
+def _convert_batch(images, code):
+    """ Converts the color space of (N, H, W, 3) images in a single call. """
+    n, h, w = images.shape[:3]
+    return cv2.cvtColor(images.reshape(n * h, w, 3), code).reshape(n, h, w, 3)
+
+
+def auto_brightness_batch(images, clip_hist_percent=2, out=None):
+    """ Batched automatic_brightness_and_contrast of (N, H, W, 3) RGB images. """
+    out = np.empty_like(images) if out is None else out
+    n, h, w = images.shape[:3]
+    grays = cv2.cvtColor(images.reshape(n * h, w, 3), cv2.COLOR_RGB2GRAY).reshape(n, h, w)
+    for img, gray, dst in zip(images, grays, out):
+        cv2.LUT(img, brightness_contrast_lut(gray, clip_hist_percent), dst=dst)
+    return out
+
+
+def adjust_contrast_batch(images, clip_limit=3.0, tile_grid_size=(8, 8), out=None):
+    """ Batched adjust_contrast of (N, H, W, 3) RGB images, with a single CLAHE instance. """
+    clahe = get_clahe(clip_limit, tile_grid_size)
+    lab = _convert_batch(images, cv2.COLOR_RGB2LAB)
+    l_channel = np.empty(images.shape[1:3], dtype=np.uint8)
+    for img_lab in lab:
+        l_channel[:] = img_lab[:, :, 0]
+        img_lab[:, :, 0] = clahe.apply(l_channel)
+    out = np.empty_like(images) if out is None else out
+    out[:] = _convert_batch(lab, cv2.COLOR_LAB2RGB)
+    return out
+
+
+def adjust_lightness_batch(images, out=None):
+    """ Batched adjust_lightness of (N, H, W, 3) RGB images, with one lookup table per image. """
+    lab = _convert_batch(images, cv2.COLOR_RGB2LAB)
+    luts = lightness_luts(lab[..., 0])
+    for img_lab, lut in zip(lab, luts):
+        img_lab[:, :, 0] = lut[img_lab[:, :, 0]]
+    out = np.empty_like(images) if out is None else out
+    out[:] = _convert_batch(lab, cv2.COLOR_LAB2RGB)
+    return out
+
+
+def color_cast_removal_batch(images, out=None):
+    """ Batched color_cast_removal of (N, H, W, 3) RGB images, with one lookup table per image. """
+    hsv = _convert_batch(images, cv2.COLOR_RGB2HSV)
+    hsv[..., 0] = HUE_LUT[hsv[..., 0]]
+    rgb_new = _convert_batch(hsv, cv2.COLOR_HSV2RGB)
+    out = np.empty_like(images) if out is None else out
+    for img, lut, dst in zip(images, color_cast_luts(images, rgb_new), out):
+        cv2.LUT(img, lut, dst=dst)
+    return out
+
+
+def normalize_batch(images, cast=False, contrast=False, lightness=False, brightness=False, out=None):
+    """
+    Photometric normalisation of a batch of RGB images, in the order of
+    back_segmentation: color cast removal, contrast then lightness, and the
+    optional automatic brightness and contrast. Each step gives the same
+    images as its per-image function; the color conversions run once on the
+    whole batch and the per-pixel transforms are lookup tables.
+
+    Args:
+        images (numpy.ndarray):     (N, H, W, 3) RGB images
+        cast (bool):                option to remove color casts
+        contrast (bool):            option to adjust contrast (CLAHE)
+        lightness (bool):           option to adjust lightness
+        brightness (bool):          option to optimize brightness and contrast
+        out (numpy.ndarray):        array receiving the images, allocated if None
+    Returns:
+        out (numpy.ndarray):        (N, H, W, 3) normalised images
+    """
+    out = np.empty_like(images) if out is None else out
+    out[:] = images
+    if cast:
+        color_cast_removal_batch(out, out=out)
+    if contrast:
+        adjust_contrast_batch(out, out=out)
+    if lightness:
+        adjust_lightness_batch(out, out=out)
+    if brightness:
+        auto_brightness_batch(out, out=out)
+    return out
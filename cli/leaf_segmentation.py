@@ -1,23 +1,109 @@
 import copy
 import cv2
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from cli.image_preprocessing import *
 from cli.cli_utils import plot_multiple_img
+from cli.batch_engine import map_batches
+
+# rows between the stacked masks of a batch, at least the 5x5 kernel radius
+MORPH_PAD = 2
+
+# HSV (lower, upper) ranges of color_mask, shared by color_mask_batch and
+# SegmentationContext; the lower saturation of the green and brown ranges is
+# the ls1 and ls2 argument, see hsv_bounds
+HSV_GREEN = ((20, 17, 25), (103, 255, 255))
+HSV_RED = ((0, 75, 28), (15, 255, 255))
+HSV_ORANGE = ((15, 50, 28), (30, 255, 255))
+HSV_BROWN = ((0, 60, 25), (30, 255, 255))
+HSV_RED_BROWN = ((160, 70, 30), (180, 200, 200))
+HSV_WHITE = ((25, 10, 190), (100, 100, 255))
+# closing of the color masks, iterated on the red and orange masks of type 1
+CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+DISEASE_CLOSE_ITERATIONS = 2
+
+# SegmentationContext of the process, see worker_context
+_worker = dict()
+
+# thresholds of the adaptive watershed gate, see needs_watershed
+GATE_COVERAGE = (0.05, 0.95)
+GATE_MIN_AREA = 0.001
+GATE_MAX_COMPONENTS = 1
+GATE_MAX_BORDER = 0.75
+
+
+def hsv_bounds(hsv_range, saturation=None):
+    """ Returns the (lower, upper) arrays of an HSV range, with another lower saturation if given. """
+    lower, upper = np.array(hsv_range[0]), np.array(hsv_range[1])
+    if saturation is not None:
+        lower[1] = saturation
+    return lower, upper
+
+
+def mask_stats(hsv_mask):
+    """
+    Cheap statistics of an HSV mask, used to decide whether the watershed
+    refinement is needed.
+
+    Args:
+        hsv_mask (numpy.array):     uint8 mask, non-zero on the leaves
+    Returns:
+        coverage (float):           fraction of the image on the mask
+        border (float):             fraction of the image border on the mask
+    """
+    coverage = cv2.countNonZero(hsv_mask) / hsv_mask.size
+    n_border = (np.count_nonzero(hsv_mask[0]) + np.count_nonzero(hsv_mask[-1])
+                + np.count_nonzero(hsv_mask[1:-1, 0]) + np.count_nonzero(hsv_mask[1:-1, -1]))
+    border = n_border / max(1, 2 * sum(hsv_mask.shape) - 4)
+    return coverage, border
 
 
-def distance_transform_fb(rgb_img, hsv_mask, fill_sbg=True, verbose=False):
+def count_components(hsv_mask, min_area=GATE_MIN_AREA, step=2):
     """
-    Distance transform from foreground to backgroundotsu= applied on the hsv mask.
+    Number of connected components of an HSV mask larger than min_area (a
+    fraction of the image), smaller ones being noise. They are counted on
+    one pixel out of step in each direction, 4 times faster for step=2.
+    """
+    small_mask = np.ascontiguousarray(hsv_mask[::step, ::step])
+    areas = cv2.connectedComponentsWithStats(small_mask)[2][1:, cv2.CC_STAT_AREA]
+    return int(np.count_nonzero(areas >= min_area * small_mask.size))
+
+
+def needs_watershed(hsv_mask, coverage=GATE_COVERAGE, max_components=GATE_MAX_COMPONENTS, max_border=GATE_MAX_BORDER):
+    """
+    Adaptive gate of the watershed refinement: an HSV mask made of a single
+    leaf, neither almost empty nor almost full, and not spreading along the
+    image border, is clean enough for the hole filling of fill_object alone.
+    The components are only counted when the other statistics pass.
+
+    Args:
+        hsv_mask (numpy.array):     uint8 mask, non-zero on the leaves
+        coverage (tuple):           (min, max) fraction of the image on the mask
+        max_components (int):       maximum number of leaves (components)
+        max_border (float):         maximum fraction of the border on the mask
+    Returns:
+        needed (bool):              True if the watershed should run
+    """
+    mask_coverage, border = mask_stats(hsv_mask)
+    if not coverage[0] <= mask_coverage <= coverage[1] or border > max_border:
+        return True
+    return count_components(hsv_mask) > max_components
+
+
+def watershed_markers(rgb_img, hsv_mask, fill_sbg=True, stages=None):
+    """
+    Watershed of the RGB image seeded with the distance transform from
+    foreground to background of the hsv mask, see distance_transform_fb.
 
     Args:
         rgb_img (numpy.array):      RGB image
         hsv_mask (numpy.array):     Hue, Saturation, Value mask
-
+        fill_sbg (bool):            option to fill holes in the sure background
+        stages (dict):              filled with the intermediate images if given
     Returns:
-        mask (numpy.array):         mask on leaves with distance transform
-        markers (numpy.array):      mask with connected components
+        markers (numpy.array):      uint8 markers, > 1 on the leaves
     """
 
     # Noise Removal with morph transform
@@ -60,15 +146,35 @@ def distance_transform_fb(rgb_img, hsv_mask, fill_sbg=True, verbose=False):
     markers = np.uint8(markers)
     markers = cv2.morphologyEx(markers, cv2.MORPH_CLOSE, kernel, iterations=1)
 
+    if stages is not None:
+        stages.update({'opening': opening, 'sure_bg': sure_bg,
+                       'dist_transform': dist_transform, 'sure_fg': sure_fg,
+                       'bg - fg': unknown})
+    return markers
+
+
+def distance_transform_fb(rgb_img, hsv_mask, fill_sbg=True, verbose=False):
+    """
+    Distance transform from foreground to backgroundotsu= applied on the hsv mask.
+
+    Args:
+        rgb_img (numpy.array):      RGB image
+        hsv_mask (numpy.array):     Hue, Saturation, Value mask
+
+    Returns:
+        mask (numpy.array):         mask on leaves with distance transform
+        markers (numpy.array):      mask with connected components
+    """
+    stages = dict() if verbose else None
+    markers = watershed_markers(rgb_img, hsv_mask, fill_sbg, stages)
+
     bg_mask = copy.deepcopy(rgb_img)
     # set background to black
     bg_mask[markers <= 1] = [0, 0, 0]
 
     if verbose:
-        imgs = [hsv_mask, opening, sure_bg, dist_transform,
-                sure_fg, unknown, markers, bg_mask]
-        titles = ['hsv_mask', 'opening', 'sure_bg', 'dist_transform',
-                  'sure_fg', 'bg - fg', 'markers', 'with mask']
+        imgs = [hsv_mask, *stages.values(), markers, bg_mask]
+        titles = ['hsv_mask', *stages, 'markers', 'with mask']
         plot_multiple_img(imgs, True, titles=titles)
 
     return bg_mask
@@ -94,29 +200,23 @@ def color_mask(rgb_img, ls1, ls2, type=1, verbose=False):
     hsv = cv2.cvtColor(g_blurred, cv2.COLOR_RGB2HSV)
 
     # define kernel for morphology transformations
-    k_size = (5, 5)  # (3, 3)
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, k_size)
+    kernel = CLOSE_KERNEL
 
     # mask on yellow-green-blue
-    lower_green = np.array([20, ls1, 25])
-    upper_green = np.array([103, 255, 255])
+    lower_green, upper_green = hsv_bounds(HSV_GREEN, ls1)
     healthy_mask = cv2.inRange(hsv, lower_green, upper_green)
     healthy_mask = cv2.morphologyEx(healthy_mask, cv2.MORPH_CLOSE, kernel)
 
     if type == 1:
         # mask on red
-        lower_red = np.array([0, 75, 28])
-        upper_red = np.array([15, 255, 255])
-        red_mask = cv2.inRange(hsv, lower_red, upper_red)
+        red_mask = cv2.inRange(hsv, *hsv_bounds(HSV_RED))
         # mask on orange-yellow
-        lower_yellow = np.array([15, 50, 28])
-        upper_yellow = np.array([30, 255, 255])
-        orange_mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
+        orange_mask = cv2.inRange(hsv, *hsv_bounds(HSV_ORANGE))
         # mask on upper red
-        upper_red_brown = cv2.inRange(hsv, (160, 70, 30), (180, 200, 200))
+        upper_red_brown = cv2.inRange(hsv, *hsv_bounds(HSV_RED_BROWN))
         disease_mask = orange_mask | red_mask
         disease_mask = cv2.morphologyEx(
-            disease_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+            disease_mask, cv2.MORPH_CLOSE, kernel, iterations=DISEASE_CLOSE_ITERATIONS)
 
         # combine the masks
         disease_mask = disease_mask | upper_red_brown
@@ -124,11 +224,9 @@ def color_mask(rgb_img, ls1, ls2, type=1, verbose=False):
 
     else:
         # mask on red-brown-orange
-        lower_brown = np.array([0, ls2, 25])
-        upper_brown = np.array([30, 255, 255])
-        disease_mask = cv2.inRange(hsv, lower_brown, upper_brown)
+        disease_mask = cv2.inRange(hsv, *hsv_bounds(HSV_BROWN, ls2))
         disease_mask = cv2.morphologyEx(disease_mask, cv2.MORPH_CLOSE, kernel)
-        upper_red_brown = cv2.inRange(hsv, (160, 70, 30), (180, 200, 200))
+        upper_red_brown = cv2.inRange(hsv, *hsv_bounds(HSV_RED_BROWN))
         # combine the masks
         disease_mask = disease_mask | upper_red_brown
         final_mask = healthy_mask | disease_mask
@@ -138,7 +236,7 @@ def color_mask(rgb_img, ls1, ls2, type=1, verbose=False):
     disease_result = cv2.bitwise_and(rgb_img, rgb_img, mask=disease_mask)
 
     # Mask on white on green leaves
-    white_mask = cv2.inRange(hsv, (25, 10, 190), (100, 100, 255))
+    white_mask = cv2.inRange(hsv, *hsv_bounds(HSV_WHITE))
     white_res = cv2.bitwise_and(rgb_img, rgb_img, mask=white_mask)
 
     final_mask = final_mask | white_mask
@@ -151,6 +249,78 @@ def color_mask(rgb_img, ls1, ls2, type=1, verbose=False):
     return final_mask, result, disease_result
 
 
+def _morph_close_batch(padded, kernel, iterations=1):
+    """
+    Morphological closing of stacked masks, see color_mask_batch. The pad
+    rows below each mask are reset to the neutral value of every dilation (0)
+    and erosion (255), so that masks never leak into each other and each one
+    is closed as if alone, with the default constant border.
+    """
+    n, h, w = padded.shape
+    h -= MORPH_PAD
+    tmp = np.empty_like(padded)
+    src, dst = padded, tmp
+    for op, neutral in [(cv2.dilate, 0)] * iterations + [(cv2.erode, 255)] * iterations:
+        src[:, h:] = neutral
+        op(src.reshape(-1, w), kernel, dst=dst.reshape(-1, w))
+        src, dst = dst, src
+    if src is not padded:
+        padded[:] = src
+    return padded
+
+
+def color_mask_batch(images, ls1, ls2, type=1):
+    """
+    Batched color_mask: HSV color masks of a batch of RGB images, bit-identical
+    to the per-image path. Only the blur runs per image; the HSV conversion
+    and the color ranges are applied to the whole batch reshaped to a single
+    image, and the morphology to the masks stacked with neutral pad rows.
+
+    Args:
+        images (numpy.array):      (N, H, W, 3) RGB images
+        ls1 (int):                 lower saturation on yellow-green-blue
+        ls2 (int):                 lower saturation on red-brown-orange
+        type (int):                type of mask
+    Returns:
+        healthy_mask (numpy.array): (N, H, W) masks on yellow-green-blue
+        disease_mask (numpy.array): (N, H, W) masks on red-brown-orange
+        white_mask (numpy.array):   (N, H, W) masks on white
+        final_mask (numpy.array):   (N, H, W) masks on leaves
+    """
+    n, h, w = images.shape[:3]
+    blurred = np.empty_like(images)
+    for img, dst in zip(images, blurred):
+        cv2.GaussianBlur(img, (5, 5), 0, dst=dst)
+    hsv = cv2.cvtColor(blurred.reshape(n * h, w, 3), cv2.COLOR_RGB2HSV)
+
+    kernel = CLOSE_KERNEL
+    masks = np.empty((4, n, h + MORPH_PAD, w), dtype=np.uint8)
+    healthy, disease, white, final = masks
+    def in_range(lower, upper, dst):
+        dst[:, :h] = cv2.inRange(hsv, lower, upper).reshape(n, h, w)
+        return dst
+
+    in_range(*hsv_bounds(HSV_GREEN, ls1), healthy)
+    _morph_close_batch(healthy, kernel)
+    upper_red_brown = cv2.inRange(hsv, *hsv_bounds(HSV_RED_BROWN))
+
+    if type == 1:
+        in_range(*hsv_bounds(HSV_RED), disease)
+        in_range(*hsv_bounds(HSV_ORANGE), final)
+        disease |= final
+        _morph_close_batch(disease, kernel, iterations=DISEASE_CLOSE_ITERATIONS)
+    else:
+        in_range(*hsv_bounds(HSV_BROWN, ls2), disease)
+        _morph_close_batch(disease, kernel)
+    disease[:, :h] |= upper_red_brown.reshape(n, h, w)
+
+    in_range(*hsv_bounds(HSV_WHITE), white)
+    np.bitwise_or(healthy, disease, out=final)
+    final |= white
+    _morph_close_batch(final, kernel)
+    return tuple(mask[:, :h] for mask in masks)
+
+
 def back_segmentation(rgb_img, white=True, dist=False, lightness=False, contrast=False, cast=False, verbose=False, subtitle=None):
     """
     Image segmentation using background subtraction.
@@ -235,11 +405,395 @@ def remove_background(rgb_img, p_type, dist=False, morphs=False, adapt_th=False,
     return no_back_img
 
 
-def segment_split_set(img_arr, p_option, dist=False):
-    seg_imgs = []
-    for img in img_arr:
-        img_noback = remove_background(
-            img, p_type=int(p_option), dist=dist)
-        seg_imgs.append(img_noback)
-    seg_imgs = np.array(seg_imgs)
+def _color_masks(images, p_type):
+    """ HSV color masks of a batch of images preprocessed for p_type, whites removed. """
+    new_imgs = images
+    if p_type in [1, 2]:
+        new_imgs = normalize_batch(images, contrast=True, lightness=p_type == 2)
+    final_masks = color_mask_batch(new_imgs, ls1=17, ls2=60)[3]
+    return remove_whites_batch(images, final_masks)
+
+
+def refine_masks(images, p_type, dist=False):
+    """
+    Full resolution masks the edges of upsampled masks are refined with: the
+    color masks of mask_batch for p_type, opened as fill_object and the
+    watershed do and, with dist, closed as the watershed markers are.
+
+    Args:
+        images (numpy.array):   (N, H, W, 3) RGB images
+        p_type (int):           type of image preprocessing
+        dist (bool):            option to use distance transformations
+    Returns:
+        masks (numpy.array):    (N, H, W) uint8 masks, non-zero on the leaves
+    """
+    kernel = np.ones((3, 3), np.uint8)
+    masks = _color_masks(images, p_type)
+    for mask in masks:
+        cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, dst=mask)
+        if dist:
+            cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, dst=mask)
+    return masks
+
+
+def upscale_masks(masks, size, images=None, p_type=0, dist=False):
+    """
+    Upsamples 0/1 masks computed on downscaled images (bilinear, then
+    rounded, which thresholds at 0.5). With the full resolution images, the
+    edges are refined: on a 1 pixel band around each upsampled edge, the
+    mask is replaced by the refine_masks mask of the full resolution image.
+
+    Args:
+        masks (numpy.array):    (N, h, w) uint8 masks of 0 and 1
+        size (tuple):           (width, height) of the full resolution
+        images (numpy.array):   (N, H, W, 3) RGB images to refine the edges on
+        p_type (int):           type of image preprocessing of the masks
+        dist (bool):            option the masks were computed with
+    Returns:
+        up_masks (numpy.array): (N, H, W) uint8 masks of 0 and 1
+    """
+    w, h = size
+    up_masks = np.empty((len(masks), h, w), dtype=np.uint8)
+    for mask, dst in zip(masks, up_masks):
+        cv2.resize(mask, (w, h), dst=dst, interpolation=cv2.INTER_LINEAR)
+    if images is not None:
+        kernel = np.ones((3, 3), np.uint8)
+        # the band of each mask is computed alone, not to leak into its neighbours
+        for mask, ref in zip(up_masks, refine_masks(images, p_type, dist)):
+            band = cv2.dilate(mask, kernel) != cv2.erode(mask, kernel)
+            mask[band] = ref[band] != 0
+    return up_masks
+
+
+def mask_batch(images, p_type, dist=False, mask_scale=1, refine=False, adaptive=False, with_stats=False):
+    """
+    Leaf masks of a batch of (N, H, W, 3) RGB images, 1 on the leaves and 0
+    on the background. segment_batch applies them to the images.
+
+    With mask_scale < 1, the masks are computed on the images downscaled by
+    mask_scale and upsampled back to (H, W), see upscale_masks; refine
+    corrects their edges with the full resolution colors. With adaptive, the
+    watershed of dist only runs on the images whose HSV mask is not clean,
+    see needs_watershed. with_stats also returns the number of images of
+    dist on each path and the time spent on them (see gate_report), as the
+    stats of map_batches.
+    """
+    if mask_scale != 1:
+        n, h, w = images.shape[:3]
+        size = (max(1, round(w * mask_scale)), max(1, round(h * mask_scale)))
+        small_imgs = np.empty((n, size[1], size[0], 3), dtype=images.dtype)
+        for img, dst in zip(images, small_imgs):
+            cv2.resize(img, size, dst=dst, interpolation=cv2.INTER_AREA)
+        masks = mask_batch(small_imgs, p_type, dist, adaptive=adaptive, with_stats=with_stats)
+        if with_stats:
+            masks, stats = masks
+            return upscale_masks(masks, (w, h), images if refine else None, p_type, dist), stats
+        return upscale_masks(masks, (w, h), images if refine else None, p_type, dist)
+
+    final_masks = _color_masks(images, p_type)
+    masks = np.empty(images.shape[:3], dtype=np.uint8)
+    context = worker_context()
+    before = context.stats()
+    for img, mask, dst in zip(images, final_masks, masks):
+        np.copyto(dst, context.leaf_mask(img, mask, dist, adaptive))
+    if with_stats:
+        return masks, {k: v - before[k] for k, v in context.stats().items()}
+    return masks
+
+
+def gate_report(stats):
+    """
+    Summary of the stats of mask_batch: the number of images of dist on each
+    path with their mean processing time, and the net time saved by the
+    adaptive gate (or its overhead when negative), estimated from the mean
+    time of the watershed on the images that went through it.
+    """
+    n_watershed, n_fill = stats.get('watershed', 0), stats.get('fill', 0)
+    report = f"adaptive gate: {n_watershed} watershed, {n_fill} fill"
+    if n_watershed:
+        report += f", watershed {1000 * stats['watershed_time'] / n_watershed:.1f}ms/image"
+    if n_fill:
+        report += f", fill {1000 * stats['fill_time'] / n_fill:.1f}ms/image"
+    report += f", gate {stats.get('gate_time', 0):.2f}s"
+    if n_watershed and n_fill:
+        saved = n_fill * (stats['watershed_time'] / n_watershed - stats['fill_time'] / n_fill)
+        net = saved - stats['gate_time']
+        if net >= 0:
+            report += f", {net:.2f}s of processing saved (estimate)"
+        else:
+            report += f", {-net:.2f}s of processing overhead (estimate)"
+    return report
+
+
+def worker_context():
+    """
+    Returns the SegmentationContext of the current process, created by the
+    first call: the workers of map_batches reuse its buffers for every chunk.
+    """
+    if 'context' not in _worker:
+        _worker['context'] = SegmentationContext()
+    return _worker['context']
+
+
+def segment_batch(images, p_type, dist=False, mask_scale=1, refine=False, adaptive=False, with_stats=False):
+    """
+    Removes the background of a batch of (N, H, W, 3) RGB images, same as
+    remove_background on each image but with the batched mask kernels.
+    with_stats also returns the stats of mask_batch.
+    """
+    masks = mask_batch(images, p_type, dist, mask_scale, refine, adaptive, with_stats)
+    if with_stats:
+        masks, stats = masks
+        return images * masks[..., np.newaxis], stats
+    return images * masks[..., np.newaxis]
+
+
+def segment_split_set(img_arr, p_option, dist=False, out=None, n_workers=None, chunk_size=32, mask_scale=1, refine=False, adaptive=False):
+    """
+    Removes the background of a set of images with a pool of processes.
+
+    Parameters:
+        img_arr (numpy.array):   (N, H, W, 3) RGB images, or an h5py.Dataset
+        p_option (str):          type of image preprocessing
+        dist (bool):             option to use distance transformations
+        out (numpy.array):       array or h5py.Dataset receiving the images
+        n_workers (int):         number of processes (defaults to the cpu count)
+        chunk_size (int):        number of images per task
+        mask_scale (float):      scale of the images the masks are computed on
+        refine (bool):           option to refine the edges of downscaled masks
+        adaptive (bool):         option to skip the watershed on clean masks,
+                                 the paths taken are reported
+    Returns:
+        seg_imgs (numpy.array):  RGB images with the background removed
+    """
+    stats = dict() if dist and adaptive else None
+    seg_imgs = map_batches(segment_batch, img_arr, out=out, n_workers=n_workers,
+                           chunk_size=chunk_size, desc='Segmenting', stats=stats,
+                           p_type=int(p_option), dist=dist, mask_scale=mask_scale, refine=refine,
+                           adaptive=adaptive, with_stats=stats is not None)
+    if stats is not None:
+        print(gate_report(stats))
     return seg_imgs
+
+
+class SegmentationContext():
+    """
+    remove_background without copies: the scratch buffers of every step
+    (normalised image, LAB, HSV, color masks, distance transform, markers)
+    are allocated once per image size and each step writes into them, so
+    segmenting a set of images allocates nothing per image but the contours.
+    The output is the same as remove_background(rgb_img, p_type, dist).
+
+    Attributes:
+        img_size (tuple): (height, width) of the buffers
+        nbytes (int): size of the buffers in bytes
+        paths (dict): number of images of dist that went through the
+            watershed and through the adaptive gate to fill_object
+        times (dict): time (s) spent in the gate and on each path
+    """
+
+    def __init__(self, img_size=None):
+        self.img_size = None
+        self.nbytes = 0
+        self.paths = {'watershed': 0, 'fill': 0}
+        self.times = {'gate': 0., 'watershed': 0., 'fill': 0.}
+        self.ellipse = CLOSE_KERNEL
+        self.square = np.ones((3, 3), np.uint8)
+        if img_size is not None:
+            self._allocate(img_size)
+
+
+    def _allocate(self, img_size):
+        """ (Re)allocates the buffers for images of img_size. """
+        h, w = img_size
+        self.img_size = (h, w)
+        self.new_img = np.empty((h, w, 3), dtype=np.uint8)
+        self.lab = np.empty((h, w, 3), dtype=np.uint8)
+        self.hsv = np.empty((h, w, 3), dtype=np.uint8)
+        # l channel, healthy, disease, white, final and scratch masks
+        self.channels = np.empty((6, h, w), dtype=np.uint8)
+        self.dist = np.empty((h, w), dtype=np.float32)
+        self.markers = np.empty((h, w), dtype=np.int32)
+        self.keep = np.empty((h, w), dtype=bool)
+        buffers = [self.new_img, self.lab, self.hsv, self.channels, self.dist,
+                   self.markers, self.keep]
+        self.nbytes = sum(buffer.nbytes for buffer in buffers)
+
+
+    def _normalize(self, rgb_img, contrast, lightness):
+        """ adjust_contrast then adjust_lightness of rgb_img into new_img. """
+        l_channel = self.channels[0]
+        src = rgb_img
+        if contrast:
+            cv2.cvtColor(src, cv2.COLOR_RGB2LAB, dst=self.lab)
+            cv2.extractChannel(self.lab, 0, dst=l_channel)
+            get_clahe(3.0, (8, 8)).apply(l_channel, dst=l_channel)
+            cv2.insertChannel(l_channel, self.lab, 0)
+            cv2.cvtColor(self.lab, cv2.COLOR_LAB2RGB, dst=self.new_img)
+            src = self.new_img
+        if lightness:
+            cv2.cvtColor(src, cv2.COLOR_RGB2LAB, dst=self.lab)
+            cv2.extractChannel(self.lab, 0, dst=l_channel)
+            cv2.LUT(l_channel, lightness_luts(l_channel[np.newaxis])[0], dst=l_channel)
+            cv2.insertChannel(l_channel, self.lab, 0)
+            cv2.cvtColor(self.lab, cv2.COLOR_LAB2RGB, dst=self.new_img)
+            src = self.new_img
+        return src
+
+
+    def _color_mask(self, new_img, ls1=17):
+        """ final_mask of color_mask(new_img, ls1, ls2=60), written into channels[4]. """
+        healthy, disease, white, final, tmp = self.channels[1:]
+        cv2.GaussianBlur(new_img, (5, 5), 0, dst=self.lab)
+        cv2.cvtColor(self.lab, cv2.COLOR_RGB2HSV, dst=self.hsv)
+
+        cv2.inRange(self.hsv, *hsv_bounds(HSV_GREEN, ls1), dst=healthy)
+        cv2.morphologyEx(healthy, cv2.MORPH_CLOSE, self.ellipse, dst=healthy)
+        cv2.inRange(self.hsv, *hsv_bounds(HSV_RED), dst=disease)
+        cv2.inRange(self.hsv, *hsv_bounds(HSV_ORANGE), dst=tmp)
+        np.bitwise_or(disease, tmp, out=disease)
+        cv2.morphologyEx(disease, cv2.MORPH_CLOSE, self.ellipse, dst=disease,
+                         iterations=DISEASE_CLOSE_ITERATIONS)
+        cv2.inRange(self.hsv, *hsv_bounds(HSV_RED_BROWN), dst=tmp)
+        np.bitwise_or(disease, tmp, out=disease)
+        np.bitwise_or(healthy, disease, out=final)
+
+        cv2.inRange(self.hsv, *hsv_bounds(HSV_WHITE), dst=white)
+        np.bitwise_or(final, white, out=final)
+        cv2.morphologyEx(final, cv2.MORPH_CLOSE, self.ellipse, dst=final)
+        return final
+
+
+    def _remove_whites(self, rgb_img, mask):
+        """ remove_whites(rgb_img, mask), in place. """
+        non_white = self.channels[5]
+        cv2.inRange(rgb_img, (0, 0, 0), (WHITE_LEVEL - 1,) * 3, dst=non_white)
+        np.bitwise_and(mask, non_white, out=mask)
+        np.bitwise_not(non_white, out=non_white)
+        np.bitwise_and(non_white, 1, out=non_white)
+        np.bitwise_or(mask, non_white, out=mask)
+        return mask
+
+
+    def _fill_object(self, mask):
+        """ final_mask of fill_object, in place, as a boolean mask into keep. """
+        cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+        cv2.fillPoly(mask, cnts, (255, 255, 255))
+        cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.square, dst=mask)
+        return np.not_equal(mask, 0, out=self.keep)
+
+
+    def _watershed(self, rgb_img, mask):
+        """ watershed_markers(rgb_img, mask) > 1, as a boolean mask into keep. """
+        opening, sure_bg, sure_fg = self.channels[1:4]
+        cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.square, dst=opening)
+        cv2.dilate(opening, self.square, dst=sure_bg, iterations=8)
+        cnts = cv2.findContours(sure_bg, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+        cv2.fillPoly(sure_bg, cnts, (255, 255, 255))
+
+        cv2.distanceTransform(opening, cv2.DIST_L2, 3, dst=self.dist)
+        cv2.normalize(self.dist, self.dist, 0, 1.0, cv2.NORM_MINMAX)
+        cv2.threshold(self.dist, 0.11 * self.dist.max(), 255, 0, dst=self.dist)
+        np.copyto(sure_fg, self.dist, casting='unsafe')
+        # unknown region, sure_bg - sure_fg
+        cv2.subtract(sure_bg, sure_fg, dst=sure_bg)
+
+        cv2.connectedComponents(sure_fg, labels=self.markers)
+        self.markers += 1
+        np.equal(sure_bg, 255, out=self.keep)
+        self.markers[self.keep] = 0
+        cv2.watershed(rgb_img, self.markers)
+
+        # markers > 1 and the boundaries (-1) are 255 once in uint8
+        markers = self.channels[4]
+        np.greater(self.markers, 1, out=self.keep)
+        self.markers[self.keep] = 255
+        np.copyto(markers, self.markers, casting='unsafe')
+        cv2.morphologyEx(markers, cv2.MORPH_CLOSE, self.square, dst=markers)
+        return np.greater(markers, 1, out=self.keep)
+
+
+    def mask(self, rgb_img, p_type, dist=False, adaptive=False):
+        """
+        Leaf mask of an RGB image, as remove_background(rgb_img, p_type, dist).
+
+        Args:
+            rgb_img (numpy.array):  RGB image
+            p_type (int):           type of image preprocessing
+            dist (bool):            option to use distance transformations
+            adaptive (bool):        option to skip the watershed on clean masks
+        Returns:
+            keep (numpy.array):     boolean mask, True on the leaves; a buffer of
+                                    the context, overwritten by the next image
+        """
+        if rgb_img.shape[:2] != self.img_size:
+            self._allocate(rgb_img.shape[:2])
+        new_img = self._normalize(rgb_img, p_type in [1, 2], p_type == 2)
+        final_mask = self._remove_whites(rgb_img, self._color_mask(new_img))
+        return self.leaf_mask(rgb_img, final_mask, dist, adaptive)
+
+
+    def leaf_mask(self, rgb_img, final_mask, dist=False, adaptive=False):
+        """
+        Leaf mask of an RGB image from its HSV mask (whites removed), filled
+        or, with dist, through the watershed. final_mask is modified.
+
+        Args:
+            rgb_img (numpy.array):  RGB image
+            final_mask (numpy.array): uint8 HSV mask of the image
+            dist (bool):            option to use distance transformations
+            adaptive (bool):        option to skip the watershed on clean masks
+        Returns:
+            keep (numpy.array):     boolean mask, True on the leaves; a buffer of
+                                    the context, overwritten by the next image
+        """
+        if rgb_img.shape[:2] != self.img_size:
+            self._allocate(rgb_img.shape[:2])
+        watershed = dist
+        if dist and adaptive:
+            start = time.perf_counter()
+            watershed = needs_watershed(final_mask)
+            self.times['gate'] += time.perf_counter() - start
+        start = time.perf_counter()
+        keep = self._watershed(rgb_img, final_mask) if watershed else self._fill_object(final_mask)
+        if dist:
+            path = 'watershed' if watershed else 'fill'
+            self.paths[path] += 1
+            self.times[path] += time.perf_counter() - start
+        return keep
+
+
+    def stats(self):
+        """ Returns the paths and the times of the context as the stats of mask_batch. """
+        stats = dict(self.paths)
+        stats.update({f"{path}_time": t for path, t in self.times.items()})
+        return stats
+
+
+    def segment(self, rgb_img, p_type, dist=False, out=None, adaptive=False):
+        """ remove_background(rgb_img, p_type, dist), written into out if given. """
+        keep = self.mask(rgb_img, p_type, dist, adaptive)
+        out = np.empty_like(rgb_img) if out is None else out
+        return np.multiply(rgb_img, keep[..., np.newaxis], out=out)
+
+
+    def segment_images(self, images, p_type, dist=False, out=None, adaptive=False):
+        """
+        Removes the background of (N, H, W, 3) RGB images one by one with
+        the buffers of the context.
+
+        Args:
+            images (numpy.array):   (N, H, W, 3) RGB images
+            p_type (int):           type of image preprocessing
+            dist (bool):            option to use distance transformations
+            out (numpy.array):      array receiving the images, allocated if None
+            adaptive (bool):        option to skip the watershed on clean masks
+        Returns:
+            seg_imgs (numpy.array): (N, H, W, 3) images with the background removed
+        """
+        out = np.empty_like(images) if out is None else out
+        for img, dst in zip(images, out):
+            self.segment(img, p_type, dist, out=dst, adaptive=adaptive)
+        return out
@@ -0,0 +1,304 @@
+import os
+import h5py
+import hashlib
+import numpy as np
+from cli.batch_engine import WorkerPool, map_batches
+from cli.dataloader import hdf5_layout
+from cli.dataset_builder import SPLIT_SETS, images_key, read_rows, rows_digest, size_group
+from cli.leaf_segmentation import gate_report, mask_batch
+
+# number of packed masks per HDF5 chunk
+CHUNK_ROWS = 64
+
+
+def pack_masks(masks):
+    """
+    Packs (N, H, W) masks into bits, 8 pixels per byte.
+
+    Args:
+        masks(numpy.array):     (N, H, W) masks, non-zero on the leaves
+    Returns:
+        packed(numpy.array):    (N, ceil(H * W / 8)) uint8 packed masks
+    """
+    masks = np.asarray(masks)
+    return np.packbits(masks.reshape(len(masks), -1) != 0, axis=1)
+
+
+def unpack_masks(packed, img_size):
+    """ Unpacks masks packed by pack_masks into (N, H, W) uint8 masks of 0 and 1. """
+    h, w = img_size
+    return np.unpackbits(packed, axis=1, count=h * w).reshape(-1, h, w)
+
+
+def image_digests(images):
+    """ Returns a 64 bits content hash of each image, 0 being kept for missing masks. """
+    digests = np.empty(len(images), dtype=np.uint64)
+    for i, img in enumerate(images):
+        digest = hashlib.blake2b(np.ascontiguousarray(img), digest_size=8).digest()
+        digests[i] = int.from_bytes(digest, 'little') or 1
+    return digests
+
+
+class MaskCache():
+    """
+    Leaf masks of an HDF5 dataset, stored bit-packed next to it as
+    {dataset}.masks.h5. The masks of each set of segmentation parameters are
+    kept in their own group, 'p{p_type}_{fill|dist}/size_{h}x{w}' (with an
+    '_adaptive' suffix on the first name for the adaptive watershed of dist,
+    and '_s{mask_scale}' and '_refine' when the masks are computed on
+    downscaled images, see mask_batch), holding a
+    'masks' dataset with one packed mask per row of the images and a
+    'digests' dataset with the hash of the image each mask was computed on.
+    A mask is only reused when the image of its row did not change, so the
+    cache stays valid across incremental rebuilds of the dataset.
+
+    Attributes:
+        name (str): path to the HDF5 file of the images (dataset)
+        path (str): path to the HDF5 file of the masks
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = f"{os.path.splitext(name)[0]}.masks.h5"
+        self.file = h5py.File(self.path, "a")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    @staticmethod
+    def group_key(p_type, dist, img_size, mask_scale=1, refine=False, adaptive=False):
+        """ Returns the key of the group holding the masks of a set of parameters. """
+        name = f"p{p_type}_{'dist' if dist else 'fill'}"
+        if dist and adaptive:
+            name += "_adaptive"
+        if mask_scale != 1:
+            name += f"_s{mask_scale:g}" + ("_refine" if refine else "")
+        return f"{name}/{size_group(img_size)}"
+
+
+    def _group(self, p_type, dist, img_size, n_rows, mask_scale=1, refine=False, adaptive=False):
+        """ Returns the group of a set of parameters, sized to n_rows rows. """
+        key = self.group_key(p_type, dist, img_size, mask_scale, refine, adaptive)
+        if key not in self.file:
+            n_bytes = (img_size[0] * img_size[1] + 7) // 8
+            group = self.file.create_group(key)
+            group.create_dataset(
+                'masks', (n_rows, n_bytes), maxshape=(None, n_bytes),
+                dtype=np.uint8, chunks=(CHUNK_ROWS, n_bytes), compression='lzf')
+            group.create_dataset(
+                'digests', (n_rows,), maxshape=(None,), dtype=np.uint64,
+                chunks=(CHUNK_ROWS * 64,), fillvalue=0)
+        group = self.file[key]
+        if group['digests'].shape[0] != n_rows:
+            # rows past the dataset are dropped, new rows have no mask yet
+            old_rows = group['digests'].shape[0]
+            group['masks'].resize(n_rows, axis=0)
+            group['digests'].resize(n_rows, axis=0)
+            if n_rows > old_rows:
+                group['digests'][old_rows:] = 0
+        return group
+
+
+    def masks(self, images, rows, n_rows, p_type, dist=False, n_workers=None, chunk_size=32, pool=None, mask_scale=1, refine=False, adaptive=False, stats=None):
+        """
+        Returns the leaf masks of images of the dataset, computing and storing
+        the ones that are not cached yet.
+
+        Args:
+            images(numpy.array):    (N, H, W, 3) images of the rows
+            rows(numpy.array):      increasing rows of the images in the dataset
+            n_rows(int):            number of rows of the dataset
+            p_type(int):            type of image preprocessing
+            dist(bool):             option to use distance transformations
+            n_workers(int):         number of processes computing the masks
+            chunk_size(int):        number of images per task
+            pool(WorkerPool):       pool computing the masks, shared by the
+                                    calls of a run, started for this call if None
+            mask_scale(float):      scale of the images the masks are computed on
+            refine(bool):           option to refine the edges of downscaled masks
+            adaptive(bool):         option to skip the watershed on clean masks
+            stats(dict):            receives the stats of mask_batch if given
+        Returns:
+            masks(numpy.array):     (N, H, W) uint8 masks, 1 on the leaves
+            n_cached(int):          number of masks read from the cache
+        """
+        rows = np.asarray(rows)
+        img_size = images.shape[1:3]
+        group = self._group(p_type, dist, img_size, n_rows, mask_scale, refine, adaptive)
+        digests = image_digests(images)
+        hit = group['digests'][rows] == digests if len(rows) else np.zeros(0, bool)
+
+        masks = np.empty(images.shape[:3], dtype=np.uint8)
+        if hit.any():
+            masks[hit] = unpack_masks(group['masks'][rows[hit]], img_size)
+        miss = ~hit
+        if miss.any():
+            masks[miss] = map_batches(
+                mask_batch, images[miss], out_shape=img_size, out_dtype=np.uint8,
+                n_workers=n_workers, chunk_size=chunk_size, desc='Computing masks',
+                pool=pool, stats=stats, p_type=p_type, dist=dist, mask_scale=mask_scale,
+                refine=refine, adaptive=adaptive, with_stats=stats is not None)
+            group['masks'][rows[miss]] = pack_masks(masks[miss])
+            group['digests'][rows[miss]] = digests[miss]
+            self.file.flush()
+        return masks, int(hit.sum())
+
+
+    def close(self):
+        self.file.close()
+
+
+def segment_rows(name, rows, p_option, dist=False, img_size=None, out=None, block_size=512, n_workers=None, mask_scale=1, refine=False, adaptive=False):
+    """
+    Removes the background of rows of an HDF5 dataset with the cached leaf
+    masks, see MaskCache. Only the missing masks are computed, the others are
+    applied to the images as they are read.
+
+    Args:
+        name(str):              path to the HDF5 file (dataset)
+        rows(numpy.array):      increasing rows of the images to segment
+        p_option(str):          type of image preprocessing
+        dist(bool):             option to use distance transformations
+        img_size(tuple):        (height, width) of the images to segment,
+                                the first stored resolution by default
+        out(numpy.array):       array or h5py.Dataset receiving the images
+        block_size(int):        number of images read at once
+        n_workers(int):         number of processes computing the masks
+        mask_scale(float):      scale of the images the masks are computed on
+        refine(bool):           option to refine the edges of downscaled masks
+        adaptive(bool):         option to skip the watershed on clean masks
+    Returns:
+        seg_imgs(numpy.array):  (N, H, W, 3) images with the background removed
+    """
+    rows = np.asarray(rows)
+    n_cached = 0
+    stats = dict() if dist and adaptive else None
+    with h5py.File(name, "r") as file, MaskCache(name) as cache, WorkerPool(n_workers) as pool:
+        images = file[images_key(file, img_size)]
+        if out is None:
+            out = np.empty((len(rows), *images.shape[1:]), dtype=images.dtype)
+        for start in range(0, len(rows), block_size):
+            block_rows = rows[start:start + block_size]
+            block = images[block_rows]
+            masks, n_block = cache.masks(
+                block, block_rows, len(images), int(p_option), dist, pool=pool,
+                mask_scale=mask_scale, refine=refine, adaptive=adaptive, stats=stats)
+            out[start:start + len(block)] = block * masks[..., np.newaxis]
+            n_cached += n_block
+    print(f"{n_cached}/{len(rows)} masks read from {cache.path}")
+    if stats:
+        print(gate_report(stats))
+    return out
+
+
+def _rows_key(file, images, rows, block_size=512):
+    """
+    Returns a hash of the rows of a split and of their content, to detect a
+    changed split or rewritten images on resume. The content is the
+    rows_digest of the dataset, or the hash of the images themselves for
+    the files without digests.
+    """
+    sha = hashlib.blake2b(np.ascontiguousarray(rows, dtype=np.int64), digest_size=8)
+    content = rows_digest(file, rows)
+    if content:
+        sha.update(content.encode())
+    else:
+        for start in range(0, len(rows), block_size):
+            sha.update(image_digests(read_rows(images, rows[start:start + block_size])))
+    return sha.hexdigest()
+
+
+def segment_dataset(name, out_name, p_option, dist=False, img_size=None, block_size=512, n_workers=None, layout='contiguous', chunk_rows=64, compression=None, mask_scale=1, refine=False, adaptive=False):
+    """
+    Streams the split sets of an HDF5 dataset to a new HDF5 file with the
+    background removed, block by block, so that only one block of images is
+    held in memory. The masks come from the MaskCache of the dataset and the
+    missing ones are computed by n_workers processes. The output has the
+    layout of store_hdf5 ('{split}_images' and '{split}_labels').
+
+    Each images dataset records in its 'rows_done' attribute the number of
+    rows written, after every block: an interrupted run resumes where it
+    stopped, unless the parameters, the split or the images of its rows
+    changed (an incremental build rewrites them in place), in which case the
+    split is segmented again from the start, its unchanged masks being
+    read from the cache.
+
+    Args:
+        name(str):              path to the HDF5 file (dataset)
+        out_name(str):          path to the HDF5 file of the segmented images
+        p_option(str):          type of image preprocessing
+        dist(bool):             option to use distance transformations
+        img_size(tuple):        (height, width) of the images to segment,
+                                the first stored resolution by default
+        block_size(int):        number of images read at once
+        n_workers(int):         number of processes computing the masks
+        layout(str):            'contiguous', 'image' or 'batch' chunking
+        chunk_rows(int):        number of images per chunk for 'batch'
+        compression(str):       None, 'gzip' or 'lzf'
+        mask_scale(float):      scale of the images the masks are computed on
+        refine(bool):           option to refine the edges of downscaled masks
+        adaptive(bool):         option to skip the watershed on clean masks,
+                                the paths taken are reported for each split
+    Returns:
+        out_name(str):          path to the HDF5 file of the segmented images
+    """
+    # the processes computing the masks are started once, not for every block
+    with h5py.File(name, "r") as file, h5py.File(out_name, "a") as out_file, \
+            MaskCache(name) as cache, WorkerPool(n_workers) as pool:
+        key = images_key(file, img_size)
+        images = file[key]
+        labels = file[file.attrs['split_label']]
+        params = {'source': os.path.abspath(name), 'source_key': key,
+                  'p_type': int(p_option), 'dist': bool(dist),
+                  'mask_scale': float(mask_scale), 'refine': bool(refine and mask_scale != 1),
+                  'adaptive': bool(adaptive and dist)}
+        if any(out_file.attrs.get(k) != v for k, v in params.items()):
+            # segmented with other parameters, nothing to resume
+            for k in list(out_file.keys()):
+                del out_file[k]
+            out_file.attrs.update(params)
+
+        for split_set in SPLIT_SETS:
+            rows = file[f"{split_set}_idx"][()]
+            rows_key = _rows_key(file, images, rows, block_size)
+            out_key = f"{split_set}_images"
+            if out_key in out_file and out_file[out_key].attrs.get('rows_key') != rows_key:
+                del out_file[out_key]
+            if out_key not in out_file:
+                shape = (len(rows), *images.shape[1:])
+                out_file.create_dataset(out_key, shape, dtype=np.uint8,
+                                        **hdf5_layout(shape, layout, chunk_rows, compression))
+                out_file[out_key].attrs.update({'rows_key': rows_key, 'rows_done': 0})
+                if f"{split_set}_labels" in out_file:
+                    del out_file[f"{split_set}_labels"]
+                out_file.create_dataset(f"{split_set}_labels", data=read_rows(labels, rows),
+                                        dtype=np.uint8)
+
+            out = out_file[out_key]
+            n_done, n_cached = int(out.attrs['rows_done']), 0
+            stats = dict() if dist and adaptive else None
+            if 0 < n_done < len(rows):
+                print(f"{split_set}: resuming at row {n_done}/{len(rows)}")
+            for start in range(n_done, len(rows), block_size):
+                # the cache reads increasing rows, the split order is restored after
+                order = np.argsort(rows[start:start + block_size])
+                block_rows = rows[start:start + block_size][order]
+                block = images[block_rows]
+                masks, n_block = cache.masks(
+                    block, block_rows, len(images), int(p_option), dist, pool=pool,
+                    mask_scale=mask_scale, refine=refine, adaptive=adaptive, stats=stats)
+                out[start:start + len(block)] = (block * masks[..., np.newaxis])[np.argsort(order)]
+                out.attrs['rows_done'] = start + len(block)
+                out_file.flush()
+                n_cached += n_block
+            print(f"{split_set}: {len(rows) - n_done} images segmented, "
+                  f"{n_cached} masks read from {cache.path}")
+            if stats:
+                print(f"{split_set}: {gate_report(stats)}")
+    return out_name
@@ -0,0 +1,134 @@
+import numpy as np
+
+# side of the dHash thumbnail, the hashes are stored and indexed as 64 bits
+HASH_SIZE = 8
+# number of set bits of each byte value
+POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash_batch(images):
+    """
+    Computes the 64 bits difference hash (dHash) of a batch of RGB images.
+    Each image is reduced to a (8, 9) grayscale thumbnail by area averaging,
+    and each bit tells if a pixel is brighter than its left neighbour.
+    Near-identical images get hashes a few bits apart.
+
+    Args:
+        images(numpy.array):    (N, H, W, 3) RGB images
+    Returns:
+        hashes(numpy.array):    (N,) uint64 hashes
+    """
+    images = np.asarray(images)
+    gray = images @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    h, w = gray.shape[1:]
+    row_edges = np.linspace(0, h, HASH_SIZE + 1).astype(int)[:-1]
+    col_edges = np.linspace(0, w, HASH_SIZE + 2).astype(int)[:-1]
+    # area averaging over the bins of every image of the batch at once
+    thumbs = np.add.reduceat(np.add.reduceat(
+        gray, row_edges, axis=1), col_edges, axis=2)
+    counts = np.outer(np.diff([*row_edges, h]), np.diff([*col_edges, w]))
+    thumbs /= counts
+    bits = thumbs[:, :, 1:] > thumbs[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(images), -1), axis=1)
+    return packed.view('>u8').ravel().astype(np.uint64)
+
+
+def hamming_distance(hash, hashes):
+    """ Returns the number of differing bits between a hash and an array of hashes. """
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(hash))
+    return POPCOUNT_LUT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class DuplicateIndex():
+    """
+    Index grouping near-duplicate images from their perceptual hashes.
+
+    Hashes are split in n_bands bands and bucketed by band value. Two hashes
+    at most max_distance bits apart, with max_distance < n_bands, share at
+    least one band, so only the images of the same buckets are compared
+    instead of all the pairs.
+
+    Attributes:
+        max_distance (int): maximum hamming distance between duplicates
+        n_bands (int): number of bands the hashes are split in
+    """
+
+    def __init__(self, max_distance=3, n_bands=4):
+        if max_distance >= n_bands:
+            raise ValueError("max_distance must be lower than n_bands")
+        self.max_distance = max_distance
+        self.n_bands = n_bands
+        self.band_bits = 64 // n_bands
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.parents = []
+        self.buckets = [dict() for _ in range(n_bands)]
+
+
+    def __len__(self):
+        return len(self.parents)
+
+
+    def _find(self, i):
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+
+    def _union(self, i, j):
+        root_i, root_j = self._find(i), self._find(j)
+        if root_i != root_j:
+            # the oldest image stays the representative of the group
+            self.parents[max(root_i, root_j)] = min(root_i, root_j)
+
+
+    def add(self, hashes):
+        """
+        Adds a batch of hashes to the index and links them to their
+        near-duplicates.
+
+        Args:
+            hashes(numpy.array):    (N,) uint64 hashes
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        start = len(self)
+        self.hashes = np.concatenate([self.hashes, hashes])
+        mask = np.uint64((1 << self.band_bits) - 1)
+        bands = [(hashes >> np.uint64(k * self.band_bits)) & mask
+                 for k in range(self.n_bands)]
+        for i in range(len(hashes)):
+            idx = start + i
+            self.parents.append(idx)
+            candidates = set()
+            for k in range(self.n_bands):
+                bucket = self.buckets[k].setdefault(int(bands[k][i]), [])
+                candidates.update(bucket)
+                bucket.append(idx)
+            if candidates:
+                candidates = np.fromiter(candidates, dtype=np.int64)
+                dist = hamming_distance(self.hashes[idx], self.hashes[candidates])
+                for j in candidates[dist <= self.max_distance]:
+                    self._union(idx, int(j))
+
+
+    def groups(self):
+        """
+        Returns the group of each image, the row of its representative (the
+        first added image of the group).
+        """
+        return np.array([self._find(i) for i in range(len(self))], dtype=np.int64)
+
+
+def duplicate_groups(hashes, max_distance=3):
+    """ Returns the near-duplicate group of each hash, see DuplicateIndex. """
+    index = DuplicateIndex(max_distance)
+    index.add(hashes)
+    return index.groups()
+
+
+def expand_groups(rows, groups):
+    """
+    Returns the rows belonging to the groups of the given rows, so that a
+    split made on the group representatives keeps each group together.
+    """
+    return np.flatnonzero(np.isin(groups, groups[rows]))
@@ -7,10 +7,10 @@ import logging
 import pandas as pd
 import tensorflow as tf
 from datasets import load_from_disk
-from transformers import DefaultDataCollator, AdamWeightDecay
+from transformers import AdamWeightDecay
 from train_framework.utils import set_seed, set_logging, parse_args
 from train_framework.prep_data_train import load_split_hdf5
-from train_framework.preprocess_tensor import prep_ds_input
+from train_framework.preprocess_tensor import prep_ds_input, transformer_dataset
 from train_framework.metrics import compute_training_metrics, f1_m, matt_coeff, precision_m, recall_m
 from train_framework.models import LayerScale
 from train_framework.custom_inception_model import CopyChannels
@@ -127,15 +127,18 @@ def main():
         ds_path = 'resources/datasets/segm_disease_60343_ds_128.h5'
 
     elif args.xp_dir == 'resources/best_models/transformers/VIT':
-        ds_path = "../block_storage/transformers/vit"
+        ds_path = "../block_storage/transformers/uint8"
+        args.feature_extractor = 'vit'
         args.transformer = True
 
     elif args.xp_dir == 'resources/best_models/transformers/ConvNexT':
-        ds_path = "../block_storage/transformers/convnext"
+        ds_path = "../block_storage/transformers/uint8"
+        args.feature_extractor = 'convnext'
         args.transformer = True
 
     elif args.xp_dir == 'resources/best_models/transformers/Swin':
-        ds_path = "../block_storage/transformers/swin"
+        ds_path = "../block_storage/transformers/uint8"
+        args.feature_extractor = 'swin'
         args.transformer = True
 
     if args.class_type == 'healthy':
@@ -166,13 +169,8 @@ def main():
     if args.transformer:
         test_set = load_from_disk(f'{ds_path}/test')
         args.len_test = test_set.num_rows
-        data_collator = DefaultDataCollator(return_tensors="tf")
-        test_set = test_set.to_tf_dataset(
-            columns=['pixel_values'],
-            label_cols=["labels"],
-            shuffle=True,
-            batch_size=32,
-            collate_fn=data_collator)
+        test_set = transformer_dataset(
+            test_set, args.feature_extractor, segment=getattr(args, 'online_segmentation', False))
     else:
         # Load the dataset
         X_test, y_test = load_split_hdf5(ds_path, 'test')
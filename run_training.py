@@ -8,12 +8,11 @@ import tensorflow as tf
 import math
 import json
 from datasets import load_from_disk
-from transformers import DefaultDataCollator
 from train_framework.metrics import compute_training_metrics, f1_m
 from train_framework.models import get_models
 from train_framework.utils import set_logging, set_seed, set_wandb_project_run, parse_args
-from train_framework.prep_data_train import load_split_hdf5
-from train_framework.preprocess_tensor import prep_ds_input
+from train_framework.prep_data_train import load_split_hdf5, HDF5Split
+from train_framework.preprocess_tensor import prep_ds_input, hdf5_split_dataset, get_train_stats, transformer_dataset
 from train_framework.custom_loss import poly_loss, poly1_cross_entropy_label_smooth
 from train_framework.train import generate_class_weights, train_model
 
@@ -34,6 +33,12 @@ def main():
         raise ValueError(
             f"Output directory ({args.output_dir}) already exists and is not empty. Use --overwrite_output_dir to overcome.")
 
+    # the stats cached in the dataset are those of the unsegmented images
+    if (getattr(args, 'online_segmentation', False) and not args.transformer
+            and (getattr(args, 'mean_arr', None) is None or getattr(args, 'std_arr', None) is None)):
+        raise ValueError(
+            "online_segmentation requires mean_arr and std_arr, set them to the stats of the segmented images (dumped by the cli).")
+
     # set logging
     set_logging(args)
     # set seed
@@ -101,48 +106,55 @@ def main():
     if args.transformer:
         args.input_shape = [224, 224, 3]
         args.label2id = {v: k for k, v in args.id2label.items()}
-        if args.feature_extractor == "vit":
-            ds_path = "../block_storage/transformers/vit"
-        elif args.feature_extractor == "swin":
-            ds_path = "../block_storage/transformers/swin"
-        elif args.feature_extractor in ["convnext", "cvt"]:
-            ds_path = "../block_storage/transformers/convnext"
+        # one uint8 dataset for all the backbones, preprocessed per batch
+        ds_path = "../block_storage/transformers/uint8"
 
         train_set = load_from_disk(f'{ds_path}/train')
         valid_set = load_from_disk(f'{ds_path}/valid')
-        data_collator = DefaultDataCollator(return_tensors="tf")
 
         y_train = train_set['labels']
         args.len_train = train_set.num_rows
         args.len_valid = valid_set.num_rows
 
-        train_set = train_set.to_tf_dataset(
-            columns=['pixel_values'],
-            label_cols=["labels"],
-            shuffle=True,
-            batch_size=32,
-            collate_fn=data_collator
-        )
-        valid_set = valid_set.to_tf_dataset(
-            columns=['pixel_values'],
-            label_cols=["labels"],
-            shuffle=True,
-            batch_size=32,
-            collate_fn=data_collator
-        )
+        segment = getattr(args, 'online_segmentation', False)
+        train_set = transformer_dataset(train_set, args.feature_extractor, segment=segment)
+        valid_set = transformer_dataset(valid_set, args.feature_extractor, segment=segment)
+
+    elif args.input_pipeline == 'hdf5_stream':
+        # Stream the split sets from the dataset, memory is bounded by the buffers
+        assert os.path.isfile(args.dataset)
+        img_size = tuple(args.input_shape[0:2])
+        with HDF5Split(args.dataset, 'train') as split:
+            y_train = split.labels
+            args.len_train = len(split)
+        with HDF5Split(args.dataset, 'valid') as split:
+            args.len_valid = len(split)
+        train_set = hdf5_split_dataset(
+            args.dataset, 'train', args.stream_block_size, args.shuffle_buffer,
+            seed=args.seed, img_size=img_size)
+        valid_set = hdf5_split_dataset(
+            args.dataset, 'valid', args.stream_block_size, shuffle=False, img_size=img_size)
 
     else:
         # Load the dataset
         assert os.path.isfile(args.dataset)
-        X_train, y_train = load_split_hdf5(args.dataset, 'train')
-        X_valid, y_valid = load_split_hdf5(args.dataset, 'valid')
+        X_train, y_train = load_split_hdf5(
+            args.dataset, 'train', tuple(args.input_shape[0:2]))
+        X_valid, y_valid = load_split_hdf5(
+            args.dataset, 'valid', tuple(args.input_shape[0:2]))
         train_set = tf.data.Dataset.from_tensor_slices((X_train, y_train))
-        valid_set = tf.data.Dataset.from_tensor_slices((X_train, y_train))
+        valid_set = tf.data.Dataset.from_tensor_slices((X_valid, y_valid))
         args.len_train = len(X_train)
         args.len_valid = len(X_valid)
         del X_train, X_valid, y_valid
         gc.collect()
 
+    # Normalization stats cached in the dataset, unless set in the config
+    if not args.transformer and getattr(args, 'mean_arr', None) is None:
+        args.mean_arr, args.std_arr = get_train_stats(
+            args.dataset, tuple(args.input_shape[0:2]))
+        logger.info(f"  Train mean = {args.mean_arr}, std = {args.std_arr}")
+
     # Set class weights for imbalanced dataset
     if args.class_weights:
         class_weights = generate_class_weights(y_train, args.class_type)
@@ -209,13 +221,7 @@ def main():
                 args.input_shape = (3, 224, 224)
                 test_set = load_from_disk(f'{ds_path}/test')
                 args.len_test = test_set.num_rows
-                data_collator = DefaultDataCollator(return_tensors="tf")
-                test_set = test_set.to_tf_dataset(
-                    columns=['pixel_values'],
-                    label_cols=["labels"],
-                    shuffle=True,
-                    batch_size=32,
-                    collate_fn=data_collator)
+                test_set = transformer_dataset(test_set, args.feature_extractor, segment=segment)
             else:
                 X_test, y_test = load_split_hdf5(ds_path, 'test')
                 args.len_test = len(X_test)
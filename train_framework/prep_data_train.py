@@ -2,36 +2,126 @@ import h5py
 import numpy as np
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
+from cli.dataset_builder import LazyRows, images_key, rows_digest
+from cli.dataset_stats import stats_key
 from train_framework.utils import bcolors, logging
 
 logger = logging.getLogger(__name__)
 
 
-def load_hdf5(name, class_label):
+def _open_images(file, key, mmap=True):
+    """
+    Returns the images dataset, memory mapped when it is stored contiguous
+    and uncompressed so that concurrent reads do not go through h5py.
+    """
+    dataset = file[key]
+    if mmap and dataset.chunks is None and dataset.compression is None:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(file.filename, dtype=dataset.dtype, mode='r',
+                             offset=offset, shape=dataset.shape)
+    return dataset
+
+
+class HDF5Split():
+    """
+    Read-only handle on a split set of an HDF5 dataset, giving lazy views on
+    its images. Use it as a context manager so that the file gets closed.
+
+    Both layouts are handled: '{split}_images' / '{split}_labels' datasets,
+    and images datasets with '{split}_idx' row indices. Multi-resolution
+    datasets are read at img_size, a KeyError is raised when it is not
+    stored; a ValueError is raised when the images of a '{split}_images'
+    dataset do not have that size.
+
+    Attributes:
+        name (str): path to the HDF5 file (dataset)
+        split_set (str): 'train', 'valid' or 'test'
+        img_size (tuple): (height, width) of the images to read
+        images (LazyRows): lazy view on the images of the split
+        labels (numpy.array): labels of the split
+    """
+
+    def __init__(self, name, split_set, mmap=True, img_size=None):
+        if split_set not in ['train', 'valid', 'test']:
+            raise ValueError(f'Split set {split_set} not found')
+        self.name = name
+        self.split_set = split_set
+        self.file = h5py.File(f"{name}", "r")
+        try:
+            if f"/{split_set}_idx" in self.file:
+                idx = self.file[f"/{split_set}_idx"][()]
+                label_key = f"/{self.file.attrs['split_label']}"
+                self.images_key = images_key(self.file, img_size)
+                self.images = LazyRows(_open_images(
+                    self.file, self.images_key, mmap), idx)
+                self.labels = self.file[label_key][()][idx]
+            else:
+                self.images_key = f"/{split_set}_images"
+                shape = self.file[self.images_key].shape
+                if img_size is not None and tuple(shape[1:3]) != tuple(img_size):
+                    raise ValueError(f"{split_set} images of {name} are {shape[1]}x{shape[2]}, "
+                                     f"not {img_size[0]}x{img_size[1]}")
+                self.images = LazyRows(_open_images(
+                    self.file, self.images_key, mmap))
+                self.labels = self.file[f"/{split_set}_labels"][()]
+        except Exception:
+            self.file.close()
+            raise
+
+
+    def __len__(self):
+        return len(self.images)
+
+
+    def cached_stats(self):
+        """
+        Returns the per-channel (mean, std) of the split cached in the dataset
+        by the cli (dataset_stats.split_stats), None when they are missing or
+        were computed on another split or other images.
+        """
+        attrs = self.file[self.images_key].attrs
+        rows, content = self.images.indices, ''
+        if rows is None:
+            rows = np.arange(len(self))
+        else:
+            content = rows_digest(self.file, rows)
+        if attrs.get(f"{self.split_set}_stats_key") != stats_key(rows, self.labels, content):
+            return None
+        return attrs[f"{self.split_set}_mean"], attrs[f"{self.split_set}_std"]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        self.images = None
+        self.file.close()
+
+
+def load_hdf5(name, class_label, img_size=None):
     """
     Reads image from HDF5.
 
     Args:
         name(str):              path to the HDF5 file (dataset)
         class_label(str):       type of classification
+        img_size(tuple):        (height, width) of the images to read
     Returns:
         images(numpy.array):    images array, (N, 256, 256, 3) to be stored
         labels(numpy.array):    labels array, (N,) to be stored
     """
-    images, labels = [], []
-    # Open the HDF5 file
-    file = h5py.File(f"{name}", "r+")
-    # images are stored as uint8 -> 0-255
-    images = np.array(file["/images"]).astype(np.uint8)
-
-    if class_label == 'healthy':
-        labels = np.array(file["/healthy"]).astype(np.uint8)
-    elif class_label == 'plant':
-        labels = np.array(file["/plant"]).astype(np.uint8)
-    elif class_label == 'disease':
-        labels = np.array(file["/disease"]).astype(np.uint8)
-    elif class_label == 'gen_disease':
-        labels = np.array(file["/gen_disease"]).astype(np.uint8)
+    if class_label not in ['plant', 'disease', 'healthy', 'gen_disease']:
+        raise ValueError(f'Classification {class_label} not found')
+    # Open the HDF5 file read-only, images are stored as uint8 -> 0-255
+    with h5py.File(f"{name}", "r") as file:
+        images = file[images_key(file, img_size)][()]
+        labels = file[f"/{class_label}"][()]
     return images, labels
 
 
@@ -57,34 +147,33 @@ def prepare_categorical_targets(y_train, y_valid, y_test):
     return y_train_enc, y_valid_enc, y_test_enc, le
 
 
-def get_split_sets(args, images, labels, logger):
+def get_split_sets(args, labels, logger, rows=None):
     """
-    Prepare the inputs and target split sets for a given classification.
+    Prepare the stratified split sets for a given classification. Only the
+    row indices are split, the images are not copied.
 
     Args:
         args(ArgumentParser): Object that holds multiple training parameters
-        images(numpy.array): images array
-        labels(numpy.array): label array
+        labels(numpy.array): label of each row
         logger():
+        rows(numpy.array): rows of the dataset to split, all if None
     Returns:
-        X_splits(list): list containing the images split sets
-        y_splits(list): list containing the labels split sets
+        idx_splits(list): increasing rows of the train, valid and test sets
     """
-
+    rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
+    pos = np.arange(len(rows))
     # Split train, valid, test
-    X_train, X_tmp, y_train, y_tmp = train_test_split(
-        images, labels, test_size=0.20, stratify=labels, random_state=args.seed)
-    X_valid, X_test, y_valid, y_test = train_test_split(
-        X_tmp, y_tmp, test_size=0.50, stratify=y_tmp, random_state=args.seed)
-
-    del X_tmp
-    del y_tmp
-    label_split_lst = list([y_train, y_valid, y_test])
+    pos_train, pos_tmp = train_test_split(
+        pos, test_size=0.20, stratify=labels, random_state=args.seed)
+    pos_valid, pos_test = train_test_split(
+        pos_tmp, test_size=0.50, stratify=labels[pos_tmp], random_state=args.seed)
+
+    pos_splits = [np.sort(pos_train), np.sort(pos_valid), np.sort(pos_test)]
     name_lst = list(['Train', 'Valid', 'Test'])
 
     # Display counts for unique values in each set
-    for value, d_set in zip(label_split_lst, name_lst):
-        (unique, cnt) = np.unique(value, return_counts=True)
+    for split_pos, d_set in zip(pos_splits, name_lst):
+        (unique, cnt) = np.unique(labels[split_pos], return_counts=True)
         logger.info(f"  {d_set} Labels:")
         for name, counts in zip(unique, cnt):
             logger.info(f"    {name} = {counts}")
@@ -92,38 +181,24 @@ def get_split_sets(args, images, labels, logger):
             logger.info(f"  Ratio Healthy = {cnt[0]/(cnt[0]+cnt[1])}")
             logger.info(f"  Ratio Sick = {cnt[1]/(cnt[0]+cnt[1])}\n")
 
-    if args.class_type == 'healthy':
-        y_train = y_train[:, np.newaxis]
-        y_valid = y_valid[:, np.newaxis]
-        y_test = y_test[:, np.newaxis]
-
-    return [X_train, X_valid, X_test], label_split_lst
+    return [rows[split_pos] for split_pos in pos_splits]
 
 
-def load_split_hdf5(name, split_set):
+def load_split_hdf5(name, split_set, img_size=None):
     """
     Reads image from HDF5.
 
     Args:
         name(str):              path to the HDF5 file (dataset)
-        split_set(str):       type of classification
+        split_set(str):         'train', 'valid' or 'test'
+        img_size(tuple):        (height, width) of the images to read
     Returns:
-        images(numpy.array):    images array, (N, 256, 256, 3) to be stored
-        labels(numpy.array):    labels array, (N,) to be stored
+        images(numpy.array):    images array, (N, H, W, 3)
+        labels(numpy.array):    labels array, (N,)
     """
-    images, labels = [], []
-    # Open the HDF5 file
-    file = h5py.File(f"{name}", "r+")
-
-    if split_set == 'train':
-        images = np.array(file["/train_images"]).astype(np.uint8)
-        labels = np.array(file["/train_labels"]).astype(np.uint8)
-    elif split_set == 'valid':
-        images = np.array(file["/valid_images"]).astype(np.uint8)
-        labels = np.array(file["/valid_labels"]).astype(np.uint8)
-    elif split_set == 'test':
-        images = np.array(file["/test_images"]).astype(np.uint8)
-        labels = np.array(file["/test_labels"]).astype(np.uint8)
+    with HDF5Split(name, split_set, img_size=img_size) as split:
+        images = split.images[:]
+        labels = split.labels
     return images, labels
 
 
@@ -131,6 +206,11 @@ def get_relevant_datasets(args, logger):
     """
     Get the relevant datasets for a given label.
 
+    The dataset is only read: the split stored by the cli (train, valid and
+    test row indices) is used as is, since the training stats were computed
+    on it, and a ValueError is raised when it was made for another label
+    type. Datasets without a stored split are split in memory.
+
     Args:
         args(ArgumentParser): Object that holds multiple training parameters
         logger():
@@ -139,19 +219,40 @@ def get_relevant_datasets(args, logger):
         y_splits(list): list containing the labels split sets
         n_classes(int): number of unique class in the dataset
     """
-    images, labels = load_hdf5(args.dataset, args.class_type)
-
     if args.class_type not in ['plant', 'disease', 'healthy', 'gen_disease']:
         raise ValueError(f'Classification {args.class_type} not found')
-    else:
-        (unique_labels, cnt) = np.unique(labels, return_counts=True)
-        n_classes = len(unique_labels)
-        for name, counts in zip(unique_labels, cnt):
-            print(
-                f"{bcolors.OKBLUE}{name}{bcolors.ENDC} = {bcolors.OKGREEN}{counts}{bcolors.ENDC}")
-        if args.class_type == 'healthy':
-            logger.info(f"  Ratio Healthy = {cnt[0]/(cnt[0]+cnt[1])}")
-            logger.info(f"  Ratio Sick = {cnt[1]/(cnt[0]+cnt[1])}\n")
+    img_size = tuple(args.input_shape[0:2])
+    with h5py.File(f"{args.dataset}", "r") as file:
+        labels = file[f"/{args.class_type}"][()]
+        has_split = "/train_idx" in file
+        split_label = file.attrs.get('split_label')
+        split_seed = file.attrs.get('split_seed')
+    (unique_labels, cnt) = np.unique(labels, return_counts=True)
+    n_classes = len(unique_labels)
+    for name, counts in zip(unique_labels, cnt):
+        print(
+            f"{bcolors.OKBLUE}{name}{bcolors.ENDC} = {bcolors.OKGREEN}{counts}{bcolors.ENDC}")
+    if args.class_type == 'healthy':
+        logger.info(f"  Ratio Healthy = {cnt[0]/(cnt[0]+cnt[1])}")
+        logger.info(f"  Ratio Sick = {cnt[1]/(cnt[0]+cnt[1])}\n")
 
-        X_splits, y_splits = get_split_sets(args, images, labels, logger)
-        return X_splits, y_splits, n_classes
+    X_splits, y_splits = [], []
+    if has_split:
+        if split_label != args.class_type:
+            raise ValueError(f"The split of {args.dataset} was made on {split_label} labels, "
+                             f"not {args.class_type}: rebuild it with the cli")
+        if split_seed is not None and split_seed != args.seed:
+            logger.warning(f"  Using the split of {args.dataset} made with seed {split_seed}")
+        for split_set in ['train', 'valid', 'test']:
+            with HDF5Split(args.dataset, split_set, img_size=img_size) as split:
+                X_splits.append(split.images[:])
+                y_splits.append(split.labels)
+    else:
+        with h5py.File(f"{args.dataset}", "r") as file:
+            images = LazyRows(file[images_key(file, img_size)])
+            for rows in get_split_sets(args, labels, logger):
+                X_splits.append(images[rows])
+                y_splits.append(labels[rows])
+    if args.class_type == 'healthy':
+        y_splits = [labels[:, np.newaxis] for labels in y_splits]
+    return X_splits, y_splits, n_classes
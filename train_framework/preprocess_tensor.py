@@ -1,25 +1,69 @@
+import os
+import json
 import tensorflow as tf
+import numpy as np
 import multiprocessing
 import matplotlib.pyplot as plt
 from keras import backend as K
+from train_framework.prep_data_train import HDF5Split
+from train_framework.tf_segmentation import segmentation_map
 
 
 @tf.function
-def get_mean_std(train_set):
+def block_moments(block):
+    """ Per-channel pixel count, mean and sum of squared deviations of a block. """
+    block = tf.cast(block, tf.float64)
+    count = tf.cast(tf.reduce_prod(tf.shape(block)[:-1]), tf.float64)
+    mean = tf.math.reduce_mean(block, [0, 1, 2])
+    m2 = tf.math.reduce_sum(tf.math.squared_difference(block, mean), [0, 1, 2])
+    return count, mean, m2
+
+
+def get_mean_std(train_set, block_size=512):
     """
     Calculate metric on the training set for normalization/image processing.
     These metrics are the mean and the standard deviation for each
     color channel (RGB).
-    """
 
-    train_set = tf.cast(train_set, tf.float64)
-    tf_std = tf.math.reduce_std(train_set, [0, 1, 2])
-    tf_mean = tf.math.reduce_mean(train_set, [0, 1, 2])
+    The set is read in blocks (an array, an HDF5Split images view...) whose
+    moments are merged (parallel Welford), so only one block is cast to
+    float64 at a time.
+    """
+    count, mean, m2 = 0., 0., 0.
+    for start in range(0, len(train_set), block_size):
+        n, block_mean, block_m2 = block_moments(
+            train_set[start:start + block_size])
+        total = count + n
+        delta = block_mean - mean
+        mean = mean + delta * n / total
+        m2 = m2 + block_m2 + delta**2 * count * n / total
+        count = total
+    tf_mean, tf_std = mean, tf.math.sqrt(m2 / count)
     tf.print(f"TRAIN MEAN (TF): {tf_mean}")
     tf.print(f"TRAIN STD (TF): {tf_std}")
     return tf_mean, tf_std
 
 
+def get_train_stats(name, img_size=None):
+    """
+    Per-channel mean and std of the train split of an HDF5 dataset, read from
+    the cache written by the cli, computed in blocks otherwise.
+
+    Args:
+        name(str):              path to the HDF5 file (dataset)
+        img_size(tuple):        (height, width) of the images to use
+    Returns:
+        mean(list):             mean of each channel
+        std(list):              std of each channel
+    """
+    with HDF5Split(name, 'train', img_size=img_size) as split:
+        stats = split.cached_stats()
+        if stats is None:
+            stats = get_mean_std(split.images)
+        mean, std = [np.asarray(arr).tolist() for arr in stats]
+    return mean, std
+
+
 @tf.function
 def resize_img(img, label, size):
     """ Resize an image to the give size """
@@ -43,11 +87,75 @@ def to_vector(img, label):
     return img, label
 
 
+# Resize and normalization of the HuggingFace image processor of each
+# backbone, applied at read time on the shared uint8 transformer dataset
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+TRANSFORMER_PREPROCESSING = {
+    'vit': {'size': 224, 'crop_pct': None, 'method': 'bilinear',
+            'mean': [0.5, 0.5, 0.5], 'std': [0.5, 0.5, 0.5]},
+    'swin': {'size': 224, 'crop_pct': None, 'method': 'bicubic',
+             'mean': IMAGENET_MEAN, 'std': IMAGENET_STD},
+    'convnext': {'size': 224, 'crop_pct': 0.875, 'method': 'bicubic',
+                 'mean': IMAGENET_MEAN, 'std': IMAGENET_STD},
+    'cvt': {'size': 224, 'crop_pct': 0.875, 'method': 'bicubic',
+            'mean': IMAGENET_MEAN, 'std': IMAGENET_STD},
+}
+
+
+def transformer_preprocessing(images, backbone):
+    """
+    Vectorized equivalent of the HuggingFace image processor of a backbone
+    on a batch of uint8 images: resize (to size / crop_pct then center crop
+    when the processor crops), rescale to [0, 1], normalize, and move the
+    channels first.
+
+    Args:
+        images(tf.Tensor):      (N, H, W, 3) uint8 images
+        backbone(str):          'vit', 'swin', 'convnext' or 'cvt'
+    Returns:
+        pixel_values(tf.Tensor): (N, 3, size, size) float32 images
+    """
+    cfg = TRANSFORMER_PREPROCESSING[backbone]
+    size = cfg['size']
+    images = tf.cast(images, tf.float32) / 255.
+    if cfg['crop_pct']:
+        resize = int(size / cfg['crop_pct'])
+        images = tf.image.resize(images, [resize, resize], method=cfg['method'])
+        offset = (resize - size) // 2
+        images = images[:, offset:offset + size, offset:offset + size]
+    elif images.shape[1:3] != (size, size):
+        images = tf.image.resize(images, [size, size], method=cfg['method'])
+    images = (images - tf.constant(cfg['mean'])) / tf.constant(cfg['std'])
+    return tf.transpose(images, [0, 3, 1, 2])
+
+
+def transformer_dataset(hf_ds, backbone, batch_size=32, shuffle=True, segment=False):
+    """
+    Reads a uint8 transformer dataset (see cli create_transformer_ds) as a
+    batched tf.data.Dataset of (pixel_values, labels), the preprocessing of
+    the backbone being applied per batch, after the leaf segmentation with
+    segment.
+    """
+    ds = hf_ds.to_tf_dataset(
+        columns='img', label_cols='labels', shuffle=shuffle, batch_size=batch_size)
+    if segment:
+        ds = ds.map(segmentation_map, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.map(lambda images, labels: (transformer_preprocessing(images, backbone), labels),
+                  num_parallel_calls=tf.data.AUTOTUNE)
+
+
 def prep_ds_input(args, ds, set_len, size):
     """ Preprocssing function that maps the relevant preprocessing steps. """
     N_CPUS = multiprocessing.cpu_count()
     if args.transformer:
         ds = ds.prefetch(tf.data.AUTOTUNE)
+    elif getattr(args, 'online_segmentation', False):
+        # segment whole batches in the graph, on the images before the resize
+        ds = ds.batch(args.batch_size).map(segmentation_map, num_parallel_calls=N_CPUS)
+        ds = ds.map(lambda elem, label: prep_inputs_and_labels(
+                    elem, label, args.n_classes, size), num_parallel_calls=N_CPUS)
+        ds = ds.prefetch(tf.data.AUTOTUNE)
     else:
         ds = ds.map(lambda elem, label: prep_inputs_and_labels(
                     elem, label, args.n_classes, size), num_parallel_calls=N_CPUS)
@@ -55,6 +163,124 @@ def prep_ds_input(args, ds, set_len, size):
     return ds
 
 
+def hdf5_split_dataset(name, split_set, block_size=256, shuffle_buffer=2048, shuffle=True, n_readers=None, seed=None, img_size=None):
+    """
+    Streams a split set of an HDF5 dataset as a tf.data.Dataset of
+    (image, label) elements, like from_tensor_slices but without loading
+    the split in memory.
+
+    Blocks of rows of the split (stored shuffled) are read in a shuffled
+    order by parallel readers, then their images are shuffled through a bounded buffer. Memory
+    use is bounded by block_size * n_readers + shuffle_buffer images.
+    Each reader opens its own handle on the file for one pass and closes it
+    at the end of the pass, so no handle outlives the iteration.
+
+    Args:
+        name(str):              path to the HDF5 file (dataset)
+        split_set(str):         'train', 'valid' or 'test'
+        block_size(int):        number of consecutive rows read at once
+        shuffle_buffer(int):    number of images in the shuffle buffer
+        shuffle(bool):          option to shuffle the blocks and the images
+        n_readers(int):         number of parallel readers (defaults to the cpu count)
+        seed(int):              seed of the shuffling
+        img_size(tuple):        (height, width) of the images to read
+    Returns:
+        ds(tf.data.Dataset):    dataset of (image, label) elements
+    """
+    n_readers = n_readers or multiprocessing.cpu_count()
+    with HDF5Split(name, split_set, img_size=img_size) as split:
+        img_shape = split.images.shape[1:]
+        n_rows = len(split)
+
+    def read_blocks(starts):
+        # each reader opens its own handle, closed at the end of the pass
+        with HDF5Split(name, split_set, img_size=img_size) as split:
+            for start in starts:
+                stop = int(start) + block_size
+                yield (split.images[int(start):stop].astype(np.uint8, copy=False),
+                       split.labels[int(start):stop].astype(np.uint8, copy=False))
+
+    signature = (tf.TensorSpec([None, *img_shape], tf.uint8),
+                 tf.TensorSpec([None], tf.uint8))
+    starts = np.arange(0, n_rows, block_size)
+    ds = tf.data.Dataset.from_tensor_slices(starts)
+    if shuffle:
+        ds = ds.shuffle(len(starts), seed=seed, reshuffle_each_iteration=True)
+    # split the blocks of the pass between the readers
+    ds = ds.batch(max(1, -(-len(starts) // n_readers)))
+    ds = ds.interleave(
+        lambda starts: tf.data.Dataset.from_generator(
+            read_blocks, output_signature=signature, args=(starts,)),
+        cycle_length=n_readers, num_parallel_calls=n_readers,
+        deterministic=not shuffle)
+    ds = ds.unbatch()
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed,
+                        reshuffle_each_iteration=True)
+    return ds
+
+
+def shards_dataset(index_path, split_set, shuffle=True, cycle_length=None, seed=None):
+    """
+    Reads the shards of a split set exported by export_shards (TFRecord or
+    npy) as a tf.data.Dataset of (image, label) elements. Shards are read
+    in parallel with interleave, so I/O parallelism scales with the number
+    of cores and files.
+
+    Args:
+        index_path(str):        path to the index.json file of the shards
+        split_set(str):         'train', 'valid' or 'test'
+        shuffle(bool):          option to shuffle the order of the shards
+        cycle_length(int):      number of shards read concurrently (defaults to the cpu count)
+        seed(int):              seed of the shuffling
+    Returns:
+        ds(tf.data.Dataset):    dataset of (image, label) elements
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+    shard_dir = os.path.dirname(index_path)
+    img_shape = index['img_shape']
+    shards = index['splits'][split_set]
+    cycle_length = cycle_length or multiprocessing.cpu_count()
+
+    if index['format'] == 'tfrecord':
+        features = {
+            'image': tf.io.FixedLenFeature([], tf.string),
+            'label': tf.io.FixedLenFeature([], tf.int64),
+        }
+
+        def parse(record):
+            example = tf.io.parse_single_example(record, features)
+            image = tf.reshape(tf.io.decode_raw(
+                example['image'], tf.uint8), img_shape)
+            return image, tf.cast(example['label'], tf.uint8)
+
+        def read_shard(files):
+            return tf.data.TFRecordDataset(files[0]).map(parse)
+
+    else:
+        def load_npy(img_file, label_file):
+            return (np.load(img_file.decode(), mmap_mode='r')[:],
+                    np.load(label_file.decode()))
+
+        def read_shard(files):
+            images, labels = tf.numpy_function(
+                load_npy, [files[0], files[1]], [tf.uint8, tf.uint8])
+            images.set_shape([None, *img_shape])
+            labels.set_shape([None])
+            return tf.data.Dataset.from_tensors((images, labels)).unbatch()
+
+    files = [[os.path.join(shard_dir, shard['images']),
+              os.path.join(shard_dir, shard.get('labels', ''))] for shard in shards]
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        ds = ds.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.interleave(read_shard, cycle_length=cycle_length,
+                       num_parallel_calls=tf.data.AUTOTUNE,
+                       deterministic=not shuffle)
+    return ds
+
+
 def preprocess_image(tensor_img, mean_arr, std_arr, mode='centering'):
     """Preprocesses a Numpy array encoding a batch of images.
     Args:
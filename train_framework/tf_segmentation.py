@@ -0,0 +1,240 @@
+import numpy as np
+import tensorflow as tf
+from cli.image_preprocessing import WHITE_LEVEL
+from cli.leaf_segmentation import (HSV_GREEN, HSV_RED, HSV_ORANGE, HSV_BROWN, HSV_RED_BROWN,
+                                   HSV_WHITE, DISEASE_CLOSE_ITERATIONS, hsv_bounds)
+
+# structuring elements as unions of centered (height, width) rectangles, so that
+# the binary morphology runs on max pooling
+# 5x5 ellipse of cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)):
+# the 3 middle rows and the middle column
+ELLIPSE_5X5 = [(3, 5), (5, 1)]
+SQUARE_3X3 = [(3, 3)]
+# 4-connected neighbourhood, background pixels reach each other through it
+CROSS_3X3 = [(3, 1), (1, 3)]
+
+# kernels used by OpenCV for the small kernel sizes when sigma is not given
+SMALL_GAUSSIAN_KERNELS = {1: [1.], 3: [0.25, 0.5, 0.25],
+                          5: [0.0625, 0.25, 0.375, 0.25, 0.0625],
+                          7: [0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125]}
+
+
+def gaussian_kernel(ksize=5, sigma=None):
+    """ 1D gaussian kernel, as cv2.getGaussianKernel(ksize, sigma or 0). """
+    if sigma is None and ksize in SMALL_GAUSSIAN_KERNELS:
+        return np.array(SMALL_GAUSSIAN_KERNELS[ksize], dtype=np.float32)
+    if sigma is None:
+        sigma = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+    x = np.arange(ksize, dtype=np.float64) - (ksize - 1) / 2
+    kernel = np.exp(-x**2 / (2 * sigma**2))
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def gaussian_blur(images, ksize=5, sigma=None):
+    """
+    Separable gaussian blur of a batch of images, with the reflected borders
+    of cv2.GaussianBlur (BORDER_REFLECT_101).
+
+    Args:
+        images(tf.Tensor):      (N, H, W, C) float images
+        ksize(int):             size of the kernel
+        sigma(float):           standard deviation, derived from ksize when None
+    Returns:
+        blurred(tf.Tensor):     (N, H, W, C) float images
+    """
+    channels = images.shape[-1]
+    kernel = tf.constant(gaussian_kernel(ksize, sigma))
+    pad = ksize // 2
+    images = tf.pad(images, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT')
+    rows = tf.tile(tf.reshape(kernel, [ksize, 1, 1, 1]), [1, 1, channels, 1])
+    cols = tf.tile(tf.reshape(kernel, [1, ksize, 1, 1]), [1, 1, channels, 1])
+    images = tf.nn.depthwise_conv2d(images, rows, [1, 1, 1, 1], 'VALID')
+    return tf.nn.depthwise_conv2d(images, cols, [1, 1, 1, 1], 'VALID')
+
+
+def rgb_to_hsv_cv(images):
+    """
+    HSV conversion of RGB images with the formulas and the 8-bit ranges of
+    cv2.COLOR_RGB2HSV: hue in [0, 180), saturation and value in [0, 255].
+
+    Args:
+        images(tf.Tensor):      (N, H, W, 3) float images in [0, 255]
+    Returns:
+        h, s, v(tf.Tensor):     (N, H, W) float channels
+    """
+    r, g, b = tf.unstack(images, axis=-1)
+    v = tf.maximum(tf.maximum(r, g), b)
+    diff = v - tf.minimum(tf.minimum(r, g), b)
+    s = tf.round(tf.math.divide_no_nan(diff * 255., v))
+    h = tf.where(v == r, (g - b) * 60., tf.where(
+        v == g, (b - r) * 60. + 120. * diff, (r - g) * 60. + 240. * diff))
+    h = tf.math.divide_no_nan(h, diff)
+    h = tf.where(h < 0., h + 360., h)
+    h = tf.math.floormod(tf.round(h * 0.5), 180.)
+    return h, s, v
+
+
+def in_range(hsv, lower, upper):
+    """
+    Mask of the pixels whose channels all are within [lower, upper], as
+    cv2.inRange, with the images stacked on the channel axis: (1, H, W, N).
+    The pooling of the morphology then runs on all the images at once.
+    """
+    inside = None
+    for channel, low, high in zip(hsv, lower, upper):
+        channel_inside = tf.logical_and(channel >= low, channel <= high)
+        inside = channel_inside if inside is None else tf.logical_and(inside, channel_inside)
+    return tf.cast(tf.transpose(inside, [1, 2, 0])[tf.newaxis], tf.float32)
+
+
+def dilate(masks, kernel, iterations=1):
+    """
+    Dilation of float masks by a structuring element given as rectangles,
+    pixels outside of the masks being ignored as in OpenCV.
+    """
+    for _ in range(iterations):
+        dilated = tf.nn.max_pool2d(masks, kernel[0], 1, 'SAME')
+        for rect in kernel[1:]:
+            dilated = tf.maximum(dilated, tf.nn.max_pool2d(masks, rect, 1, 'SAME'))
+        masks = dilated
+    return masks
+
+
+def erode(masks, kernel, iterations=1):
+    """ Erosion of float masks, pixels outside of the masks being ignored. """
+    return -dilate(-masks, kernel, iterations)
+
+
+def morph_close(masks, kernel=ELLIPSE_5X5, iterations=1):
+    """ Morphological closing, as cv2.morphologyEx(masks, cv2.MORPH_CLOSE, kernel). """
+    return erode(dilate(masks, kernel, iterations), kernel, iterations)
+
+
+def morph_open(masks, kernel=SQUARE_3X3, iterations=1):
+    """ Morphological opening, as cv2.morphologyEx(masks, cv2.MORPH_OPEN, kernel). """
+    return dilate(erode(masks, kernel, iterations), kernel, iterations)
+
+
+def fill_holes(masks):
+    """
+    Fills the holes of (1, H, W, N) float masks, like the filled external
+    contours of fill_object: the background is grown from the image borders
+    through the 4-connected background pixels, and everything it does not
+    reach is set to the foreground.
+    """
+    background = 1. - masks
+    border = tf.pad(tf.zeros_like(masks[:, 1:-1, 1:-1]), [[0, 0], [1, 1], [1, 1], [0, 0]],
+                    constant_values=1.)
+    reached = background * border
+
+    def grow(reached, previous):
+        return dilate(reached, CROSS_3X3) * background, reached
+
+    def not_done(reached, previous):
+        return tf.reduce_any(tf.not_equal(reached, previous))
+
+    reached, _ = tf.while_loop(not_done, grow, [reached, tf.zeros_like(reached)])
+    return 1. - reached
+
+
+@tf.function(reduce_retracing=True)
+def leaf_masks(images, ls1=17, ls2=60, mask_type=1, white=True, fill=True):
+    """
+    TensorFlow version of the HSV color masks of back_segmentation (without
+    image adjustments nor distance transform), to segment the leaves online
+    in a tf.data pipeline or a model: blur, HSV color ranges and closings of
+    color_mask, remove_whites, then the hole filling and opening of
+    fill_object.
+
+    Args:
+        images(tf.Tensor):      (N, H, W, 3) RGB images in [0, 255]
+        ls1(int):               lower saturation on yellow-green-blue
+        ls2(int):               lower saturation on red-brown-orange
+        mask_type(int):         type of mask, see color_mask
+        white(bool):            option to keep the white pixels
+        fill(bool):             option to fill the holes of the masks
+    Returns:
+        masks(tf.Tensor):       (N, H, W, 1) float masks, 1 on the leaves
+    """
+    images = tf.cast(images, tf.float32)
+    hsv = rgb_to_hsv_cv(tf.round(gaussian_blur(images)))
+
+    # mask on yellow-green-blue
+    healthy_mask = morph_close(in_range(hsv, *hsv_bounds(HSV_GREEN, ls1)))
+    upper_red_brown = in_range(hsv, *hsv_bounds(HSV_RED_BROWN))
+    if mask_type == 1:
+        # masks on red and on orange-yellow
+        red_mask = in_range(hsv, *hsv_bounds(HSV_RED))
+        orange_mask = in_range(hsv, *hsv_bounds(HSV_ORANGE))
+        disease_mask = morph_close(tf.maximum(red_mask, orange_mask),
+                                   iterations=DISEASE_CLOSE_ITERATIONS)
+    else:
+        # mask on red-brown-orange
+        disease_mask = morph_close(in_range(hsv, *hsv_bounds(HSV_BROWN, ls2)))
+    disease_mask = tf.maximum(disease_mask, upper_red_brown)
+
+    # Mask on white on green leaves
+    white_mask = in_range(hsv, *hsv_bounds(HSV_WHITE))
+    masks = morph_close(tf.maximum(tf.maximum(healthy_mask, disease_mask), white_mask))
+
+    if white:
+        whites = tf.reduce_any(images >= float(WHITE_LEVEL), axis=-1)
+        masks = tf.maximum(masks, tf.cast(tf.transpose(whites, [1, 2, 0])[tf.newaxis], tf.float32))
+    if fill:
+        masks = morph_open(fill_holes(masks))
+    return tf.transpose(masks, [3, 1, 2, 0])
+
+
+def segment_images(images, **kwargs):
+    """
+    Removes the background of a batch of images with leaf_masks, keeping
+    the type of the images.
+
+    Args:
+        images(tf.Tensor):      (N, H, W, 3) RGB images in [0, 255]
+        kwargs:                 options of leaf_masks
+    Returns:
+        seg_imgs(tf.Tensor):    (N, H, W, 3) images with the background removed
+    """
+    masks = leaf_masks(images, **kwargs)
+    return images * tf.cast(masks, images.dtype)
+
+
+def segmentation_map(images, labels):
+    """ tf.data map function segmenting a batch of (images, labels) elements. """
+    return segment_images(images), labels
+
+
+class LeafSegmentation(tf.keras.layers.Layer):
+    """
+    Keras preprocessing layer removing the background of RGB images in
+    [0, 255], see leaf_masks. Placed in front of a model, the segmentation
+    is applied the same way at training and serving time.
+
+    Attributes:
+        ls1 (int): lower saturation on yellow-green-blue
+        ls2 (int): lower saturation on red-brown-orange
+        mask_type (int): type of mask, see color_mask
+        white (bool): option to keep the white pixels
+        fill (bool): option to fill the holes of the masks
+    """
+
+    def __init__(self, ls1=17, ls2=60, mask_type=1, white=True, fill=True, **kwargs):
+        super().__init__(**kwargs)
+        self.ls1 = ls1
+        self.ls2 = ls2
+        self.mask_type = mask_type
+        self.white = white
+        self.fill = fill
+
+
+    def call(self, inputs):
+        return segment_images(inputs, ls1=self.ls1, ls2=self.ls2, mask_type=self.mask_type,
+                              white=self.white, fill=self.fill)
+
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'ls1': self.ls1, 'ls2': self.ls2, 'mask_type': self.mask_type,
+                       'white': self.white, 'fill': self.fill})
+        return config